@@ -0,0 +1,346 @@
+# Benchmarks of the library's hot paths on synthetic corpora
+# Run with: python -m benchmarks.run_benchmarks --help
+# No API calls are made: corpus and query embeddings are random, and query embeddings are pre-seeded in the embedding cache.
+from __future__ import annotations
+
+import argparse
+import functools
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from collections.abc import Callable
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from brain_wave import (
+    cache_utils,
+    chat_db,
+    embedding_utils,
+    logit_bias,
+    prompt_utils,
+    retrieval,
+    retrieval_strategies,
+    tokenization,
+)
+from brain_wave.prompts import mathqa
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_REPEATS = 5
+# rows per parent group in the synthetic corpus
+PARENT_GROUP_SIZE = 10
+# larger corpora are subsampled for the token counting and chat log benchmarks
+MAX_TOKEN_COUNT_TEXTS = 10000
+MAX_CHATS = 10000
+QUERIES = [
+    "How do I find the greatest common factor of 12 and 18?",
+    "What is the slope of the line through (1, 2) and (3, 8)?",
+    "How do I solve 3x + 5 = 20?",
+    "What is the area of a circle with radius 4?",
+]
+WORDS = (
+    "the a of to and is in that it for on with as are be this by number equation fraction decimal slope line "
+    "angle triangle area volume factor multiply divide add subtract solve variable graph ratio percent prime"
+).split()
+
+logger = logging.getLogger(__name__)
+
+
+def create_synthetic_db(work_dir: Path, n_rows: int, dim: int, seed: int = 0) -> retrieval.RetrievalDb:
+    """A RetrievalDb with random texts and random unit-length embeddings, grouped into parent groups."""
+    rng = np.random.default_rng(seed)
+    n_words = rng.integers(20, 80, size=n_rows)
+    word_ids = rng.integers(0, len(WORDS), size=n_words.sum())
+    offsets = np.concatenate([[0], np.cumsum(n_words)])
+    texts = [" ".join(WORDS[j] for j in word_ids[offsets[i] : offsets[i + 1]]) for i in range(n_rows)]
+    row_ids = np.arange(n_rows)
+    df = pd.DataFrame(
+        {
+            "text": texts,
+            # roughly 1.3 tokens per word; counting 1M texts with tiktoken would dominate setup time
+            "n_tokens": (n_words * 1.3).astype(int),
+            "chapter": row_ids // (PARENT_GROUP_SIZE * 100),
+            "section": (row_ids // PARENT_GROUP_SIZE) % 100,
+            "paragraph": row_ids % PARENT_GROUP_SIZE,
+        }
+    )
+    db = retrieval.RetrievalDb(work_dir, f"synthetic_{n_rows}", "text", df)
+    embedding_mat = np.empty((n_rows, dim), dtype=np.float32)
+    for start in range(0, n_rows, 65536):
+        batch = rng.standard_normal((min(65536, n_rows - start), dim), dtype=np.float32)
+        embedding_mat[start : start + len(batch)] = batch / np.linalg.norm(batch, axis=1, keepdims=True)
+    db.embedding_mat = embedding_mat
+    return db
+
+
+def seed_query_embeddings(queries: list[str], dim: int, seed: int = 1):
+    """Put random embeddings for the queries in a fresh in-memory embedding cache, so retrieval needs no API calls."""
+    rng = np.random.default_rng(seed)
+    embedding_cache = cache_utils.EmbeddingCache(None)
+    texts = [retrieval.normalize_text(query) for query in queries]
+    embeddings = list(rng.standard_normal((len(texts), dim), dtype=np.float32))
+    embedding_cache.put_many(texts, embeddings, embedding_utils.EMBEDDING_MODEL)
+    embedding_utils.set_embedding_cache(embedding_cache)
+
+
+def time_function(func: Callable, repeats: int) -> dict[str, float]:
+    """Wall-clock timings of func() over repeats calls, after one untimed warm-up call."""
+    func()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {
+        "min_s": min(times),
+        "median_s": statistics.median(times),
+        "mean_s": statistics.mean(times),
+        "repeats": repeats,
+    }
+
+
+def get_benchmarks(db: retrieval.RetrievalDb, work_dir: Path, dim: int) -> dict[str, Callable[[], Callable]]:
+    """Map of benchmark name -> setup function, which returns the function to time."""
+    n_rows = len(db.df)
+    rng = np.random.default_rng(2)
+    query_embedding = rng.standard_normal(dim, dtype=np.float32)
+    distances = db.compute_embedding_distances(query_embedding, exact=True)
+
+    def clear_indexes():
+        db.quantized_embeddings = None
+        db.ann_index = None
+
+    def setup_distances():
+        clear_indexes()
+        return lambda: db.compute_embedding_distances(query_embedding, exact=True)
+
+    def setup_distances_quantized():
+        clear_indexes()
+        db.quantize_embeddings()
+
+        def run():
+            return db.compute_embedding_distances(query_embedding)
+
+        return run
+
+    def setup_distances_ann():
+        clear_indexes()
+        db.build_ann_index(min_rows=0)
+
+        def run():
+            return db.compute_embedding_distances(query_embedding)
+
+        return run
+
+    def setup_fill_string_single():
+        db_info = retrieval.DbInfo(db, max_tokens=2000)
+        return lambda: db_info.get_fill_string_from_distances(distances)
+
+    def setup_fill_string_parent():
+        db_info = retrieval.DbInfo(
+            db,
+            max_tokens=2000,
+            use_parent_text=True,
+            parent_group_cols=["chapter", "section"],
+            parent_sort_cols=["paragraph"],
+        )
+        return lambda: db_info.get_fill_string_from_distances(distances)
+
+    def setup_build_query():
+        clear_indexes()
+        db_info = retrieval.DbInfo(db, max_tokens=1000)
+        retrieval_strategy = retrieval_strategies.MappedEmbeddingRetrievalStrategy(
+            {"rori_microlesson_texts": db_info, "openstax_subsection_texts": db_info},
+        )
+        intro_messages = prompt_utils.PromptSelector(mathqa.intro_prompts).get_default_intro_prompt()["messages"]
+
+        def run():
+            for query in QUERIES:
+                prompt_manager = prompt_utils.PromptManager()
+                prompt_manager.set_intro_messages(intro_messages).set_retrieval_strategy(retrieval_strategy)
+                prompt_manager.build_query(query)
+
+        return run
+
+    def setup_logit_bias():
+        texts = db.texts[np.argsort(distances)[:20]]
+        recent_slot_fill_dict = [{"retrieved_texts": "\n".join(texts)}, {}]
+        return lambda: logit_bias.get_logit_bias_from_slot(recent_slot_fill_dict)
+
+    def create_chat_log(chat_log_class: type) -> chat_db.ChatLog:
+        log_dir = work_dir / f"{chat_log_class.__name__}_{n_rows}"
+        log_dir.mkdir(exist_ok=True)
+        chat_log = chat_log_class(log_dir)
+        for i in range(min(n_rows, MAX_CHATS)):
+            messages = [{"role": "user", "content": db.texts[i]}]
+            completion = {"choices": [{"message": {"role": "assistant", "content": db.texts[-i - 1]}}]}
+            chat_log.log_chat_completion(f"chat_{i}", messages, completion)
+        return chat_log
+
+    def setup_load_previous_chats(chat_log_class: type):
+        chat_log = create_chat_log(chat_log_class)
+        return lambda: chat_log.load_previous_chats(use_cached=False)
+
+    def setup_get_chat_by_id(chat_log_class: type):
+        chat_log = create_chat_log(chat_log_class)
+
+        def run():
+            # ChatLog loads every chat on first lookup, so time a fresh load plus the lookups
+            chat_log.chat_id_dict = None
+            for i in range(0, min(n_rows, MAX_CHATS), 100):
+                chat_log.get_chat_by_id(f"chat_{i}")
+
+        return run
+
+    def setup_search_chats(chat_log_class: type):
+        chat_log = create_chat_log(chat_log_class)
+
+        def run():
+            chat_log.chat_id_dict = None
+            return chat_log.search_chats("triangle area")
+
+        return run
+
+    def setup_get_chat_statistics(chat_log_class: type):
+        chat_log = create_chat_log(chat_log_class)
+
+        def run():
+            chat_log.chat_id_dict = None
+            return chat_log.get_chat_statistics()
+
+        return run
+
+    def setup_token_counts_uncached():
+        texts = list(db.texts[:MAX_TOKEN_COUNT_TEXTS])
+        return lambda: embedding_utils.get_token_counts(texts, use_cache=False)
+
+    def setup_token_counts_cached():
+        texts = list(db.texts[:MAX_TOKEN_COUNT_TEXTS])
+        tokenization.get_token_counter(embedding_utils.EMBEDDING_MODEL).cache_size = max(
+            tokenization.TOKEN_COUNT_CACHE_SIZE, len(texts)
+        )
+        return lambda: embedding_utils.get_token_counts(texts)
+
+    return {
+        "compute_embedding_distances": setup_distances,
+        "compute_embedding_distances_quantized": setup_distances_quantized,
+        "compute_embedding_distances_ann": setup_distances_ann,
+        "get_fill_string_from_distances_single": setup_fill_string_single,
+        "get_fill_string_from_distances_parent": setup_fill_string_parent,
+        "build_query": setup_build_query,
+        "get_logit_bias_from_slot": setup_logit_bias,
+        "load_previous_chats": functools.partial(setup_load_previous_chats, chat_db.ChatLog),
+        "load_previous_chats_sqlite": functools.partial(setup_load_previous_chats, chat_db.SqliteChatLog),
+        "get_chat_by_id": functools.partial(setup_get_chat_by_id, chat_db.ChatLog),
+        "get_chat_by_id_sqlite": functools.partial(setup_get_chat_by_id, chat_db.SqliteChatLog),
+        "search_chats": functools.partial(setup_search_chats, chat_db.ChatLog),
+        "search_chats_sqlite": functools.partial(setup_search_chats, chat_db.SqliteChatLog),
+        "get_chat_statistics": functools.partial(setup_get_chat_statistics, chat_db.ChatLog),
+        "get_chat_statistics_sqlite": functools.partial(setup_get_chat_statistics, chat_db.SqliteChatLog),
+        "get_token_counts_uncached": setup_token_counts_uncached,
+        "get_token_counts_cached": setup_token_counts_cached,
+    }
+
+
+def run_benchmarks(
+    sizes: list[int],
+    dim: int,
+    repeats: int,
+    work_dir: Path,
+    benchmark_names: list[str] | None = None,
+) -> list[dict]:
+    """Run the benchmarks on a synthetic corpus of each size.
+
+    Returns:
+        list[dict]: One result per (benchmark, size), with timings in seconds or an error.
+    """
+    seed_query_embeddings(QUERIES, dim)
+    results = []
+    for n_rows in sizes:
+        logger.info(f"Creating a synthetic corpus of {n_rows} rows.")
+        db = create_synthetic_db(work_dir, n_rows, dim)
+        for name, setup in get_benchmarks(db, work_dir, dim).items():
+            if benchmark_names is not None and name not in benchmark_names:
+                continue
+            result = {"benchmark": name, "n_rows": n_rows, "dim": dim}
+            try:
+                result.update(time_function(setup(), repeats))
+                logger.info(f"{name} ({n_rows} rows): {result['median_s'] * 1000:.2f} ms")
+            except Exception as ex:
+                logger.warning(f"{name} ({n_rows} rows) failed: {ex}")
+                result["error"] = f"{type(ex).__name__}: {ex}"
+            results.append(result)
+    return results
+
+
+def get_metadata() -> dict:
+    try:
+        git_commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True, cwd=Path(__file__).parent
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        git_commit = None
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "git_commit": git_commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def compare_results(results: list[dict], baseline_results: list[dict]) -> str:
+    """Table of median timings relative to a baseline run; ratios above 1 are slower than the baseline."""
+    baseline_map = {(r["benchmark"], r["n_rows"]): r for r in baseline_results if "median_s" in r}
+    lines = [f"{'benchmark':<42}{'n_rows':>10}{'baseline ms':>14}{'current ms':>14}{'ratio':>8}"]
+    for result in results:
+        baseline = baseline_map.get((result["benchmark"], result["n_rows"]))
+        if baseline is None or "median_s" not in result:
+            continue
+        lines.append(
+            f"{result['benchmark']:<42}{result['n_rows']:>10}{baseline['median_s'] * 1000:>14.2f}"
+            f"{result['median_s'] * 1000:>14.2f}{result['median_s'] / baseline['median_s']:>8.2f}"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark BrainWave hot paths on synthetic corpora.")
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=DEFAULT_SIZES,
+        help="Corpus sizes; 1000000 rows at 1536 dimensions needs about 6GB of memory for the embeddings.",
+    )
+    parser.add_argument("--dim", type=int, default=embedding_utils.EMBEDDING_DIM)
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS)
+    parser.add_argument("--benchmarks", nargs="+", default=None, help="Benchmark names to run; defaults to all.")
+    parser.add_argument("--output-json", type=Path, default=None, help="Write the results to this file.")
+    parser.add_argument("--compare", type=Path, default=None, help="Compare against the results in this file.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = run_benchmarks(args.sizes, args.dim, args.repeats, Path(work_dir), args.benchmarks)
+    report = {"metadata": get_metadata(), "results": results}
+    if args.output_json is not None:
+        with open(args.output_json, "w") as outfile:
+            json.dump(report, outfile, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare is not None:
+        with open(args.compare) as infile:
+            print(compare_results(results, json.load(infile)["results"]))
+
+
+if __name__ == "__main__":
+    main()
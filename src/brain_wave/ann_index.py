@@ -0,0 +1,133 @@
+# Approximate nearest-neighbour search over RetrievalDb embeddings
+# Implements an inverted file (IVF) index: rows are clustered with spherical k-means,
+# and a query is only scored against the rows in its n_probe closest clusters.
+# See: https://github.com/facebookresearch/faiss/wiki/Faster-search
+from __future__ import annotations
+
+from pathlib import Path
+
+import numpy as np
+
+# below this many rows, exact search is fast enough that an index isn't worth the recall loss
+MIN_ROWS_FOR_ANN = 20000
+DEFAULT_N_PROBE = 8
+KMEANS_MAX_TRAINING_ROWS_PER_LIST = 256
+# rows assigned to centroids per matrix product, bounding the (batch, n_lists) scores matrix
+ASSIGNMENT_BATCH_SIZE = 8192
+
+
+class IvfIndex:
+    """Inverted file index over a unit-normalized embedding matrix.
+
+    Rows are stored grouped by cluster: the ids of the rows in cluster i are `list_ids[list_offsets[i]:list_offsets[i + 1]]`.
+
+    Recall/latency is tuned with:
+     - n_lists (at build time): more lists means smaller lists and faster queries, but lower recall for a fixed n_probe.
+     - n_probe (at query time): more probed lists means higher recall and slower queries. n_probe == n_lists is exact.
+    """
+
+    def __init__(
+        self,
+        centroids: np.array,
+        list_offsets: np.array,
+        list_ids: np.array,
+        n_probe: int = DEFAULT_N_PROBE,
+    ):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.n_probe = n_probe
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    @property
+    def n_rows(self) -> int:
+        return len(self.list_ids)
+
+    @classmethod
+    def build(
+        cls,
+        embedding_mat: np.array,
+        n_lists: int | None = None,
+        n_probe: int = DEFAULT_N_PROBE,
+        n_iter: int = 10,
+        seed: int = 0,
+    ) -> IvfIndex:
+        """Cluster the rows of embedding_mat and build the inverted lists.
+
+        Args:
+            embedding_mat (np.array): Unit-normalized float32 embeddings, e.g. `RetrievalDb.embedding_mat`.
+            n_lists (int | None, optional): Number of clusters. Defaults to None, meaning 4 * sqrt(n).
+            n_probe (int, optional): Number of clusters scored per query. Defaults to DEFAULT_N_PROBE.
+            n_iter (int, optional): k-means iterations. Defaults to 10.
+            seed (int, optional): Seed for k-means initialization and training sample. Defaults to 0.
+
+        Returns:
+            IvfIndex: The built index.
+        """
+        n_rows = len(embedding_mat)
+        if n_lists is None:
+            n_lists = max(1, int(4 * np.sqrt(n_rows)))
+        n_lists = min(n_lists, n_rows)
+        rng = np.random.default_rng(seed)
+        n_training_rows = min(n_rows, n_lists * KMEANS_MAX_TRAINING_ROWS_PER_LIST)
+        training_mat = np.asarray(embedding_mat[np.sort(rng.choice(n_rows, n_training_rows, replace=False))])
+        centroids = training_mat[rng.choice(n_training_rows, n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            assignments = assign_to_centroids(training_mat, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, training_mat)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            is_empty = norms[:, 0] == 0
+            # empty clusters keep their previous centroid
+            centroids[~is_empty] = sums[~is_empty] / norms[~is_empty]
+        assignments = assign_to_centroids(embedding_mat, centroids)
+        list_ids = np.argsort(assignments, kind="stable")
+        list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        list_offsets[1:] = np.cumsum(np.bincount(assignments, minlength=n_lists))
+        return cls(centroids, list_offsets, list_ids, n_probe=n_probe)
+
+    def get_candidate_ids(self, query_embedding: np.array, n_probe: int | None = None) -> np.array:
+        """Row ids in the n_probe clusters closest to the query.
+
+        Args:
+            query_embedding (np.array): Unit-normalized query embedding.
+            n_probe (int | None, optional): Overrides the index's n_probe if provided. Defaults to None.
+
+        Returns:
+            np.array: Candidate row ids, in no particular order.
+        """
+        if n_probe is None:
+            n_probe = self.n_probe
+        if n_probe >= self.n_lists:
+            return self.list_ids
+        centroid_scores = self.centroids @ query_embedding
+        probed_lists = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe]
+        return np.concatenate(
+            [self.list_ids[self.list_offsets[i] : self.list_offsets[i + 1]] for i in probed_lists],
+        )
+
+    def save(self, filepath: Path):
+        np.savez(
+            filepath,
+            centroids=self.centroids,
+            list_offsets=self.list_offsets,
+            list_ids=self.list_ids,
+            n_probe=self.n_probe,
+        )
+
+    @classmethod
+    def load(cls, filepath: Path) -> IvfIndex:
+        with np.load(filepath) as data:
+            return cls(data["centroids"], data["list_offsets"], data["list_ids"], n_probe=int(data["n_probe"]))
+
+
+def assign_to_centroids(embedding_mat: np.array, centroids: np.array) -> np.array:
+    """Index of the closest (by cosine) centroid for each row of embedding_mat."""
+    assignments = np.empty(len(embedding_mat), dtype=np.int64)
+    for start in range(0, len(embedding_mat), ASSIGNMENT_BATCH_SIZE):
+        batch = np.asarray(embedding_mat[start : start + ASSIGNMENT_BATCH_SIZE])
+        assignments[start : start + len(batch)] = np.argmax(batch @ centroids.T, axis=1)
+    return assignments
@@ -0,0 +1,163 @@
+# Persistent caches for API results
+# Caches live in BRAIN_WAVE_CACHE_DIR if set, otherwise ~/.cache/brain_wave
+from __future__ import annotations
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+import numpy as np
+
+EMBEDDING_CACHE_MEMORY_SIZE = 4096
+
+logger = logging.getLogger(__name__)
+
+
+def get_default_cache_dir() -> Path:
+    if "BRAIN_WAVE_CACHE_DIR" in os.environ:
+        return Path(os.environ["BRAIN_WAVE_CACHE_DIR"])
+    return Path.home() / ".cache" / "brain_wave"
+
+
+def hash_key(*parts: str) -> str:
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+class SqliteStore:
+    """Thread-safe key -> bytes store in a single SQLite table."""
+
+    def __init__(self, db_filepath: Path, table_name: str):
+        db_filepath.parent.mkdir(parents=True, exist_ok=True)
+        self.table_name = table_name
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_filepath, check_same_thread=False)
+        with self.lock, self.connection:
+            # WAL lets multiple processes read while one writes
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS {table_name} (key TEXT PRIMARY KEY, value BLOB)")
+
+    def get_many(self, keys: list[str]) -> dict[str, bytes]:
+        values = {}
+        # SQLite limits the number of bound parameters per statement
+        for start in range(0, len(keys), 500):
+            batch = keys[start : start + 500]
+            placeholders = ",".join("?" * len(batch))
+            with self.lock:
+                rows = self.connection.execute(
+                    f"SELECT key, value FROM {self.table_name} WHERE key IN ({placeholders})",
+                    batch,
+                ).fetchall()
+            values.update(rows)
+        return values
+
+    def put_many(self, items: list[tuple[str, bytes]]):
+        with self.lock, self.connection:
+            self.connection.executemany(f"INSERT OR REPLACE INTO {self.table_name} (key, value) VALUES (?, ?)", items)
+
+
+class EmbeddingCache:
+    """Per-text embedding cache: a bounded in-memory LRU in front of an optional on-disk SQLite store.
+
+    Keys are a hash of the model name and the normalized text, so batches that share some texts share cache entries.
+    """
+
+    def __init__(self, db_filepath: Path | None = None, memory_size: int = EMBEDDING_CACHE_MEMORY_SIZE):
+        self.memory_size = memory_size
+        self.memory_cache: collections.OrderedDict[str, np.array] = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.store = None
+        if db_filepath is not None:
+            try:
+                self.store = SqliteStore(db_filepath, "embeddings")
+            except (OSError, sqlite3.Error) as ex:
+                logger.warning(f"Failed to open embedding cache {db_filepath}; caching in memory only: {ex}")
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get_many(self, texts: list[str], embedding_model: str) -> list[np.array | None]:
+        """Cached embeddings for the given texts, with None for each text that isn't cached."""
+        keys = [hash_key(embedding_model, normalize_cache_text(text)) for text in texts]
+        embeddings = [None] * len(texts)
+        with self.lock:
+            for i, key in enumerate(keys):
+                if key in self.memory_cache:
+                    self.memory_cache.move_to_end(key)
+                    embeddings[i] = self.memory_cache[key]
+                    self.memory_hits += 1
+        missing_keys = list({keys[i] for i, embedding in enumerate(embeddings) if embedding is None})
+        stored = self.store.get_many(missing_keys) if self.store is not None and len(missing_keys) > 0 else {}
+        with self.lock:
+            for i, key in enumerate(keys):
+                if embeddings[i] is not None:
+                    continue
+                if key in stored:
+                    embeddings[i] = np.frombuffer(stored[key], dtype=np.float32)
+                    self._put_memory(key, embeddings[i])
+                    self.disk_hits += 1
+                else:
+                    self.misses += 1
+        return embeddings
+
+    def put_many(self, texts: list[str], embeddings: list[np.array], embedding_model: str):
+        items = []
+        with self.lock:
+            for text, embedding in zip(texts, embeddings):
+                key = hash_key(embedding_model, normalize_cache_text(text))
+                embedding = np.asarray(embedding, dtype=np.float32)
+                self._put_memory(key, embedding)
+                items.append((key, embedding.tobytes()))
+        if self.store is not None:
+            self.store.put_many(items)
+
+    def _put_memory(self, key: str, embedding: np.array):
+        self.memory_cache[key] = embedding
+        self.memory_cache.move_to_end(key)
+        while len(self.memory_cache) > self.memory_size:
+            self.memory_cache.popitem(last=False)
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_entries": len(self.memory_cache),
+        }
+
+
+class CompletionCache:
+    """Exact-match chat completion cache in an on-disk SQLite store, keyed by a hash of the request.
+
+    See `completion_utils.get_completion_cache_key`.
+    """
+
+    def __init__(self, db_filepath: Path):
+        self.store = SqliteStore(db_filepath, "completions")
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> dict | None:
+        values = self.store.get_many([key])
+        if key not in values:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(values[key])
+
+    def put(self, key: str, completion: dict):
+        self.store.put_many([(key, json.dumps(completion).encode("utf-8"))])
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def normalize_cache_text(text: str) -> str:
+    return " ".join(text.split())
@@ -1,7 +1,11 @@
+from __future__ import annotations
+
 import json
 import logging
+import sqlite3
+import threading
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 from pathlib import Path
 
 
@@ -74,12 +78,7 @@ class ChatLog:
         return matching_chat_ids
 
 
-def generate_chat_id():
-    curr_date = datetime.now().strftime("%Y%m%d")
-    curr_timestamp = datetime.now().timestamp()
-    return f"{uuid.uuid4()}_{curr_date}_{curr_timestamp}"
-
-def get_chat_by_id(self, chat_id: str) -> dict:
+    def get_chat_by_id(self, chat_id: str) -> dict:
         """Retrieve a specific chat session by its ID.
         
         Args:
@@ -237,3 +236,253 @@ def get_chat_by_id(self, chat_id: str) -> dict:
                     
         self.logger.info(f"Deleted {deleted_files} old log files")
         return deleted_files
+
+
+class SqliteChatLog(ChatLog):
+    """ChatLog stored in a local SQLite database, keeping the most recent record per chat_id.
+
+    Lookups by chat_id, time ranges and statistics are indexed queries, so nothing is loaded into memory at startup.
+    If the SQLite build supports FTS5 trigram indexes (SQLite 3.34+), searches for role or content are indexed too.
+    Existing ndjson logs can be copied in with `import_logs`.
+    """
+
+    def __init__(self, log_dir: Path, filename: str = "chat_log.sqlite"):
+        super().__init__(log_dir, filename)
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.log_file, check_same_thread=False)
+        # SQLite's lower() only folds ASCII; searches should match ChatLog.search_chats, which uses str.lower()
+        self.connection.create_function("python_lower", 1, python_lower, deterministic=True)
+        with self.lock, self.connection:
+            # WAL lets multiple processes read while one writes
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS chats (
+                    chat_id TEXT PRIMARY KEY,
+                    logged_timestamp REAL NOT NULL,
+                    n_messages INTEGER NOT NULL,
+                    record TEXT NOT NULL
+                )""",
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS chats_logged_timestamp_index ON chats (logged_timestamp)",
+            )
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS chat_messages (
+                    id INTEGER PRIMARY KEY,
+                    chat_id TEXT NOT NULL,
+                    role TEXT,
+                    content TEXT
+                )""",
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS chat_messages_chat_id_index ON chat_messages (chat_id)")
+        self.use_fts = self.create_fts_index()
+
+    def create_fts_index(self) -> bool:
+        """Create a trigram full-text index over message roles and contents, kept in sync by triggers.
+
+        Returns:
+            bool: False if this SQLite build doesn't support FTS5 trigram indexes.
+        """
+        try:
+            with self.lock, self.connection:
+                is_new = (
+                    self.connection.execute(
+                        "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'chat_messages_fts'",
+                    ).fetchone()
+                    is None
+                )
+                self.connection.execute(
+                    """CREATE VIRTUAL TABLE IF NOT EXISTS chat_messages_fts USING fts5(
+                        role, content, content='chat_messages', content_rowid='id', tokenize='trigram'
+                    )""",
+                )
+                self.connection.execute(
+                    """CREATE TRIGGER IF NOT EXISTS chat_messages_insert AFTER INSERT ON chat_messages BEGIN
+                        INSERT INTO chat_messages_fts (rowid, role, content) VALUES (new.id, new.role, new.content);
+                    END""",
+                )
+                self.connection.execute(
+                    """CREATE TRIGGER IF NOT EXISTS chat_messages_delete AFTER DELETE ON chat_messages BEGIN
+                        INSERT INTO chat_messages_fts (chat_messages_fts, rowid, role, content)
+                        VALUES ('delete', old.id, old.role, old.content);
+                    END""",
+                )
+                if is_new:
+                    # index any messages logged before the index existed
+                    self.connection.execute("INSERT INTO chat_messages_fts (chat_messages_fts) VALUES ('rebuild')")
+        except sqlite3.OperationalError as ex:
+            self.logger.info(f"Full-text search unavailable, so chat searches will scan all messages: {ex}")
+            return False
+        return True
+
+    def log_dict(self, dict_to_log: dict) -> bool:
+        """Store the record, unless a record with the same chat_id and a later logged_timestamp is already stored.
+
+        Returns:
+            bool: True if the record was stored.
+        """
+        if "chat_id" not in dict_to_log:
+            self.logger.warning("Not logging a record without a chat_id.")
+            return False
+        chat_id = dict_to_log["chat_id"]
+        logged_timestamp = dict_to_log["logged_timestamp"]
+        messages = dict_to_log["messages"]
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT logged_timestamp FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()
+            if row is not None and row[0] >= logged_timestamp:
+                # like load_previous_chats, keep the earlier-logged record on ties
+                return False
+            self.connection.execute(
+                "INSERT OR REPLACE INTO chats (chat_id, logged_timestamp, n_messages, record) VALUES (?, ?, ?, ?)",
+                (chat_id, logged_timestamp, len(messages), json.dumps(dict_to_log)),
+            )
+            self.connection.execute("DELETE FROM chat_messages WHERE chat_id = ?", (chat_id,))
+            self.connection.executemany(
+                "INSERT INTO chat_messages (chat_id, role, content) VALUES (?, ?, ?)",
+                [
+                    (chat_id, get_message_field_string(message, "role"), get_message_field_string(message, "content"))
+                    for message in messages
+                ],
+            )
+        return True
+
+    def import_logs(self, log_filepaths: list[Path] | None = None) -> int:
+        """Copy records from ndjson chat logs, e.g. those written by a ChatLog in the same directory.
+
+        Args:
+            log_filepaths (list[Path] | None, optional): Logs to import.
+                Defaults to None, meaning all ndjson logs in log_dir.
+
+        Returns:
+            int: Number of records stored.
+        """
+        if log_filepaths is None:
+            log_filepaths = self.list_previous_logs()
+        n_stored = 0
+        for log_filepath in log_filepaths:
+            with open(log_filepath) as infile:
+                for line in infile:
+                    d = json.loads(line)
+                    if "chat_id" in d and self.log_dict(d):
+                        n_stored += 1
+        self.logger.info(f"Imported {n_stored} chat records from {len(log_filepaths)} log files.")
+        return n_stored
+
+    def load_previous_chats(self, use_cached: bool = True) -> dict:
+        """Loads all stored chats, oldest first. Prefer the indexed lookups for single chats or statistics.
+
+        Args:
+            use_cached (bool, optional): If previously-loaded chats should be used. Defaults to True.
+
+        Returns:
+            dict: Map of chat_id -> saved contents dict
+        """
+        if self.chat_id_dict is not None and use_cached:
+            return self.chat_id_dict
+        with self.lock:
+            rows = self.connection.execute("SELECT record FROM chats ORDER BY logged_timestamp").fetchall()
+        chat_id_dict = {}
+        for (record,) in rows:
+            d = json.loads(record)
+            chat_id_dict[d["chat_id"]] = d
+        self.chat_id_dict = chat_id_dict
+        return self.chat_id_dict
+
+    def get_chat_by_id(self, chat_id: str) -> dict:
+        """Retrieve a specific chat session by its ID, with a single lookup in the chat_id index.
+
+        Returns:
+            dict: The complete chat session data, or None if no chat with the given ID is stored.
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT record FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def search_chats(self, keyword: str, field: str = "content") -> list[dict]:
+        """Search through all stored chats for messages containing the keyword, ignoring case.
+
+        Searches of role or content use the full-text index if it is available and the keyword has 3+ characters;
+        other fields are searched by `ChatLog.search_chats`, which loads every chat.
+        """
+        if field not in ["role", "content"]:
+            return super().search_chats(keyword, field)
+        if self.use_fts and len(keyword) >= 3:
+            # with the trigram tokenizer, a phrase matches any case-insensitive substring of at least 3 characters
+            phrase = '"' + keyword.replace('"', '""') + '"'
+            query = """SELECT record FROM chats WHERE chat_id IN (
+                SELECT chat_messages.chat_id FROM chat_messages_fts
+                JOIN chat_messages ON chat_messages.id = chat_messages_fts.rowid
+                WHERE chat_messages_fts MATCH ?
+            ) ORDER BY logged_timestamp"""
+            parameters = (f"{field} : {phrase}",)
+        else:
+            query = f"""SELECT record FROM chats WHERE chat_id IN (
+                SELECT chat_id FROM chat_messages WHERE instr(python_lower({field}), ?) > 0
+            ) ORDER BY logged_timestamp"""
+            parameters = (keyword.lower(),)
+        with self.lock:
+            rows = self.connection.execute(query, parameters).fetchall()
+        return [json.loads(record) for (record,) in rows]
+
+    def get_chat_statistics(self) -> dict:
+        """Calculate basic statistics about stored chat sessions; see `ChatLog.get_chat_statistics`."""
+        with self.lock:
+            total_sessions, total_messages, earliest_timestamp, latest_timestamp = self.connection.execute(
+                # separate subqueries, so MIN and MAX are each a single lookup in the logged_timestamp index
+                """SELECT
+                    (SELECT COUNT(*) FROM chats),
+                    (SELECT SUM(n_messages) FROM chats),
+                    (SELECT MIN(logged_timestamp) FROM chats),
+                    (SELECT MAX(logged_timestamp) FROM chats)""",
+            ).fetchone()
+        if total_sessions == 0:
+            return {
+                "total_sessions": 0,
+                "total_messages": 0,
+                "earliest_date": None,
+                "latest_date": None,
+                "avg_messages": 0,
+            }
+        return {
+            "total_sessions": total_sessions,
+            "total_messages": total_messages,
+            "earliest_date": datetime.fromtimestamp(earliest_timestamp).isoformat(),
+            "latest_date": datetime.fromtimestamp(latest_timestamp).isoformat(),
+            "avg_messages": total_messages / total_sessions,
+        }
+
+    def cleanup_old_logs(self, days_to_keep: int = 30) -> int:
+        """Delete chats last logged more than days_to_keep days ago.
+
+        Returns:
+            int: Number of deleted chats.
+        """
+        cutoff_timestamp = (datetime.now() - timedelta(days=days_to_keep)).timestamp()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM chat_messages WHERE chat_id IN (SELECT chat_id FROM chats WHERE logged_timestamp < ?)",
+                (cutoff_timestamp,),
+            )
+            deleted_chats = self.connection.execute(
+                "DELETE FROM chats WHERE logged_timestamp < ?",
+                (cutoff_timestamp,),
+            ).rowcount
+        self.chat_id_dict = None
+        self.logger.info(f"Deleted {deleted_chats} old chats")
+        return deleted_chats
+
+
+def python_lower(value: str | None) -> str | None:
+    return None if value is None else value.lower()
+
+
+def get_message_field_string(message: dict, field: str) -> str | None:
+    """The field as a string, as `ChatLog.search_chats` compares it; None if missing."""
+    return str(message[field]) if field in message else None
+
+
+def generate_chat_id():
+    curr_date = datetime.now().strftime("%Y%m%d")
+    curr_timestamp = datetime.now().timestamp()
+    return f"{uuid.uuid4()}_{curr_date}_{curr_timestamp}"
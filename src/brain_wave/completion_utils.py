@@ -0,0 +1,201 @@
+# Chat completions with an exact, content-addressed cache
+# docs: https://platform.openai.com/docs/api-reference/chat/create
+from __future__ import annotations
+
+import json
+import logging
+import sqlite3
+import time
+from collections.abc import Iterator
+
+import openai
+
+from brain_wave import cache_utils, prompt_utils, tokenization, tracing
+
+DEFAULT_TEMPERATURE = 1.0
+
+logger = logging.getLogger(__name__)
+
+# set by get_completion_cache() on first use
+_completion_cache: cache_utils.CompletionCache | None = None
+
+
+def create_chat_completion(
+    model: str,
+    messages: list[dict[str, str]],
+    temperature: float = DEFAULT_TEMPERATURE,
+    max_tokens: int | None = None,
+    logit_bias: dict[int, float] | None = None,
+    use_cache: bool | None = None,
+    **kwargs,
+) -> dict:
+    """Call `openai.ChatCompletion.create`, serving identical requests from the completion cache.
+
+    Args:
+        model (str): Chat model to use.
+        messages (list[dict[str, str]]): Messages, e.g. from `prompt_utils.PromptManager.build_query`.
+        temperature (float, optional): Sampling temperature. Defaults to DEFAULT_TEMPERATURE, the API default.
+        max_tokens (int | None, optional): Maximum tokens to generate. Defaults to None, meaning no limit.
+        logit_bias (dict[int, float] | None, optional): See `logit_bias`. Defaults to None.
+        use_cache (bool | None, optional): Whether to use the completion cache. Defaults to None, meaning only if
+            temperature is 0: at higher temperatures, repeating a request is expected to give a different completion.
+        kwargs: Passed on to `openai.ChatCompletion.create`, but not part of the cache key (e.g. request_timeout).
+
+    Returns:
+        dict: The completion; completion["choices"][0]["message"] is the assistant message.
+    """
+    if use_cache is None:
+        use_cache = temperature == 0
+    request_kwargs = get_request_kwargs(model, messages, temperature, max_tokens, logit_bias)
+    with tracing.span("chat_completion", model=model) as completion_span:
+        completion_cache = get_completion_cache() if use_cache else None
+        if completion_cache is not None:
+            key = get_completion_cache_key(model, messages, temperature, max_tokens, logit_bias)
+            completion = completion_cache.get(key)
+            if completion is not None:
+                if completion_span is not None:
+                    completion_span.set_attribute("cached", True)
+                return completion
+        completion = openai.ChatCompletion.create(**request_kwargs, **kwargs)
+        if completion_cache is not None:
+            completion_cache.put(key, completion)
+        return completion
+
+
+def create_chat_completion_stream(
+    model: str,
+    messages: list[dict[str, str]],
+    temperature: float = DEFAULT_TEMPERATURE,
+    max_tokens: int | None = None,
+    logit_bias: dict[int, float] | None = None,
+    use_cache: bool | None = None,
+    **kwargs,
+) -> Iterator[str]:
+    """Streaming version of `create_chat_completion`, yielding pieces of the assistant message content as they arrive.
+
+    A cached completion is yielded as a single piece; a streamed completion is cached once it is complete,
+    in the same shape as a `create_chat_completion` response, with usage computed by `compute_usage`.
+    The request is sent on the first iteration.
+    If tracing is enabled, a "chat_completion" span covering the whole stream is recorded once it is complete.
+
+    Returns:
+        Iterator[str]: Pieces of the content; joined, they form the full assistant message content.
+    """
+    if use_cache is None:
+        use_cache = temperature == 0
+    request_kwargs = get_request_kwargs(model, messages, temperature, max_tokens, logit_bias)
+    # the stream is consumed by the caller, so it can't be timed with a `with tracing.span()` block
+    start_time = time.perf_counter()
+    completion_cache = get_completion_cache() if use_cache else None
+    if completion_cache is not None:
+        key = get_completion_cache_key(model, messages, temperature, max_tokens, logit_bias)
+        completion = completion_cache.get(key)
+        if completion is not None:
+            yield completion["choices"][0]["message"]["content"]
+            tracing.record_span("chat_completion", start_time, model=model, cached=True)
+            return
+    content_pieces = []
+    first_token_time = None
+    chunk = {}
+    finish_reason = None
+    for chunk in openai.ChatCompletion.create(**request_kwargs, **kwargs, stream=True):
+        choice = chunk["choices"][0]
+        finish_reason = choice.get("finish_reason") or finish_reason
+        content_piece = choice["delta"].get("content")
+        if content_piece:
+            if first_token_time is None:
+                first_token_time = time.perf_counter()
+            content_pieces.append(content_piece)
+            yield content_piece
+    if completion_cache is not None:
+        content = "".join(content_pieces)
+        completion = {
+            "id": chunk.get("id"),
+            "object": "chat.completion",
+            "created": chunk.get("created"),
+            "model": chunk.get("model", model),
+            "choices": [
+                {"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": finish_reason},
+            ],
+            "usage": compute_usage(model, messages, content),
+        }
+        completion_cache.put(key, completion)
+    span_attributes = {"model": model}
+    if first_token_time is not None:
+        span_attributes["time_to_first_token_ms"] = round((first_token_time - start_time) * 1000, 1)
+    tracing.record_span("chat_completion", start_time, **span_attributes)
+
+
+def compute_usage(model: str, messages: list[dict[str, str]], completion_content: str) -> dict[str, int]:
+    """Token usage of a completion, as the API reports it; streamed responses don't include usage.
+
+    Prompt tokens include the chat format overhead; see `prompt_utils.PromptManager.count_message_tokens`.
+    """
+    token_counter = tokenization.get_token_counter(model)
+    prompt_tokens = prompt_utils.TOKENS_PER_REPLY
+    for message in messages:
+        prompt_tokens += prompt_utils.TOKENS_PER_MESSAGE + sum(token_counter.count_tokens(list(message.values())))
+        if "name" in message:
+            prompt_tokens += prompt_utils.TOKENS_PER_NAME
+    completion_tokens = token_counter.count_tokens([completion_content])[0]
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def get_request_kwargs(
+    model: str,
+    messages: list[dict[str, str]],
+    temperature: float,
+    max_tokens: int | None,
+    logit_bias: dict[int, float] | None,
+) -> dict:
+    request_kwargs = {"model": model, "messages": messages, "temperature": temperature}
+    if max_tokens is not None:
+        request_kwargs["max_tokens"] = max_tokens
+    if logit_bias is not None:
+        request_kwargs["logit_bias"] = logit_bias
+    return request_kwargs
+
+
+def get_completion_cache_key(
+    model: str,
+    messages: list[dict[str, str]],
+    temperature: float,
+    max_tokens: int | None,
+    logit_bias: dict[int, float] | None,
+) -> str:
+    """Hash of everything in a request that affects the completion."""
+    if logit_bias is not None:
+        # JSON object keys are strings, so a logit bias can equivalently be given with int or str token keys
+        logit_bias = {str(token): float(bias) for token, bias in logit_bias.items()}
+    request_string = json.dumps(
+        [model, messages, float(temperature), max_tokens, logit_bias],
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return cache_utils.hash_key(request_string)
+
+
+def get_completion_cache() -> cache_utils.CompletionCache | None:
+    """The completion cache used by `create_chat_completion`.
+
+    By default, `completions.sqlite` in `cache_utils.get_default_cache_dir()`; None if it can't be opened.
+    """
+    global _completion_cache
+    if _completion_cache is None:
+        try:
+            _completion_cache = cache_utils.CompletionCache(cache_utils.get_default_cache_dir() / "completions.sqlite")
+        except (OSError, sqlite3.Error) as ex:
+            logger.warning(f"Failed to open the completion cache; not caching completions: {ex}")
+            return None
+    return _completion_cache
+
+
+def set_completion_cache(completion_cache: cache_utils.CompletionCache | None):
+    """Replace the completion cache, e.g. to keep an evaluation run's completions in their own file.
+    None restores the default cache."""
+    global _completion_cache
+    _completion_cache = completion_cache
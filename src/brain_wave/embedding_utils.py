@@ -1,75 +1,196 @@
+import asyncio
+import concurrent.futures
 import functools
 
 import numpy as np
 import openai
-import tiktoken
+
+from brain_wave import cache_utils, rate_limit, tokenization
 
 EMBEDDING_DIM = 1536
 MAX_TOKENS_PER_REQUEST = 8191
 EMBEDDING_MODEL = "text-embedding-ada-002"
-
-
-def get_token_counts(text_list: list[str]) -> list[int]:
+# default OpenAI limits for the embedding model; lower these for restricted accounts
+REQUESTS_PER_MINUTE = 3000
+TOKENS_PER_MINUTE = 1000000
+MAX_CONCURRENT_REQUESTS = 4
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+)
+
+# set by get_embedding_cache() on first use
+_embedding_cache: cache_utils.EmbeddingCache | None = None
+
+
+def get_token_counts(text_list: list[str], use_cache: bool = True) -> list[int]:
     """Given a list of texts, returns a list of the same length with the number of tokens from the EMBEDDING_MODEL tokenizer.
 
     Args:
         text_list (list[str]): Texts to tokenize.
+        use_cache (bool, optional): Whether to memoize the counts; see `tokenization.TokenCounter.count_tokens`.
+            Defaults to True.
 
     Returns:
         list[int]: Token counts corresponding to text_list.
     """
-    tokenizer = tiktoken.encoding_for_model(EMBEDDING_MODEL)
-    token_counts = []
-    for string in text_list:
-        token_counts.append(len(tokenizer.encode(string)))
-    return token_counts
+    return tokenization.get_token_counts(text_list, model_name=EMBEDDING_MODEL, use_cache=use_cache)
 
 
-def get_openai_embeddings(texts: list[str], embedding_model: str = EMBEDDING_MODEL) -> list[np.array]:
+def get_openai_embeddings(
+    texts: list[str],
+    embedding_model: str = EMBEDDING_MODEL,
+    rate_limiter: rate_limit.TokenBucketRateLimiter | None = None,
+) -> list[np.array]:
     """Given the list of texts, query the openai Embedding API, returning the embeddings in a list of numpy arrays.
-    Note: calls through to a cahced function.
+    Note: embeddings are cached per text (see `get_embedding_cache`); only uncached texts are sent to the API.
 
     Args:
         texts (list[str]): List of texts to embed.
         embedding_model (str, optional): Embedding model to use. Defaults to EMBEDDING_MODEL.
+        rate_limiter (rate_limit.TokenBucketRateLimiter | None, optional): If provided, the API request waits for
+            the tokens of the uncached texts. Defaults to None.
 
     Returns:
-        list[np.array]: Embeddings, in the same order as the given texts.
+        list[np.array]: float32 embeddings, in the same order as the given texts.
+    """
+    embedding_cache = get_embedding_cache()
+    embeddings = embedding_cache.get_many(texts, embedding_model)
+    missing_texts = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+    if len(missing_texts) > 0:
+        if rate_limiter is not None:
+            rate_limiter.acquire(sum(get_token_counts(missing_texts, use_cache=False)))
+        result = openai.Embedding.create(input=missing_texts, engine=embedding_model)
+        missing_embeddings = [np.array(d["embedding"], dtype=np.float32) for d in result.data]
+        embedding_cache.put_many(missing_texts, missing_embeddings, embedding_model)
+        missing_embedding_map = dict(zip(missing_texts, missing_embeddings))
+        embeddings = [
+            missing_embedding_map[text] if embedding is None else embedding for text, embedding in zip(texts, embeddings)
+        ]
+    return embeddings
+
+
+async def aget_openai_embeddings(texts: list[str], embedding_model: str = EMBEDDING_MODEL) -> list[np.array]:
+    """Async version of `get_openai_embeddings`, sharing the same per-text cache.
+
+    Args:
+        texts (list[str]): List of texts to embed.
+        embedding_model (str, optional): Embedding model to use. Defaults to EMBEDDING_MODEL.
+
+    Returns:
+        list[np.array]: float32 embeddings, in the same order as the given texts.
+    """
+    embedding_cache = get_embedding_cache()
+    # cache lookups may hit the on-disk store, so keep them off the event loop
+    embeddings = await asyncio.to_thread(embedding_cache.get_many, texts, embedding_model)
+    missing_texts = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+    if len(missing_texts) > 0:
+        result = await openai.Embedding.acreate(input=missing_texts, engine=embedding_model)
+        missing_embeddings = [np.array(d["embedding"], dtype=np.float32) for d in result.data]
+        await asyncio.to_thread(embedding_cache.put_many, missing_texts, missing_embeddings, embedding_model)
+        missing_embedding_map = dict(zip(missing_texts, missing_embeddings))
+        embeddings = [
+            missing_embedding_map[text] if embedding is None else embedding for text, embedding in zip(texts, embeddings)
+        ]
+    return embeddings
+
+
+def get_embedding_cache() -> cache_utils.EmbeddingCache:
+    """The embedding cache used by `get_openai_embeddings`.
+
+    By default, an in-memory LRU in front of `embeddings.sqlite` in `cache_utils.get_default_cache_dir()`.
+    Use `get_embedding_cache().get_stats()` for hit/miss counts.
     """
-    return get_openai_embeddings_cached(tuple(texts), embedding_model=embedding_model)
+    global _embedding_cache
+    if _embedding_cache is None:
+        _embedding_cache = cache_utils.EmbeddingCache(cache_utils.get_default_cache_dir() / "embeddings.sqlite")
+    return _embedding_cache
 
 
-@functools.lru_cache(maxsize=512, typed=True)
-def get_openai_embeddings_cached(texts: tuple[str], embedding_model: str = EMBEDDING_MODEL) -> list[np.array]:
-    result = openai.Embedding.create(input=texts, engine=embedding_model)
-    embedding_list = [np.array(d["embedding"]) for d in result.data]
-    return embedding_list
+def set_embedding_cache(embedding_cache: cache_utils.EmbeddingCache):
+    """Replace the embedding cache, e.g. with `cache_utils.EmbeddingCache(None)` to cache in memory only."""
+    global _embedding_cache
+    _embedding_cache = embedding_cache
 
 
-def batch_embed_texts(input_text_list: list[str], n_tokens_list: list[int]) -> list[np.array]:
+@functools.cache
+def get_rate_limiter() -> rate_limit.TokenBucketRateLimiter:
+    """Rate limiter shared by all `batch_embed_texts` calls in this process."""
+    return rate_limit.TokenBucketRateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+
+
+def batch_embed_texts(
+    input_text_list: list[str],
+    n_tokens_list: list[int],
+    max_workers: int = MAX_CONCURRENT_REQUESTS,
+    max_retries: int = 5,
+) -> np.array:
     """Embed the given texts, respecting the API max tokens limit given MAX_TOKENS_PER_REQUEST.
 
+    Batches are sent concurrently from a bounded thread pool, subject to the shared rate limiter (see `get_rate_limiter`),
+    and retried with jittered backoff on transient API errors. Only uncached texts count against the token limit.
+
     Args:
         input_text_list (list[str]): Texts to embed.
         n_tokens_list (list[int]): As returned by `get_token_counts`
+        max_workers (int, optional): Maximum concurrent requests. Defaults to MAX_CONCURRENT_REQUESTS.
+        max_retries (int, optional): Retries per batch before giving up. Defaults to 5.
 
     Returns:
-        list[np.array]: List of embeddings, stored in numpy arrays.
+        np.array: float32 matrix of embeddings, of shape (len(input_text_list), EMBEDDING_DIM), in input order.
     """
+    input_text_list = list(input_text_list)
+    batch_bounds = get_batch_bounds(n_tokens_list)
+    embedding_mat = np.empty((len(input_text_list), EMBEDDING_DIM), dtype=np.float32)
+    rate_limiter = get_rate_limiter()
+
+    def embed_batch(start: int, end: int):
+        # every attempt, including retries after a rate limit error, waits for the rate limiter
+        embedding_list = rate_limit.call_with_retries(
+            lambda: get_openai_embeddings(input_text_list[start:end], EMBEDDING_MODEL, rate_limiter=rate_limiter),
+            RETRYABLE_ERRORS,
+            max_retries=max_retries,
+        )
+        # each batch writes its own rows, so results are reassembled in input order
+        embedding_mat[start:end] = embedding_list
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(embed_batch, start, end) for start, end, _ in batch_bounds]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+    return embedding_mat
+
+
+def get_batch_bounds(n_tokens_list: list[int]) -> list[tuple[int, int, int]]:
+    """Split texts into consecutive batches of at most MAX_TOKENS_PER_REQUEST tokens.
+
+    Args:
+        n_tokens_list (list[int]): As returned by `get_token_counts`
+
+    Raises:
+        ValueError: If a single text is longer than MAX_TOKENS_PER_REQUEST.
+
+    Returns:
+        list[tuple[int, int, int]]: (start, end, n_tokens) for each batch.
+    """
+    batch_bounds = []
+    start = 0
     curr_batch_token_count = 0
-    texts = []
-    embedding_list = []
-    for text, n_tokens in zip(input_text_list, n_tokens_list):
+    for i, n_tokens in enumerate(n_tokens_list):
+        if n_tokens > MAX_TOKENS_PER_REQUEST:
+            raise ValueError(f"Text {i} has {n_tokens} tokens, more than the limit of {MAX_TOKENS_PER_REQUEST}.")
         if curr_batch_token_count + n_tokens > MAX_TOKENS_PER_REQUEST:
-            embedding_list.extend(get_openai_embeddings(texts, EMBEDDING_MODEL))
-            texts = [text]
+            batch_bounds.append((start, i, curr_batch_token_count))
+            start = i
             curr_batch_token_count = 0
-        else:
-            texts.append(text)
-            curr_batch_token_count += n_tokens
-    if len(texts) > 0:
-        embedding_list.extend(get_openai_embeddings(texts, EMBEDDING_MODEL))
-    return embedding_list
+        curr_batch_token_count += n_tokens
+    if start < len(n_tokens_list):
+        batch_bounds.append((start, len(n_tokens_list), curr_batch_token_count))
+    return batch_bounds
+
 
 def cosine_similarity(embedding1: np.array, embedding2: np.array) -> float:
     """Calculate cosine similarity between two embeddings.
@@ -0,0 +1,108 @@
+# Lexical (keyword) retrieval over RetrievalDb texts
+# Okapi BM25, stored as an inverted index: for each term, the rows containing it and the term's frequency in each row.
+# See: https://en.wikipedia.org/wiki/Okapi_BM25
+from __future__ import annotations
+
+import re
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def tokenize(text: str) -> list[str]:
+    """Lower-cased alphanumeric terms; numbers are kept, since they matter in math questions."""
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+
+class Bm25Index:
+    """BM25 inverted index in compressed sparse row form.
+
+    The rows containing term t (with id `vocab[t]`) are `doc_ids[term_offsets[t]:term_offsets[t + 1]]`,
+    with corresponding counts in `term_freqs`.
+    """
+
+    def __init__(
+        self,
+        vocab: dict[str, int],
+        term_offsets: np.array,
+        doc_ids: np.array,
+        term_freqs: np.array,
+        doc_lengths: np.array,
+        k1: float = BM25_K1,
+        b: float = BM25_B,
+    ):
+        self.vocab = vocab
+        self.term_offsets = term_offsets
+        self.doc_ids = doc_ids
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        n_docs = len(doc_lengths)
+        doc_freqs = np.diff(term_offsets)
+        self.idf = np.log(1 + (n_docs - doc_freqs + 0.5) / (doc_freqs + 0.5)).astype(np.float32)
+        avg_doc_length = doc_lengths.mean() if n_docs > 0 else 0
+        # per-row part of the BM25 denominator, which doesn't depend on the query
+        self.length_norms = (k1 * (1 - b + b * doc_lengths / max(avg_doc_length, 1))).astype(np.float32)
+
+    @property
+    def n_docs(self) -> int:
+        return len(self.doc_lengths)
+
+    @classmethod
+    def build(cls, texts: list[str], k1: float = BM25_K1, b: float = BM25_B) -> Bm25Index:
+        vocab = {}
+        postings = []
+        doc_lengths = np.zeros(len(texts), dtype=np.int64)
+        for doc_id, text in enumerate(texts):
+            terms = tokenize(text)
+            doc_lengths[doc_id] = len(terms)
+            for term, count in Counter(terms).items():
+                postings.append((vocab.setdefault(term, len(vocab)), doc_id, count))
+        postings = np.array(postings, dtype=np.int64).reshape(-1, 3)
+        postings = postings[np.lexsort((postings[:, 1], postings[:, 0]))]
+        term_offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        term_offsets[1:] = np.cumsum(np.bincount(postings[:, 0], minlength=len(vocab)))
+        return cls(vocab, term_offsets, postings[:, 1], postings[:, 2].astype(np.float32), doc_lengths, k1=k1, b=b)
+
+    def compute_scores(self, query_str: str) -> np.array:
+        """BM25 score of every row for the given query; rows sharing no terms with the query score 0.
+
+        Returns:
+            np.array: Scores, one per row; higher is more relevant.
+        """
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        for term in set(tokenize(query_str)):
+            if term not in self.vocab:
+                continue
+            term_id = self.vocab[term]
+            start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+            doc_ids = self.doc_ids[start:end]
+            term_freqs = self.term_freqs[start:end]
+            scores[doc_ids] += (
+                self.idf[term_id] * term_freqs * (self.k1 + 1) / (term_freqs + self.length_norms[doc_ids])
+            )
+        return scores
+
+    def save(self, filepath: Path):
+        terms = np.array(sorted(self.vocab, key=self.vocab.get), dtype=str)
+        np.savez(
+            filepath,
+            terms=terms,
+            term_offsets=self.term_offsets,
+            doc_ids=self.doc_ids,
+            term_freqs=self.term_freqs,
+            doc_lengths=self.doc_lengths,
+            params=np.array([self.k1, self.b]),
+        )
+
+    @classmethod
+    def load(cls, filepath: Path) -> Bm25Index:
+        with np.load(filepath) as data:
+            vocab = {term: i for i, term in enumerate(data["terms"].tolist())}
+            k1, b = data["params"].tolist()
+            return cls(vocab, data["term_offsets"], data["doc_ids"], data["term_freqs"], data["doc_lengths"], k1=k1, b=b)
@@ -11,12 +11,11 @@ from collections import Counter
 
 import tiktoken
 
-from brain_wave import resources
+from brain_wave import resources, tokenization
 
 
-@functools.cache
-def get_tokenizer(model_name: str = "gpt-3.5-turbo") -> tiktoken.Encoding:
-    """Get the tokenizer. Cached.
+def get_tokenizer(model_name: str = tokenization.DEFAULT_MODEL) -> tiktoken.Encoding:
+    """Get the tokenizer. Shared with the rest of the package; see `tokenization.get_tokenizer`.
 
     Args:
         model_name (str, optional): The model tokenizer to load. Defaults to "gpt-3.5-turbo".
@@ -24,8 +23,7 @@ def get_tokenizer(model_name: str = "gpt-3.5-turbo") -> tiktoken.Encoding:
     Returns:
         tiktoken.Encoding: The tiktoken/OpenAI tokenizer.
     """
-    tokenizer = tiktoken.encoding_for_model(model_name)
-    return tokenizer
+    return tokenization.get_tokenizer(model_name)
 
 
 @functools.cache
@@ -1,10 +1,22 @@
 from __future__ import annotations
 
+import functools
 import re
+import string as string_utils
+from collections.abc import Generator
 
-from brain_wave import embedding_utils, retrieval_strategies
+import numpy as np
+
+from brain_wave import cache_utils, response_cache, retrieval, retrieval_strategies, tokenization, tracing
 
 VALID_ROLES: list[str] = ["user", "assistant", "system"]
+# chat format overhead per message
+# see: https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+TOKENS_PER_MESSAGE: int = 3
+TOKENS_PER_NAME: int = 1
+# every reply is primed with <|start|>assistant<|message|>
+TOKENS_PER_REPLY: int = 3
+PROMPT_TEMPLATE_CACHE_SIZE: int = 256
 
 
 class PromptSelector:
@@ -85,6 +97,13 @@ class PromptManager:
         self.stored_messages: list[dict[str, str]] = []
         self.most_recent_slot_fill_dict: dict[str, str] = {}
         self.recent_slot_fill_dict: list[dict[str, str]] = []
+        # token counts of stored_messages[:len(stored_message_token_counts)], and their running sum
+        self.stored_message_token_counts: list[int] = []
+        self.stored_token_count: int = 0
+        # opt-in; see set_response_cache
+        self.response_cache: response_cache.SemanticResponseCache | None = None
+        self.response_cache_namespace: str = ""
+        self.pending_response_cache_query: tuple[str, np.array] | None = None
 
     def set_intro_messages(self, intro_messages: list[dict[str, str]]) -> PromptManager:
         self.intro_messages = intro_messages
@@ -97,12 +116,72 @@ class PromptManager:
     def get_retrieval_strategy(self) -> retrieval_strategies.RetrievalStrategy:
         return self.retrieval_strategy
 
+    def set_response_cache(
+        self,
+        semantic_response_cache: response_cache.SemanticResponseCache | None,
+        cache_namespace: str = "",
+    ) -> PromptManager:
+        """Use the given cache for answers to the first question of a conversation; None disables response caching.
+
+        Args:
+            semantic_response_cache (response_cache.SemanticResponseCache | None): Cache, which may be shared.
+            cache_namespace (str, optional): Identifies settings that change the response other than the intro messages,
+                e.g. the retrieval option. Defaults to "".
+        """
+        self.response_cache = semantic_response_cache
+        self.response_cache_namespace = cache_namespace
+        self.pending_response_cache_query = None
+        return self
+
+    def get_cached_response(self, user_query: str) -> dict[str, str] | None:
+        """Look up a cached answer to the user_query, before calling `build_query` with it.
+
+        Only the first question of a conversation is looked up, as later answers depend on the conversation so far.
+        On a miss, pass the generated answer to `cache_response`.
+
+        Returns:
+            dict[str, str] | None: The cached assistant message, or None.
+        """
+        self.pending_response_cache_query = None
+        if self.response_cache is None or len(self.stored_messages) > 0:
+            return None
+        # build_query passes this embedding on to retrieval, so the query is only embedded once
+        query_embedding = retrieval.embed_query(user_query)
+        entry = self.response_cache.get(query_embedding, self.get_response_cache_namespace())
+        if entry is not None:
+            return entry.response.copy()
+        self.pending_response_cache_query = (user_query, query_embedding)
+        return None
+
+    def cache_response(self, assistant_message: dict[str, str]):
+        """Store the answer to the user_query most recently missed by `get_cached_response`, if any."""
+        if self.response_cache is None or self.pending_response_cache_query is None:
+            return
+        user_query, query_embedding = self.pending_response_cache_query
+        self.pending_response_cache_query = None
+        response = {"role": assistant_message["role"], "content": assistant_message["content"]}
+        self.response_cache.put(user_query, query_embedding, response, self.get_response_cache_namespace())
+
+    def get_pending_query_embedding(self, query_for_retrieval_context: str) -> np.array | None:
+        """The embedding from the last `get_cached_response` miss, if it was for the given query."""
+        if self.pending_response_cache_query is None:
+            return None
+        user_query, query_embedding = self.pending_response_cache_query
+        return query_embedding if user_query == query_for_retrieval_context else None
+
+    def get_response_cache_namespace(self) -> str:
+        intro_message_strings = [message["role"] + ":" + message["content"] for message in self.intro_messages]
+        return cache_utils.hash_key(self.response_cache_namespace, *intro_message_strings)
+
     def add_stored_message(self, message: dict[str, str]) -> PromptManager:
         self.stored_messages.append(message)
+        self._update_stored_token_counts()
         return self
 
     def clear_stored_messages(self) -> PromptManager:
         self.stored_messages.clear()
+        self.stored_message_token_counts.clear()
+        self.stored_token_count = 0
         return self
 
     def build_query(
@@ -124,6 +203,61 @@ class PromptManager:
         Returns:
             list[dict[str, str]]: List of messages, to pass to the OpenAI API.
         """
+        with tracing.span("build_query"):
+            messages = self._start_query(user_query, previous_messages)
+            fill_steps = self._fill_messages(messages, user_query, query_for_retrieval_context)
+            slot_fill_dict = None
+            while True:
+                try:
+                    expected_slots, query = fill_steps.send(slot_fill_dict)
+                except StopIteration as stop:
+                    should_remove_user_query_message = stop.value
+                    break
+                with tracing.span("do_retrieval", strategy=type(self.retrieval_strategy).__name__):
+                    slot_fill_dict = self.retrieval_strategy.do_retrieval(
+                        expected_slots,
+                        query,
+                        messages,
+                        query_embedding=self.get_pending_query_embedding(query),
+                    )
+            return self._finish_query(messages, user_query, should_remove_user_query_message)
+
+    async def abuild_query(
+        self,
+        user_query: str | None = None,
+        previous_messages: list[dict[str, str]] | None = None,
+        query_for_retrieval_context: str | None = None,
+    ) -> list[dict[str, str]]:
+        """Async version of `build_query`, using the RetrievalStrategy's `ado_retrieval`.
+
+        Messages' slots are still filled one message at a time, but the retrieval calls don't block the event loop,
+        so a single event loop can build queries for many conversations.
+        Don't await several abuild_query calls on the same PromptManager at once, as they share the stored messages.
+        """
+        with tracing.span("build_query"):
+            messages = self._start_query(user_query, previous_messages)
+            fill_steps = self._fill_messages(messages, user_query, query_for_retrieval_context)
+            slot_fill_dict = None
+            while True:
+                try:
+                    expected_slots, query = fill_steps.send(slot_fill_dict)
+                except StopIteration as stop:
+                    should_remove_user_query_message = stop.value
+                    break
+                with tracing.span("do_retrieval", strategy=type(self.retrieval_strategy).__name__):
+                    slot_fill_dict = await self.retrieval_strategy.ado_retrieval(
+                        expected_slots,
+                        query,
+                        messages,
+                        query_embedding=self.get_pending_query_embedding(query),
+                    )
+            return self._finish_query(messages, user_query, should_remove_user_query_message)
+
+    def _start_query(
+        self,
+        user_query: str | None,
+        previous_messages: list[dict[str, str]] | None,
+    ) -> list[dict[str, str]]:
         if previous_messages is None:
             previous_messages = self.stored_messages
         if len(previous_messages) == 0:
@@ -141,46 +275,125 @@ class PromptManager:
             }
             messages.append(user_message)
             self.stored_messages.append(user_message)
+        return messages
 
+    def _fill_messages(
+        self,
+        messages: list[dict[str, str]],
+        user_query: str | None,
+        query_for_retrieval_context: str | None,
+    ) -> Generator[tuple[list[str], str], dict[str, str], bool]:
+        """Fill the messages' slots in place, most recent message first; shared by `build_query` and `abuild_query`.
+
+        For each message with slots, yields (expected_slots, query_for_retrieval_context),
+        and must be sent the RetrievalStrategy's slot fill dict for them.
+        Returns True if the user_query was used to fill a slot.
+        """
         should_remove_user_query_message = False
         if query_for_retrieval_context is None:
             query_for_retrieval_context = ""
         for message in messages[::-1]:
-            expected_slots = PromptManager.identify_slots(message["content"])
+            prompt_template = get_prompt_template(message["content"])
+            expected_slots = prompt_template.slots
             if len(expected_slots) > 0:
-                slot_fill_dict = self.retrieval_strategy.do_retrieval(
-                    expected_slots,
-                    query_for_retrieval_context,
-                    messages,
-                )
-                self.most_recent_slot_fill_dict = slot_fill_dict
-                self.recent_slot_fill_dict.append(slot_fill_dict)
-                assert len(slot_fill_dict) == len(expected_slots), "Unexpected fill provided."
-                if "user_query" in slot_fill_dict and user_query is not None:
-                    # special case: fill user_query slots with the current user_query
-                    slot_fill_dict["user_query"] = user_query
+                slot_fill_dict = yield expected_slots, query_for_retrieval_context
+                if self._fill_slots(message, prompt_template, slot_fill_dict, user_query):
                     should_remove_user_query_message = True
-                try:
-                    message["content"] = message["content"].format(**slot_fill_dict)
-                except KeyError:
-                    raise KeyError(f"Failed to fill {expected_slots} with {slot_fill_dict}.")
             else:
                 self.recent_slot_fill_dict.append({})
             if query_for_retrieval_context == "" and message["role"] == "user":
                 # use as retrieval context the most recent user message
                 # TODO rethink this, providing a more flexible way to specify the retrieval context
                 query_for_retrieval_context = message["content"]
+        return should_remove_user_query_message
+
+    def _fill_slots(
+        self,
+        message: dict[str, str],
+        prompt_template: PromptTemplate,
+        slot_fill_dict: dict[str, str],
+        user_query: str | None,
+    ) -> bool:
+        """Fill the message's slots in place; returns True if the user_query was used to fill a slot."""
+        self.most_recent_slot_fill_dict = slot_fill_dict
+        self.recent_slot_fill_dict.append(slot_fill_dict)
+        expected_slots = prompt_template.slots
+        assert len(slot_fill_dict) == len(expected_slots), "Unexpected fill provided."
+        used_user_query = False
+        if "user_query" in slot_fill_dict and user_query is not None:
+            # special case: fill user_query slots with the current user_query
+            slot_fill_dict["user_query"] = user_query
+            used_user_query = True
+        try:
+            with tracing.span("fill_template"):
+                message["content"] = prompt_template.fill(slot_fill_dict)
+        except KeyError:
+            raise KeyError(f"Failed to fill {expected_slots} with {slot_fill_dict}.")
+        return used_user_query
+
+    def _finish_query(
+        self,
+        messages: list[dict[str, str]],
+        user_query: str | None,
+        should_remove_user_query_message: bool,
+    ) -> list[dict[str, str]]:
         self.recent_slot_fill_dict = self.recent_slot_fill_dict[::-1]
         if should_remove_user_query_message:
             self.stored_messages.pop()
             assert messages[-1]["content"] == user_query
             messages = messages[:-1]
+        # newly stored messages are counted only now, after their slots are filled
+        with tracing.span("count_tokens"):
+            self._update_stored_token_counts()
         return messages
 
     def compute_stored_token_counts(self) -> int:
-        token_counts = embedding_utils.get_token_counts([message["content"] for message in self.stored_messages])
-        total_token_count = sum(token_counts)
-        return total_token_count
+        """Prompt tokens the stored messages would use in a ChatCompletion request, including chat format overhead.
+
+        Maintained incrementally as messages are stored, so this doesn't re-tokenize the conversation.
+        """
+        self._update_stored_token_counts()
+        if len(self.stored_messages) == 0:
+            return 0
+        return self.stored_token_count + TOKENS_PER_REPLY
+
+    def compute_intro_token_count(self) -> int:
+        """Prompt tokens used by the intro messages before any slots are filled, including chat format overhead.
+
+        Slot fills add to this; e.g. subtract it from a token budget to get the room left for retrieved texts.
+        """
+        n_tokens = 0
+        for message in self.intro_messages:
+            n_tokens += PromptManager.count_message_tokens({**message, "content": ""})
+            n_tokens += get_prompt_template(message["content"]).static_token_count
+        return n_tokens
+
+    def _update_stored_token_counts(self):
+        n_counted = len(self.stored_message_token_counts)
+        if n_counted > len(self.stored_messages):
+            # stored_messages was truncated directly; drop the counts of the removed messages
+            self.stored_token_count -= sum(self.stored_message_token_counts[len(self.stored_messages) :])
+            del self.stored_message_token_counts[len(self.stored_messages) :]
+        elif n_counted < len(self.stored_messages):
+            new_token_counts = [
+                PromptManager.count_message_tokens(message) for message in self.stored_messages[n_counted:]
+            ]
+            self.stored_message_token_counts.extend(new_token_counts)
+            self.stored_token_count += sum(new_token_counts)
+
+    def count_message_tokens(message: dict[str, str]) -> int:
+        """Tokens used by the message in a ChatCompletion request, including chat format overhead.
+
+        Args:
+            message (dict[str, str]): Message with a "role", "content" and optional "name".
+
+        Returns:
+            int: Token count.
+        """
+        n_tokens = TOKENS_PER_MESSAGE + sum(tokenization.get_token_counts(list(message.values())))
+        if "name" in message:
+            n_tokens += TOKENS_PER_NAME
+        return n_tokens
 
     def identify_slots(prompt_string: str) -> list[str]:
         """Uses a regex to identify missing slots in a prompt_string.
@@ -195,3 +408,90 @@ class PromptManager:
         """
         expected_slots = re.findall(r"{[^{} ]+}", prompt_string)
         return sorted({slot[1:-1] for slot in expected_slots})
+
+
+class PromptTemplate:
+    """A prompt string, parsed once into literal segments and the slots between them.
+
+    Filling the template joins the precomputed segments, equivalent to `str.format` on the prompt string.
+    Use `get_prompt_template` to get a cached instance.
+    """
+
+    def __init__(self, prompt_string: str):
+        self.prompt_string = prompt_string
+        self.slots: list[str] = PromptManager.identify_slots(prompt_string) if "{" in prompt_string else []
+        # literals[i] precedes slot fill i; None if the prompt needs str.format (e.g. format specs like {slot:>10})
+        self.literals: list[str] | None = None
+        self.slot_sequence: list[str] | None = None
+        if len(self.slots) > 0:
+            self._parse()
+
+    def _parse(self):
+        try:
+            parsed = list(string_utils.Formatter().parse(self.prompt_string))
+        except ValueError:
+            # malformed; str.format will raise when filled
+            return
+        literals = []
+        slot_sequence = []
+        literal = ""
+        for literal_text, field_name, format_spec, conversion in parsed:
+            literal += literal_text
+            if field_name is None:
+                continue
+            if field_name not in self.slots or not is_keyword_field(field_name):
+                return
+            if format_spec or conversion is not None:
+                return
+            literals.append(literal)
+            slot_sequence.append(field_name)
+            literal = ""
+        literals.append(literal)
+        self.literals = literals
+        self.slot_sequence = slot_sequence
+
+    def fill(self, slot_fill_dict: dict[str, str]) -> str:
+        """Fill the slots in the prompt string.
+
+        Raises:
+            KeyError: If slot_fill_dict lacks one of the slots.
+
+        Returns:
+            str: The filled prompt.
+        """
+        if len(self.slots) == 0:
+            return self.prompt_string
+        if self.literals is None:
+            return self.prompt_string.format(**slot_fill_dict)
+        parts = [self.literals[0]]
+        for slot, literal in zip(self.slot_sequence, self.literals[1:]):
+            parts.append(format(slot_fill_dict[slot]))
+            parts.append(literal)
+        return "".join(parts)
+
+    @functools.cached_property
+    def static_token_count(self) -> int:
+        """Tokens in the prompt excluding slot fills; approximate, as tokens can span a literal/fill boundary."""
+        if self.literals is None:
+            return tokenization.get_token_counts([self.prompt_string])[0]
+        return sum(tokenization.get_token_counts(self.literals))
+
+
+def is_keyword_field(field_name: str) -> bool:
+    """False for format fields that str.format treats as positional, attribute or index lookups."""
+    return not field_name.isdigit() and "." not in field_name and "[" not in field_name
+
+
+@functools.lru_cache(maxsize=PROMPT_TEMPLATE_CACHE_SIZE)
+def _compile_prompt_template(prompt_string: str) -> PromptTemplate:
+    return PromptTemplate(prompt_string)
+
+
+def get_prompt_template(prompt_string: str) -> PromptTemplate:
+    """Compiled PromptTemplate for the prompt string, cached by content.
+
+    Prompts without slots, such as most conversation messages, aren't cached so they don't evict the intro prompts.
+    """
+    if "{" not in prompt_string:
+        return PromptTemplate(prompt_string)
+    return _compile_prompt_template(prompt_string)
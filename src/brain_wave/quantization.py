@@ -0,0 +1,62 @@
+# Compact int8 storage of RetrievalDb embeddings
+# Used for a coarse first pass over the whole db; the best candidates are then re-scored at full precision.
+# See: https://qdrant.tech/articles/scalar-quantization/
+from __future__ import annotations
+
+from pathlib import Path
+
+import numpy as np
+
+# number of best coarse candidates re-scored against the full-precision embeddings
+DEFAULT_RESCORE_K = 100
+# rows scored per matrix product, bounding the float32 temporary created from the int8 codes
+SCORING_BATCH_SIZE = 4096
+
+
+class ScalarQuantizedEmbeddings:
+    """Per-dimension symmetric int8 quantization of a unit-normalized embedding matrix.
+
+    Each value x[i, j] is stored as round(x[i, j] / scales[j]), with scales[j] = max_i |x[i, j]| / 127.
+    Compared to float64 this is 8x smaller; compared to float32, 4x.
+    """
+
+    def __init__(self, codes: np.array, scales: np.array):
+        self.codes = codes
+        self.scales = scales
+
+    @classmethod
+    def from_embedding_mat(cls, embedding_mat: np.array) -> ScalarQuantizedEmbeddings:
+        max_abs = np.abs(embedding_mat).max(axis=0)
+        scales = np.where(max_abs > 0, max_abs / 127, 1).astype(np.float32)
+        codes = np.empty(embedding_mat.shape, dtype=np.int8)
+        for start in range(0, len(embedding_mat), SCORING_BATCH_SIZE):
+            batch = np.asarray(embedding_mat[start : start + SCORING_BATCH_SIZE], dtype=np.float32)
+            codes[start : start + len(batch)] = np.clip(np.rint(batch / scales), -127, 127)
+        return cls(codes, scales)
+
+    def compute_similarities(self, query_embedding: np.array, ids: np.array | None = None) -> np.array:
+        """Approximate dot products between the query and the quantized rows.
+
+        Args:
+            query_embedding (np.array): Unit-normalized float32 query embedding.
+            ids (np.array | None, optional): If provided, only these rows are scored. Defaults to None, meaning all rows.
+
+        Returns:
+            np.array: Approximate cosine similarities, one per scored row.
+        """
+        scaled_query = query_embedding * self.scales
+        n_rows = len(self.codes) if ids is None else len(ids)
+        similarities = np.empty(n_rows, dtype=np.float32)
+        for start in range(0, n_rows, SCORING_BATCH_SIZE):
+            end = start + SCORING_BATCH_SIZE
+            batch = self.codes[start:end] if ids is None else self.codes[ids[start:end]]
+            similarities[start:end] = batch.astype(np.float32) @ scaled_query
+        return similarities
+
+    def save(self, filepath: Path):
+        np.savez(filepath, codes=self.codes, scales=self.scales)
+
+    @classmethod
+    def load(cls, filepath: Path) -> ScalarQuantizedEmbeddings:
+        with np.load(filepath) as data:
+            return cls(data["codes"], data["scales"])
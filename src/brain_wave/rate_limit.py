@@ -0,0 +1,83 @@
+# Client-side rate limiting and retries for OpenAI API calls
+# docs: https://platform.openai.com/docs/guides/rate-limits
+from __future__ import annotations
+
+import logging
+import random
+import threading
+import time
+from collections.abc import Callable
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucketRateLimiter:
+    """Thread-safe limit on both requests per minute and tokens per minute.
+
+    Each limit is a token bucket that refills continuously, holding at most one minute's allowance.
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_requests = requests_per_minute
+        self.available_tokens = tokens_per_minute
+        self.last_refill_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed_minutes = (now - self.last_refill_time) / 60
+        self.last_refill_time = now
+        self.available_requests = min(
+            self.requests_per_minute,
+            self.available_requests + elapsed_minutes * self.requests_per_minute,
+        )
+        self.available_tokens = min(self.tokens_per_minute, self.available_tokens + elapsed_minutes * self.tokens_per_minute)
+
+    def acquire(self, n_tokens: int):
+        """Block until one request using n_tokens tokens is allowed."""
+        # a request larger than the bucket can never fit; let it through once the bucket is full
+        n_tokens = min(n_tokens, self.tokens_per_minute)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.available_requests >= 1 and self.available_tokens >= n_tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= n_tokens
+                    return
+                wait_s = 60 * max(
+                    (1 - self.available_requests) / self.requests_per_minute,
+                    (n_tokens - self.available_tokens) / self.tokens_per_minute,
+                )
+            time.sleep(wait_s)
+
+
+def call_with_retries(
+    func: Callable,
+    retryable_errors: tuple[type[Exception], ...],
+    max_retries: int = 5,
+    initial_backoff_s: float = 1.0,
+    max_backoff_s: float = 60.0,
+):
+    """Call func(), retrying on the given errors with jittered exponential backoff.
+
+    Args:
+        func (Callable): Function to call, without arguments.
+        retryable_errors (tuple[type[Exception], ...]): Exception types worth retrying, e.g. rate limit errors.
+        max_retries (int, optional): Retries after the first attempt before re-raising. Defaults to 5.
+        initial_backoff_s (float, optional): Mean wait before the first retry. Defaults to 1.0.
+        max_backoff_s (float, optional): Cap on the mean wait between retries. Defaults to 60.0.
+
+    Returns:
+        The result of func().
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return func()
+        except retryable_errors as ex:
+            if attempt == max_retries:
+                raise
+            backoff_s = min(max_backoff_s, initial_backoff_s * 2**attempt) * random.uniform(0.5, 1.5)
+            logger.warning(f"Retrying in {backoff_s:.1f}s after error: {ex}")
+            time.sleep(backoff_s)
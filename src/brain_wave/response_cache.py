@@ -0,0 +1,127 @@
+# Semantic cache of chat responses
+# Serves a stored answer when a new question's embedding is close enough to a previously answered question's.
+from __future__ import annotations
+
+import collections
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_SIMILARITY_THRESHOLD = 0.95
+DEFAULT_MAX_ENTRIES = 4096
+DEFAULT_TTL_S = 7 * 24 * 60 * 60
+
+
+class ResponseCacheEntry:
+    def __init__(self, query: str, query_embedding: np.array, response: dict[str, str]):
+        self.query = query
+        self.query_embedding = query_embedding
+        self.response = response
+        self.created_time = time.time()
+        self.hit_count = 0
+
+
+class SemanticResponseCache:
+    """Thread-safe nearest-neighbour cache from query embeddings to responses.
+
+    Entries are grouped by namespace, e.g. the prompt and retrieval settings used to generate the response,
+    and a lookup only matches entries from the same namespace.
+    Entries expire after ttl_s seconds; beyond max_entries, the least recently used entries are evicted.
+    """
+
+    def __init__(
+        self,
+        similarity_threshold: float = DEFAULT_SIMILARITY_THRESHOLD,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl_s: float = DEFAULT_TTL_S,
+    ):
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.lock = threading.Lock()
+        self.next_entry_id = 0
+        # entry id -> (namespace, entry), in least to most recently used order
+        self.entries: collections.OrderedDict[int, tuple[str, ResponseCacheEntry]] = collections.OrderedDict()
+        # per namespace: entry ids and their stacked query embeddings, rebuilt lazily after changes
+        self.namespace_entry_ids: dict[str, list[int]] = {}
+        self.namespace_embedding_mats: dict[str, np.array] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, query_embedding: np.array, namespace: str = "") -> ResponseCacheEntry | None:
+        """The entry whose query is most similar to the given one, if it is above the similarity threshold.
+
+        Args:
+            query_embedding (np.array): Query embedding; need not be normalized.
+            namespace (str, optional): Only entries put with this namespace can match. Defaults to "".
+
+        Returns:
+            ResponseCacheEntry | None: The matching entry, with its hit count incremented, or None.
+        """
+        query_embedding = normalize_embedding(query_embedding)
+        with self.lock:
+            self._remove_expired()
+            entry_ids = self.namespace_entry_ids.get(namespace, [])
+            if len(entry_ids) == 0:
+                self.misses += 1
+                return None
+            if namespace not in self.namespace_embedding_mats:
+                self.namespace_embedding_mats[namespace] = np.stack(
+                    [self.entries[entry_id][1].query_embedding for entry_id in entry_ids]
+                )
+            similarities = self.namespace_embedding_mats[namespace] @ query_embedding
+            best_ind = int(np.argmax(similarities))
+            if similarities[best_ind] < self.similarity_threshold:
+                self.misses += 1
+                return None
+            entry_id = entry_ids[best_ind]
+            self.entries.move_to_end(entry_id)
+            entry = self.entries[entry_id][1]
+            entry.hit_count += 1
+            self.hits += 1
+            return entry
+
+    def put(self, query: str, query_embedding: np.array, response: dict[str, str], namespace: str = ""):
+        entry = ResponseCacheEntry(query, normalize_embedding(query_embedding), response)
+        with self.lock:
+            entry_id = self.next_entry_id
+            self.next_entry_id += 1
+            self.entries[entry_id] = (namespace, entry)
+            self.namespace_entry_ids.setdefault(namespace, []).append(entry_id)
+            self.namespace_embedding_mats.pop(namespace, None)
+            while len(self.entries) > self.max_entries:
+                self._remove_entry(next(iter(self.entries)))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.namespace_entry_ids.clear()
+            self.namespace_embedding_mats.clear()
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+        }
+
+    def _remove_expired(self):
+        expiry_time = time.time() - self.ttl_s
+        expired_entry_ids = [
+            entry_id for entry_id, (_, entry) in self.entries.items() if entry.created_time < expiry_time
+        ]
+        for entry_id in expired_entry_ids:
+            self._remove_entry(entry_id)
+
+    def _remove_entry(self, entry_id: int):
+        namespace, _ = self.entries.pop(entry_id)
+        self.namespace_entry_ids[namespace].remove(entry_id)
+        if len(self.namespace_entry_ids[namespace]) == 0:
+            del self.namespace_entry_ids[namespace]
+        self.namespace_embedding_mats.pop(namespace, None)
+
+
+def normalize_embedding(embedding: np.array) -> np.array:
+    embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+    return embedding / max(np.linalg.norm(embedding), 1e-12)
@@ -1,13 +1,33 @@
 from __future__ import annotations
 
+import asyncio
 import collections.abc
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
-import scipy
 
-from brain_wave import embedding_utils
+from brain_wave import ann_index, cache_utils, embedding_utils, lexical, quantization, tracing
+
+# number of candidates initially selected when iterating over ranked search results
+INITIAL_SEARCH_K = 32
+# reciprocal-rank fusion constant and number of top candidates fused from each ranking
+# see: https://plg.uwaterloo.ca/~gvcormac/cormacksigir09-rrf.pdf
+RRF_K = 60
+RRF_N_CANDIDATES = 100
+# gap between the furthest re-scored distance and the closest approximate one from quantized embeddings
+APPROXIMATE_DISTANCE_MARGIN = 1e-3
+# rows checked for unit norm before memory-mapping saved float32 embeddings as-is
+NORM_CHECK_SAMPLE_ROWS = 1024
+
+logger = logging.getLogger(__name__)
 
 
 class RetrievalDb:
@@ -27,6 +47,22 @@ class RetrievalDb:
         # `load()` is called during construction if df is not provided
         assert "text_col" in retrieval_db.df.columns
     ```
+
+    Pass `mmap=True` to memory-map the saved embeddings read-only instead of reading them into private memory;
+    every process that loads the same db then shares one physical copy via the OS page cache.
+
+    For large dbs, `build_ann_index()` builds and saves an approximate nearest-neighbour index that is used
+    by `compute_embedding_distances()` and `search()` whenever it is present.
+
+    After `quantize_embeddings()`, pass `quantized=True` to score queries against int8 codes held in memory;
+    only the best `rescore_k` candidates are re-scored against the (memory-mapped) full-precision embeddings.
+
+    `save_df()` also saves a BM25 index over `embed_col`, for lexical and hybrid retrieval (see `compute_lexical_scores`).
+
+    `upsert()` and `delete()` update the db incrementally, embedding only rows whose text changed.
+    Changes are saved as delta segments that are applied on `load()`, until `compact()` merges them.
+
+    `embedding_mat` is stored unit-normalized as float32, so cosine distances are a single matrix-vector product.
     """
 
     def __init__(
@@ -36,80 +72,773 @@ class RetrievalDb:
         embed_col: str,
         df: pd.DataFrame | None = None,
         n_tokens_col: str = "n_tokens",
+        content_hash_col: str = "content_hash",
+        mmap: bool = False,
+        quantized: bool = False,
+        rescore_k: int = quantization.DEFAULT_RESCORE_K,
     ):
         self.embedding_dir = embedding_dir
         self.db_name = db_name
 
         self.df_filepath = self.embedding_dir / f"{self.db_name}_df.parquet"
         self.embedding_filepath = self.embedding_dir / f"{self.db_name}_embed.npy"
+        self.ann_index_filepath = self.embedding_dir / f"{self.db_name}_ivf.npz"
+        self.ann_index: ann_index.IvfIndex | None = None
+        self.quantized_filepath = self.embedding_dir / f"{self.db_name}_embed_int8.npz"
+        self.quantized_embeddings: quantization.ScalarQuantizedEmbeddings | None = None
+        self.rescore_k = rescore_k
+        self.lexical_index_filepath = self.embedding_dir / f"{self.db_name}_bm25.npz"
+        self.lexical_index: lexical.Bm25Index | None = None
+        self.delta_dir = self.embedding_dir / f"{self.db_name}_deltas"
+        self.content_hash_col = content_hash_col
+        # serializes upserts, deletes and compaction
+        self.update_lock = threading.Lock()
 
         self.embed_col = embed_col
+        self.n_tokens_col = n_tokens_col
         if df is None:
-            self.load()
+            # full-precision embeddings are only touched for re-scoring, so they needn't be resident
+            self.load(mmap=mmap or quantized, quantized=quantized)
         else:
             self.df = df
             self.normalize_strings()
         assert self.embed_col in self.df.columns
 
-        self.n_tokens_col = n_tokens_col
         if n_tokens_col not in self.df.columns:
             self.compute_token_counts()
+        self.cache_columns()
 
     def normalize_strings(self):
         self.df[self.embed_col] = self.df[self.embed_col].map(normalize_text)
 
     def compute_token_counts(self):
-        token_counts = embedding_utils.get_token_counts(self.df[self.embed_col])
+        token_counts = embedding_utils.get_token_counts(self.df[self.embed_col], use_cache=False)
         self.df[self.n_tokens_col] = token_counts
 
+    def cache_columns(self):
+        """Cache the text and token count columns as arrays, avoiding per-row pandas lookups during retrieval.
+
+        Must be called again if df is modified.
+        """
+        self.texts = self.df[self.embed_col].to_numpy(dtype=object)
+        self.token_counts = self.df[self.n_tokens_col].to_numpy(dtype=np.int64)
+        # no row fits in a smaller token budget
+        self.min_token_count = int(self.token_counts.min()) if len(self.token_counts) > 0 else 0
+        self.parent_group_indexes: dict[tuple, ParentGroupIndex] = {}
+        self.column_value_indexes: dict[str, dict[object, np.array]] = {}
+
+    def get_column_value_index(self, col: str) -> dict[object, np.array]:
+        """Map of each distinct value in the given df column to the sorted indices of the rows with that value. Cached."""
+        if col not in self.column_value_indexes:
+            if col not in self.df.columns:
+                raise ValueError(f"Can't filter on {col}; not a column in {self.db_name}.")
+            codes, values = pd.factorize(self.df[col])
+            # rows with missing values (code -1) sort first, and are excluded from every value
+            member_order = np.argsort(codes, kind="stable")
+            offsets = np.searchsorted(codes[member_order], np.arange(len(values) + 1))
+            self.column_value_indexes[col] = {
+                value: member_order[offsets[i] : offsets[i + 1]] for i, value in enumerate(values)
+            }
+        return self.column_value_indexes[col]
+
+    def get_filter_ids(self, filters: dict) -> np.array:
+        """Sorted indices of the rows matching the given filters.
+
+        Filters map a column name to a value, or to a list of values; rows must match any listed value in every column.
+        e.g. `{"chapter": [1, 2], "section": 3}` keeps rows in section 3 of chapter 1 or 2.
+
+        Args:
+            filters (dict): Map of column name -> value or list of values.
+
+        Returns:
+            np.array: Row indices into df.
+        """
+        filter_ids = None
+        for col, values in filters.items():
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            value_index = self.get_column_value_index(col)
+            col_ids = [value_index[value] for value in values if value in value_index]
+            col_ids = np.sort(np.concatenate(col_ids)) if len(col_ids) > 0 else np.array([], dtype=np.int64)
+            filter_ids = col_ids if filter_ids is None else np.intersect1d(filter_ids, col_ids, assume_unique=True)
+        if filter_ids is None:
+            return np.arange(len(self.df))
+        return filter_ids
+
+    def get_parent_group_index(self, parent_group_cols: list[str], parent_sort_cols: list[str]) -> ParentGroupIndex:
+        """Cached `ParentGroupIndex` for the given grouping, shared by all DbInfos using this db."""
+        key = (tuple(parent_group_cols), tuple(parent_sort_cols))
+        if key not in self.parent_group_indexes:
+            self.parent_group_indexes[key] = ParentGroupIndex(self, parent_group_cols, parent_sort_cols)
+        return self.parent_group_indexes[key]
+
     def create_embeddings(self):
-        embedding_list = embedding_utils.batch_embed_texts(self.df[self.embed_col], self.df[self.n_tokens_col])
-        self.embedding_mat = np.concatenate([e.reshape(1, -1) for e in embedding_list], axis=0)
+        embedding_mat = embedding_utils.batch_embed_texts(self.df[self.embed_col], self.df[self.n_tokens_col])
+        self.embedding_mat = normalize_embedding_mat(embedding_mat)
         np.save(self.embedding_filepath, self.embedding_mat)
+        # any saved deltas were relative to the previous embeddings
+        shutil.rmtree(self.delta_dir, ignore_errors=True)
 
     def save_df(self):
+        # saved content hashes let later upserts skip re-embedding unchanged texts
+        self.get_content_hashes()
         self.df.to_parquet(self.df_filepath)
+        self.lexical_index = lexical.Bm25Index.build(self.df[self.embed_col])
+        self.lexical_index.save(self.lexical_index_filepath)
 
-    def load(self):
+    def load(self, mmap: bool = False, quantized: bool = False):
+        """Load the df and embeddings saved by `save_df()` and `create_embeddings()`.
+
+        Args:
+            mmap (bool, optional): If True, memory-map the embeddings read-only. Defaults to False.
+            quantized (bool, optional): If True, load the int8 codes saved by `quantize_embeddings()`. Defaults to False.
+        """
         if not self.df_filepath.exists():
             raise ValueError(f"Trying to load a dataframe from non-existent path: {self.df_filepath}")
         self.df = pd.read_parquet(self.df_filepath)
-        self.embedding_mat = np.load(self.embedding_filepath)
+        if mmap:
+            self.embedding_mat = self.load_mmap_embeddings()
+        else:
+            # older saved embeddings are un-normalized float64; normalize_embedding_mat handles both
+            embedding_mat = np.load(self.embedding_filepath)
+            check_saved_embedding_dtype(embedding_mat, self.embedding_filepath)
+            self.embedding_mat = normalize_embedding_mat(embedding_mat)
+        if len(self.embedding_mat) != len(self.df):
+            raise ValueError(
+                f"{self.embedding_filepath} has {len(self.embedding_mat)} rows, "
+                f"but {self.df_filepath} has {len(self.df)}; was compact() interrupted?",
+            )
+        if self.apply_delta_segments() > 0:
+            # saved indexes don't include the deltas, and will be rebuilt by compact()
+            if quantized:
+                logger.warning(f"Not using quantized embeddings for {self.db_name} until compact() is called.")
+            return
+        if self.ann_index_filepath.exists():
+            self.ann_index = ann_index.IvfIndex.load(self.ann_index_filepath)
+            if self.ann_index.n_rows != len(self.embedding_mat):
+                logger.warning(f"Ignoring out-of-date ANN index {self.ann_index_filepath}; rebuild with build_ann_index().")
+                self.ann_index = None
+        if quantized:
+            if not self.quantized_filepath.exists():
+                raise ValueError(f"No quantized embeddings at {self.quantized_filepath}; create with quantize_embeddings().")
+            self.quantized_embeddings = quantization.ScalarQuantizedEmbeddings.load(self.quantized_filepath)
+            if len(self.quantized_embeddings.codes) != len(self.embedding_mat):
+                logger.warning(f"Ignoring out-of-date quantized embeddings {self.quantized_filepath}.")
+                self.quantized_embeddings = None
+        if self.lexical_index_filepath.exists():
+            self.lexical_index = lexical.Bm25Index.load(self.lexical_index_filepath)
+            if self.lexical_index.n_docs != len(self.df):
+                logger.warning(f"Ignoring out-of-date lexical index {self.lexical_index_filepath}.")
+                self.lexical_index = None
 
-    def compute_embedding_distances(self, query_embedding: np.array) -> np.array:
-        if query_embedding.shape[0] != 1:
-            query_embedding = query_embedding.reshape(1, -1)
-        distances = scipy.spatial.distance.cdist(query_embedding, self.embedding_mat, metric="cosine")[0]
+    def get_lexical_index(self) -> lexical.Bm25Index:
+        """The BM25 index over `embed_col`, built (but not saved) if it wasn't saved with the df."""
+        if self.lexical_index is None:
+            self.lexical_index = lexical.Bm25Index.build(self.df[self.embed_col])
+        return self.lexical_index
+
+    def compute_lexical_scores(self, query_str: str, filters: dict | None = None) -> np.array:
+        """BM25 scores of every row for the given query. Needs no embedding API call.
+
+        Args:
+            query_str (str): Query.
+            filters (dict | None, optional): If provided, rows not matching these filters score 0. Defaults to None.
+
+        Returns:
+            np.array: Scores, one per row of the df; higher is more relevant, and 0 means no shared terms.
+        """
+        scores = self.get_lexical_index().compute_scores(normalize_text(query_str))
+        if filters is not None:
+            is_match = np.zeros(len(scores), dtype=bool)
+            is_match[self.get_filter_ids(filters)] = True
+            scores[~is_match] = 0
+        return scores
+
+    def upsert(self, rows: pd.DataFrame) -> int:
+        """Insert the given rows, replacing any existing rows with the same index labels.
+
+        Only rows whose text isn't already in the db are embedded. The change is saved as a delta segment.
+        The ANN index and quantized embeddings (if any) are dropped until the next `compact()`.
+
+        Args:
+            rows (pd.DataFrame): Rows to upsert, with an `embed_col` column. The df index identifies rows.
+
+        Returns:
+            int: Number of texts that were embedded.
+        """
+        rows = rows.copy()
+        rows[self.embed_col] = rows[self.embed_col].map(normalize_text)
+        rows[self.content_hash_col] = rows[self.embed_col].map(compute_content_hash)
+        rows[self.n_tokens_col] = embedding_utils.get_token_counts(rows[self.embed_col], use_cache=False)
+        with self.update_lock:
+            existing_hash_inds = {content_hash: i for i, content_hash in enumerate(self.get_content_hashes())}
+            # rows whose text isn't already in the db, deduplicated by content hash
+            is_new = ~rows[self.content_hash_col].isin(existing_hash_inds) & ~rows[self.content_hash_col].duplicated()
+            new_rows = rows[is_new]
+            new_hash_inds = {content_hash: i for i, content_hash in enumerate(new_rows[self.content_hash_col])}
+            if len(new_rows) > 0:
+                new_embedding_mat = normalize_embedding_mat(
+                    embedding_utils.batch_embed_texts(new_rows[self.embed_col], new_rows[self.n_tokens_col]),
+                )
+            embeddings = np.empty((len(rows), self.embedding_mat.shape[1]), dtype=np.float32)
+            for i, content_hash in enumerate(rows[self.content_hash_col]):
+                if content_hash in existing_hash_inds:
+                    embeddings[i] = self.embedding_mat[existing_hash_inds[content_hash]]
+                else:
+                    embeddings[i] = new_embedding_mat[new_hash_inds[content_hash]]
+            self.apply_upsert(rows, embeddings)
+            segment_prefix = self.get_next_delta_segment_prefix()
+            # the embeddings are written first, so a segment's df file only exists once the segment is complete
+            np.save(f"{segment_prefix}_embed.npy", embeddings)
+            rows.to_parquet(f"{segment_prefix}_df.parquet")
+        return len(new_hash_inds)
+
+    def delete(self, ids: list) -> int:
+        """Delete the rows with the given index labels, saving the change as a delta segment.
+
+        Args:
+            ids (list): df index labels to delete.
+
+        Returns:
+            int: Number of rows deleted.
+        """
+        with self.update_lock:
+            n_rows = len(self.df)
+            self.apply_delete(ids)
+            with open(f"{self.get_next_delta_segment_prefix()}_deleted.json", "w") as outfile:
+                json.dump(pd.Index(ids).tolist(), outfile)
+        return n_rows - len(self.df)
+
+    def compact(self, background: bool = False) -> threading.Thread | None:
+        """Rewrite the saved df and embeddings to include all delta segments, then remove the segments.
+
+        Saved ANN indexes (with their saved settings) and quantized embeddings are rebuilt.
+        The df and embeddings are written to temporary paths and only renamed once everything else is saved,
+        with the df last, so a failed compaction leaves the saved db and delta segments loadable as they were.
+
+        Args:
+            background (bool, optional): If True, compact in a new thread, which is returned. Defaults to False.
+
+        Returns:
+            threading.Thread | None: The compaction thread, if background.
+        """
+        if background:
+            thread = threading.Thread(target=self.compact, name=f"compact-{self.db_name}")
+            thread.start()
+            return thread
+        with self.update_lock:
+            self.get_content_hashes()
+            embedding_tmp_filepath = get_tmp_filepath(self.embedding_filepath)
+            df_tmp_filepath = get_tmp_filepath(self.df_filepath)
+            try:
+                np.save(embedding_tmp_filepath, np.asarray(self.embedding_mat))
+                self.df.to_parquet(df_tmp_filepath)
+                # indexes are ignored on load while delta segments remain, so they can be replaced first
+                if self.ann_index_filepath.exists():
+                    saved_ann_index = ann_index.IvfIndex.load(self.ann_index_filepath)
+                    self.build_ann_index(n_lists=saved_ann_index.n_lists, n_probe=saved_ann_index.n_probe)
+                if self.quantized_filepath.exists():
+                    self.quantize_embeddings()
+                self.lexical_index = lexical.Bm25Index.build(self.df[self.embed_col])
+                self.lexical_index.save(self.lexical_index_filepath)
+                os.replace(embedding_tmp_filepath, self.embedding_filepath)
+                os.replace(df_tmp_filepath, self.df_filepath)
+            finally:
+                embedding_tmp_filepath.unlink(missing_ok=True)
+                df_tmp_filepath.unlink(missing_ok=True)
+            shutil.rmtree(self.delta_dir, ignore_errors=True)
+        return None
+
+    def get_content_hashes(self) -> pd.Series:
+        """Hash of each row's text, used to identify rows that don't need to be re-embedded."""
+        if self.content_hash_col not in self.df.columns or self.df[self.content_hash_col].isna().any():
+            self.df[self.content_hash_col] = self.df[self.embed_col].map(compute_content_hash)
+        return self.df[self.content_hash_col]
+
+    def apply_upsert(self, rows: pd.DataFrame, embeddings: np.array):
+        is_kept = ~self.df.index.isin(rows.index)
+        self.df = pd.concat([self.df[is_kept], rows])
+        self.embedding_mat = np.concatenate([self.embedding_mat[is_kept], embeddings])
+        self.invalidate_indexes()
+
+    def apply_delete(self, ids: list):
+        is_kept = ~self.df.index.isin(ids)
+        self.df = self.df[is_kept]
+        self.embedding_mat = self.embedding_mat[is_kept]
+        self.invalidate_indexes()
+
+    def invalidate_indexes(self):
+        """Drop indexes built over the previous rows; the lexical index is rebuilt on demand."""
+        self.ann_index = None
+        self.quantized_embeddings = None
+        self.lexical_index = None
+        if self.n_tokens_col in self.df.columns:
+            self.cache_columns()
+
+    def apply_delta_segments(self) -> int:
+        """Apply the delta segments saved by `upsert()` and `delete()`, in order.
+
+        Returns:
+            int: Number of segments applied.
+        """
+        if not self.delta_dir.exists():
+            return 0
+        segment_prefixes = sorted({filepath.name.split("_")[0] for filepath in self.delta_dir.iterdir()})
+        for segment_prefix in segment_prefixes:
+            deleted_filepath = self.delta_dir / f"{segment_prefix}_deleted.json"
+            df_filepath = self.delta_dir / f"{segment_prefix}_df.parquet"
+            if deleted_filepath.exists():
+                with open(deleted_filepath) as infile:
+                    self.apply_delete(json.load(infile))
+            elif df_filepath.exists():
+                embeddings = np.load(self.delta_dir / f"{segment_prefix}_embed.npy")
+                self.apply_upsert(pd.read_parquet(df_filepath), embeddings)
+        logger.info(f"Applied {len(segment_prefixes)} delta segments to {self.db_name}.")
+        return len(segment_prefixes)
+
+    def get_next_delta_segment_prefix(self) -> Path:
+        self.delta_dir.mkdir(exist_ok=True)
+        segment_numbers = [int(filepath.name.split("_")[0]) for filepath in self.delta_dir.iterdir()]
+        return self.delta_dir / f"{max(segment_numbers, default=-1) + 1:06d}"
+
+    def quantize_embeddings(self):
+        """Quantize `embedding_mat` to int8, saving the codes next to the full-precision embeddings."""
+        self.quantized_embeddings = quantization.ScalarQuantizedEmbeddings.from_embedding_mat(self.embedding_mat)
+        self.quantized_embeddings.save(self.quantized_filepath)
+
+    def build_ann_index(
+        self,
+        n_lists: int | None = None,
+        n_probe: int = ann_index.DEFAULT_N_PROBE,
+        min_rows: int = ann_index.MIN_ROWS_FOR_ANN,
+    ):
+        """Build and save an approximate nearest-neighbour index over `embedding_mat`.
+
+        Dbs with fewer than min_rows rows keep using exact search, and any stale saved index is removed.
+
+        Args:
+            n_lists (int | None, optional): Number of IVF clusters. Defaults to None, meaning 4 * sqrt(n).
+            n_probe (int, optional): Clusters scored per query; higher is slower with better recall. Defaults to ann_index.DEFAULT_N_PROBE.
+            min_rows (int, optional): Smallest db for which an index is built. Defaults to ann_index.MIN_ROWS_FOR_ANN.
+        """
+        if len(self.embedding_mat) < min_rows:
+            logger.info(f"Not building an ANN index for {self.db_name}; {len(self.embedding_mat)} rows < {min_rows}.")
+            self.ann_index = None
+            self.ann_index_filepath.unlink(missing_ok=True)
+            return
+        self.ann_index = ann_index.IvfIndex.build(self.embedding_mat, n_lists=n_lists, n_probe=n_probe)
+        self.ann_index.save(self.ann_index_filepath)
+
+    def load_mmap_embeddings(self) -> np.array:
+        """Memory-map the saved embeddings, read-only.
+
+        Embeddings saved by `create_embeddings()` are already normalized float32 and are mapped as-is,
+        after checking the norms of a sample of rows. Older float64 files, and float32 files that aren't normalized,
+        are left untouched: a normalized float32 copy is written once to the cache dir
+        (see `get_converted_embedding_filepath`), and that copy is mapped instead.
+
+        Raises:
+            ValueError: If the saved embeddings are neither float32 nor float64.
+
+        Returns:
+            np.array: Read-only, memory-mapped embedding matrix.
+        """
+        embedding_mat = np.load(self.embedding_filepath, mmap_mode="r")
+        check_saved_embedding_dtype(embedding_mat, self.embedding_filepath)
+        if embedding_mat.dtype == np.float32 and is_sample_normalized(embedding_mat):
+            return embedding_mat
+        converted_filepath = self.get_converted_embedding_filepath()
+        if converted_filepath.exists():
+            return np.load(converted_filepath, mmap_mode="r")
+        normalized_embedding_mat = normalize_embedding_mat(embedding_mat)
+        # write to a temporary file and rename, so concurrent loaders never see a partial file
+        tmp_filepath = get_tmp_filepath(converted_filepath)
+        try:
+            converted_filepath.parent.mkdir(parents=True, exist_ok=True)
+            np.save(tmp_filepath, normalized_embedding_mat)
+            os.replace(tmp_filepath, converted_filepath)
+        except OSError as ex:
+            logger.warning(f"Failed to cache float32 embeddings for {self.db_name}, so they can't be memory-mapped: {ex}")
+            tmp_filepath.unlink(missing_ok=True)
+            return normalized_embedding_mat
+        logger.info(f"Cached normalized float32 embeddings for {self.embedding_filepath} at {converted_filepath}.")
+        return np.load(converted_filepath, mmap_mode="r")
+
+    def get_converted_embedding_filepath(self) -> Path:
+        """Where `load_mmap_embeddings` caches a normalized float32 copy of the saved embeddings.
+
+        The name depends on the saved file's path, size and modification time, so a changed file gets a new copy.
+        """
+        file_stat = self.embedding_filepath.stat()
+        key = cache_utils.hash_key(
+            str(self.embedding_filepath.resolve()),
+            str(file_stat.st_size),
+            str(file_stat.st_mtime_ns),
+        )
+        return cache_utils.get_default_cache_dir() / "embeddings" / f"{self.db_name}_{key[:16]}_embed.npy"
+
+    def compute_embedding_distances(
+        self,
+        query_embedding: np.array,
+        exact: bool = False,
+        filters: dict | None = None,
+    ) -> np.array:
+        """Cosine distances from the query to every row of `embedding_mat`.
+
+        If an ANN index is loaded, only rows in the probed clusters are scored; all other rows get a distance of inf.
+        If quantized embeddings are loaded, rows are scored approximately from the int8 codes,
+        and only the `rescore_k` closest rows get exact distances. The other rows keep their approximate order,
+        but are shifted to rank behind every re-scored row, so their distances can exceed 2.
+
+        Args:
+            query_embedding (np.array): Query embedding, of shape (EMBEDDING_DIM,) or (1, EMBEDDING_DIM).
+            exact (bool, optional): If True, exactly score every row, ignoring any ANN index or quantization. Defaults to False.
+            filters (dict | None, optional): If provided, only rows matching these filters are scored;
+                all other rows get a distance of inf. See `get_filter_ids`. Defaults to None.
+
+        Returns:
+            np.array: Distances, in the range [0, 2] (or inf, or shifted as above), one per row of the df.
+        """
+        query_embedding = normalize_embedding_mat(query_embedding.reshape(1, -1))[0]
+        # None means every row is a candidate
+        candidate_ids = None if filters is None else self.get_filter_ids(filters)
+        # a selective filter makes exact scoring of the matching rows cheaper than probing the ANN index
+        use_ann_index = candidate_ids is None or len(candidate_ids) >= ann_index.MIN_ROWS_FOR_ANN
+        if not exact and self.ann_index is not None and use_ann_index:
+            # sorted ids read embedding_mat sequentially, which matters when it is memory-mapped
+            ann_ids = np.sort(self.ann_index.get_candidate_ids(query_embedding))
+            if candidate_ids is None:
+                candidate_ids = ann_ids
+            else:
+                candidate_ids = np.intersect1d(candidate_ids, ann_ids, assume_unique=True)
+        use_quantized = not exact and self.quantized_embeddings is not None
+        if candidate_ids is None:
+            if not use_quantized:
+                return 1 - self.embedding_mat @ query_embedding
+            distances = 1 - self.quantized_embeddings.compute_similarities(query_embedding)
+        else:
+            distances = np.full(len(self.embedding_mat), np.inf, dtype=np.float32)
+            if not use_quantized:
+                distances[candidate_ids] = 1 - self.embedding_mat[candidate_ids] @ query_embedding
+                return distances
+            distances[candidate_ids] = 1 - self.quantized_embeddings.compute_similarities(query_embedding, candidate_ids)
+        rescore_ids = get_top_k_indices(distances, self.rescore_k)
+        rescore_ids = np.sort(rescore_ids[np.isfinite(distances[rescore_ids])])
+        distances[rescore_ids] = 1 - self.embedding_mat[rescore_ids] @ query_embedding
+        is_approximate = np.isfinite(distances)
+        is_approximate[rescore_ids] = False
+        if len(rescore_ids) > 0 and is_approximate.any():
+            # approximate distances aren't comparable with exact ones, so rank them all behind the exact ones
+            shift = distances[rescore_ids].max() - distances[is_approximate].min() + APPROXIMATE_DISTANCE_MARGIN
+            if shift > 0:
+                distances[is_approximate] += shift
         return distances
 
-    def compute_string_distances(self, query_str: str) -> np.array:
-        embedding_list = embedding_utils.get_openai_embeddings([normalize_text(query_str)])
-        query_embedding = embedding_list[0]
-        return self.compute_embedding_distances(query_embedding)
+    def compute_string_distances(self, query_str: str, filters: dict | None = None) -> np.array:
+        with tracing.span("compute_string_distances", db_name=self.db_name):
+            query_embedding = embed_query(query_str)
+            with tracing.span("compute_embedding_distances", db_name=self.db_name):
+                return self.compute_embedding_distances(query_embedding, filters=filters)
+
+    async def acompute_string_distances(self, query_str: str, filters: dict | None = None) -> np.array:
+        """Async version of `compute_string_distances`; scoring runs in a worker thread to keep the event loop free."""
+        with tracing.span("compute_string_distances", db_name=self.db_name):
+            query_embedding = await aembed_query(query_str)
+            with tracing.span("compute_embedding_distances", db_name=self.db_name):
+                return await asyncio.to_thread(self.compute_embedding_distances, query_embedding, filters=filters)
+
+    def compute_embedding_distances_batch(
+        self,
+        query_embedding_mat: np.array,
+        exact: bool = False,
+        filters: dict | None = None,
+    ) -> np.array:
+        """Cosine distances from each of several queries to every row of `embedding_mat`.
+
+        Without an ANN index or quantized embeddings (or if exact), this is a single matrix product.
+
+        Args:
+            query_embedding_mat (np.array): Query embeddings, of shape (n_queries, EMBEDDING_DIM).
+            exact (bool, optional): See `compute_embedding_distances`. Defaults to False.
+            filters (dict | None, optional): See `compute_embedding_distances`. Defaults to None.
+
+        Returns:
+            np.array: Distances, of shape (n_queries, len(df)).
+        """
+        if not exact and (self.ann_index is not None or self.quantized_embeddings is not None):
+            return np.stack([self.compute_embedding_distances(q, filters=filters) for q in query_embedding_mat])
+        query_embedding_mat = normalize_embedding_mat(query_embedding_mat)
+        if filters is None:
+            return 1 - query_embedding_mat @ self.embedding_mat.T
+        candidate_ids = self.get_filter_ids(filters)
+        distances = np.full((len(query_embedding_mat), len(self.embedding_mat)), np.inf, dtype=np.float32)
+        distances[:, candidate_ids] = 1 - query_embedding_mat @ self.embedding_mat[candidate_ids].T
+        return distances
+
+    def compute_string_distances_batch(self, query_strs: list[str], filters: dict | None = None) -> np.array:
+        """Embed the given query strings in as few API requests as possible, then compute distances for all of them.
+
+        Returns:
+            np.array: Distances, of shape (len(query_strs), len(df)).
+        """
+        return self.compute_embedding_distances_batch(embed_queries(query_strs), filters=filters)
 
     def iterate_query_embeddings(
         self,
         query_embedding_list: collections.abc.Iterable[np.array],
+        batch_size: int = 256,
     ) -> collections.abc.Generator[np.array]:
+        batch = []
         for query_embedding in query_embedding_list:
-            yield self.compute_embedding_distances(query_embedding)
+            batch.append(query_embedding.reshape(-1))
+            if len(batch) == batch_size:
+                yield from self.compute_embedding_distances_batch(np.stack(batch))
+                batch = []
+        if len(batch) > 0:
+            yield from self.compute_embedding_distances_batch(np.stack(batch))
+
+    def search(
+        self,
+        query: str | np.array,
+        k: int = 5,
+        max_distance: float | None = None,
+        filters: dict | None = None,
+    ) -> tuple[np.array, np.array]:
+        """Identify the k rows closest to the given query.
+
+        Only the k best candidates are sorted, so cost is O(n + k log k) rather than O(n log n).
+
+        Args:
+            query (str | np.array): Query string (which will be embedded) or a query embedding.
+            k (int, optional): Maximum number of results. Defaults to 5.
+            max_distance (float | None, optional): If provided, results further than this are dropped. Defaults to None.
+            filters (dict | None, optional): If provided, only rows matching these filters are returned.
+                See `get_filter_ids`. Defaults to None.
+
+        Returns:
+            tuple[np.array, np.array]: Row indices into df and their distances, closest first.
+        """
+        if isinstance(query, str):
+            distances = self.compute_string_distances(query, filters=filters)
+        else:
+            distances = self.compute_embedding_distances(query, filters=filters)
+        return self.search_distances(distances, k, max_distance)
+
+    def search_distances(
+        self,
+        distances: np.array,
+        k: int = 5,
+        max_distance: float | None = None,
+    ) -> tuple[np.array, np.array]:
+        """Like `search`, but given already-computed distances, e.g. from `compute_federated_distances`.
+
+        Returns:
+            tuple[np.array, np.array]: Row indices into df and their distances, closest first.
+        """
+        top_k_indices = get_top_k_indices(distances, k)
+        top_k_distances = distances[top_k_indices]
+        # rows not scored (due to the ANN index or filters) have infinite distance
+        is_close = np.isfinite(top_k_distances)
+        if max_distance is not None:
+            is_close &= top_k_distances <= max_distance
+        return top_k_indices[is_close], top_k_distances[is_close]
 
     def get_top_df(self, distances: np.array, k: int = 5) -> pd.DataFrame:
-        sort_inds = np.argsort(distances)
-        top_k_indices = sort_inds[:k]
-        top_k_scores = distances[top_k_indices]
-        assert top_k_indices.shape == top_k_scores.shape
+        top_k_indices = get_top_k_indices(distances, k)
         return self.df.iloc[top_k_indices]
 
 
-def get_distance_sort_indices(distances: np.array) -> np.array:
-    return np.argsort(distances)
+def get_top_k_indices(distances: np.array, k: int) -> np.array:
+    """Indices of the k smallest distances, sorted by distance.
+
+    Uses `np.argpartition` so that only the selected k candidates are sorted.
+
+    Args:
+        distances (np.array): Distances, e.g. as returned by `RetrievalDb.compute_embedding_distances`.
+        k (int): Number of indices to return. If k >= len(distances), all indices are returned.
+
+    Returns:
+        np.array: Up to k indices into distances.
+    """
+    if k <= 0:
+        return np.array([], dtype=int)
+    if k >= len(distances):
+        return np.argsort(distances)
+    candidate_inds = np.argpartition(distances, k - 1)[:k]
+    return candidate_inds[np.argsort(distances[candidate_inds])]
+
+
+def convert_scores_to_distances(scores: np.array) -> np.array:
+    """Negate relevance scores (e.g. from `RetrievalDb.compute_lexical_scores`) so they rank like distances.
+
+    Rows with a score of 0 get a distance of inf, so they are never retrieved.
+    """
+    return np.where(scores > 0, -scores, np.inf).astype(np.float32)
+
+
+def fuse_distances(distances_list: list[np.array], k: int = RRF_K, n_candidates: int = RRF_N_CANDIDATES) -> np.array:
+    """Combine several rankings of the same rows with reciprocal-rank fusion.
+
+    Each row scores the sum of 1 / (k + rank) over the rankings where it is in the top n_candidates.
+
+    Args:
+        distances_list (list[np.array]): Distances (or distance-like values, smaller is better) from each ranking.
+        k (int, optional): RRF constant; larger values flatten the difference between top ranks. Defaults to RRF_K.
+        n_candidates (int, optional): Number of top rows taken from each ranking. Defaults to RRF_N_CANDIDATES.
+
+    Returns:
+        np.array: Fused distance-like values; rows outside every ranking's top n_candidates get inf.
+    """
+    fused_scores = np.zeros(len(distances_list[0]), dtype=np.float32)
+    for distances in distances_list:
+        top_inds = get_top_k_indices(distances, n_candidates)
+        top_inds = top_inds[np.isfinite(distances[top_inds])]
+        fused_scores[top_inds] += 1 / (k + np.arange(1, len(top_inds) + 1))
+    return convert_scores_to_distances(fused_scores)
 
 
 def normalize_text(text: str) -> str:
     return text.replace("\n", " ").strip()
 
 
+def compute_content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def embed_queries(query_strs: list[str]) -> np.array:
+    """Embed the given query strings, batching as many as fit in each API request.
+
+    Args:
+        query_strs (list[str]): Queries to embed.
+
+    Returns:
+        np.array: Query embeddings, of shape (len(query_strs), EMBEDDING_DIM).
+    """
+    texts = [normalize_text(query_str) for query_str in query_strs]
+    return embedding_utils.batch_embed_texts(texts, embedding_utils.get_token_counts(texts))
+
+
+def embed_query(query_str: str) -> np.array:
+    with tracing.span("embed_query"):
+        return embedding_utils.get_openai_embeddings([normalize_text(query_str)])[0]
+
+
+async def aembed_query(query_str: str) -> np.array:
+    with tracing.span("embed_query"):
+        return (await embedding_utils.aget_openai_embeddings([normalize_text(query_str)]))[0]
+
+
+def compute_federated_distances(query_embedding: np.array, db_infos: list[DbInfo]) -> list[np.array]:
+    """Distances from one query embedding to the rows of each DbInfo's db, respecting each DbInfo's filters.
+
+    DbInfos sharing a db and filters are scored once. Distinct dbs are scored in parallel threads,
+    as numpy releases the GIL during the matrix products.
+
+    Args:
+        query_embedding (np.array): Query embedding, e.g. from `embed_query`.
+        db_infos (list[DbInfo]): DbInfos to score.
+
+    Returns:
+        list[np.array]: Distances for each of the db_infos; see `RetrievalDb.compute_embedding_distances`.
+    """
+    unique_db_infos = {db_info.get_distances_key(): db_info for db_info in db_infos}
+    with tracing.span("compute_embedding_distances", n_dbs=len(unique_db_infos)):
+        if len(unique_db_infos) <= 1:
+            distances_by_key = {
+                key: db_info.compute_embedding_distances(query_embedding) for key, db_info in unique_db_infos.items()
+            }
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(unique_db_infos)) as executor:
+                futures = {
+                    key: executor.submit(db_info.compute_embedding_distances, query_embedding)
+                    for key, db_info in unique_db_infos.items()
+                }
+                distances_by_key = {key: future.result() for key, future in futures.items()}
+    return [distances_by_key[db_info.get_distances_key()] for db_info in db_infos]
+
+
+async def acompute_federated_distances(query_embedding: np.array, db_infos: list[DbInfo]) -> list[np.array]:
+    """Async version of `compute_federated_distances`."""
+    unique_db_infos = {db_info.get_distances_key(): db_info for db_info in db_infos}
+    with tracing.span("compute_embedding_distances", n_dbs=len(unique_db_infos)):
+        distances_list = await asyncio.gather(
+            *[
+                asyncio.to_thread(db_info.compute_embedding_distances, query_embedding)
+                for db_info in unique_db_infos.values()
+            ]
+        )
+    distances_by_key = dict(zip(unique_db_infos.keys(), distances_list))
+    return [distances_by_key[db_info.get_distances_key()] for db_info in db_infos]
+
+
+def get_tmp_filepath(filepath: Path) -> Path:
+    """A per-process temporary path next to filepath, with the same suffix, for writing a file before renaming it."""
+    return filepath.with_name(f"{filepath.stem}.{os.getpid()}.tmp{filepath.suffix}")
+
+
+def check_saved_embedding_dtype(embedding_mat: np.array, embedding_filepath: Path):
+    if embedding_mat.dtype not in [np.float32, np.float64]:
+        raise ValueError(f"Expected float32 or float64 embeddings in {embedding_filepath}, not {embedding_mat.dtype}.")
+
+
+def is_sample_normalized(embedding_mat: np.array, n_sample_rows: int = NORM_CHECK_SAMPLE_ROWS) -> bool:
+    """Whether evenly spaced sample rows are unit-length (or all-zero), as `normalize_embedding_mat` leaves them."""
+    sample_inds = np.unique(np.linspace(0, len(embedding_mat) - 1, min(len(embedding_mat), n_sample_rows)).astype(int))
+    norms = np.linalg.norm(np.asarray(embedding_mat[sample_inds], dtype=np.float32), axis=1)
+    return bool(np.all(np.isclose(norms, 1, atol=1e-4) | (norms == 0)))
+
+
+def normalize_embedding_mat(embedding_mat: np.array) -> np.array:
+    """Convert the given (n, EMBEDDING_DIM) matrix to float32 with unit-length rows.
+
+    Already-normalized float32 input is returned without copying.
+
+    Args:
+        embedding_mat (np.array): Embeddings, one per row.
+
+    Returns:
+        np.array: float32 matrix in which each (non-zero) row has L2 norm 1.
+    """
+    embedding_mat = np.asarray(embedding_mat, dtype=np.float32)
+    norms = np.linalg.norm(embedding_mat, axis=1, keepdims=True)
+    if np.allclose(norms, 1, atol=1e-4):
+        return embedding_mat
+    # all-zero rows are left as zeros, giving a cosine distance of 1
+    norms[norms == 0] = 1
+    return embedding_mat / norms
+
+
+class ParentGroupIndex:
+    """Precomputed parent groups for a RetrievalDb, used by `DbInfo.get_parent_text`.
+
+    Rows are grouped by equal values in parent_group_cols (all rows form one group if there are none),
+    and ordered within each group by parent_sort_cols.
+    The members of a row's group are `member_order[start:end]`, where (start, end) is given by `get_group_bounds`,
+    and the tokens in `member_order[i:j]` sum to `token_prefix_sums[j] - token_prefix_sums[i]`.
+    """
+
+    def __init__(self, db: RetrievalDb, parent_group_cols: list[str], parent_sort_cols: list[str]):
+        n_rows = len(db.df)
+        if len(parent_group_cols) > 0:
+            self.group_ids = db.df.groupby(parent_group_cols, sort=False, dropna=False).ngroup().to_numpy()
+        else:
+            self.group_ids = np.zeros(n_rows, dtype=np.int64)
+        order_df = pd.DataFrame({"_group_id": self.group_ids})
+        for col in parent_sort_cols:
+            order_df[col] = db.df[col].to_numpy()
+        self.member_order = order_df.sort_values(by=["_group_id", *parent_sort_cols], kind="stable").index.to_numpy()
+        self.member_positions = np.empty(n_rows, dtype=np.int64)
+        self.member_positions[self.member_order] = np.arange(n_rows)
+        self.group_offsets = np.zeros(self.group_ids.max(initial=-1) + 2, dtype=np.int64)
+        self.group_offsets[1:] = np.cumsum(np.bincount(self.group_ids))
+        self.token_prefix_sums = np.zeros(n_rows + 1, dtype=np.int64)
+        self.token_prefix_sums[1:] = np.cumsum(db.token_counts[self.member_order])
+
+    def get_group_bounds(self, ind: int) -> tuple[int, int]:
+        group_id = self.group_ids[ind]
+        return self.group_offsets[group_id], self.group_offsets[group_id + 1]
+
+
 class DbInfo:
     """Wrapper class with info about how retrieved texts should be incorporated in a prompt.
 
@@ -127,6 +856,7 @@ class DbInfo:
         use_parent_text: bool = False,
         parent_group_cols: list[str] = [],
         parent_sort_cols: list[str] = [],
+        filters: dict | None = None,
     ):
         self.db = db
         self.max_tokens = max_tokens
@@ -141,107 +871,53 @@ class DbInfo:
         self.parent_group_cols = parent_group_cols
         self.parent_sort_cols = parent_sort_cols
 
+        # restrict retrieval to matching rows; see `RetrievalDb.get_filter_ids`
+        self.filters = filters
+
     def copy(self, **kwargs) -> DbInfo:
         """Create a copy of this DbInfo, overriding the keyword args with new values if provided.
 
         Returns:
             DbInfo: Newly instantiated copy.
         """
-        for expected_key in ["max_tokens", "prefix", "suffix"]:
+        for expected_key in ["max_tokens", "prefix", "suffix", "filters"]:
             if expected_key not in kwargs:
                 kwargs[expected_key] = getattr(self, expected_key)
         return DbInfo(self.db, **kwargs)
 
-    def get_fill_string_from_distances(self, distances: np.array) -> str:
-        """Given distances to the texts within the RetrievalDb, create an appropriate fill string.
-
-        Args:
-            distances (np.array): Distances, where closer texts in the RetrievalDb are more relevant.
-
-        Returns:
-            str: The string to include in the prompt.
-        """
-        sort_inds = get_distance_sort_indices(distances)
-        used_inds = set()
-        texts = []
-        total_tokens = 0
-        for ind in sort_inds:
-            if ind in used_inds:
-                continue
-            if self.use_parent_text:
-                token_budget = self.max_tokens - total_tokens
-                text, n_tokens, new_used_inds = self.get_parent_text(ind, token_budget)
-                used_inds.update(new_used_inds)
-            else:
-                text, n_tokens = self.get_single_text(ind)
-                used_inds.add(ind)
-            if total_tokens + n_tokens > self.max_tokens:
-                break
-            total_tokens += n_tokens
-            texts.append(text)
-            if len(texts) >= self.max_texts:
-                break
-        fill_string = self.prefix + self.join_string.join(texts) + self.suffix
-        return fill_string
-
     def get_single_text(self, ind: int):
         """Given a index, return the text and corresponding number of tokens from the RetrievalDb.
 
         Args:
-            ind (int): _description_
+            ind (int): Index into the RetrievalDb's df.
         """
-        row = self.db.df.iloc[ind]
-        text = row[self.db.embed_col]
-        n_tokens = row[self.db.n_tokens_col]
-        return text, n_tokens
+        return self.db.texts[ind], self.db.token_counts[ind]
 
-    def get_parent_text(self, ind: int, token_budget: int):
-        """
-        Intuition of "parent document" retriever is to retrieve for inclusion in a prompt the "parent" document,
-        similar to including docs on either "side" as additional context.
+    def get_single_fill_texts(self, distances: np.array) -> list[str]:
+        """The closest texts that fit within max_tokens and max_texts, closest first.
 
-        Read more: https://python.langchain.com/docs/modules/data_connection/retrievers/parent_document_retriever
+        The budget cutoff is found with a cumulative sum over the token counts of the top candidates;
+        more candidates are only selected if the budget isn't filled by the first ones.
 
         Args:
-            ind (int): Most semantically relevant index to retrieve parents of.
+            distances (np.array): Distances, where closer texts in the RetrievalDb are more relevant.
+
+        Returns:
+            list[str]: Selected texts.
         """
-        df = self.db.df
-        row = df.iloc[ind]
-        and_cond = np.ones(len(df), dtype=bool)
-        for col in self.parent_group_cols:
-            cond = df[col] == row[col]
-            and_cond = np.logical_and(and_cond, cond)
-        parent = df[and_cond]
-        if self.parent_sort_cols is not None and len(self.parent_sort_cols) > 1:
-            parent = parent.sort_values(by=self.parent_sort_cols)
-        # include a variable amount of context based on the given token_budget
-        # preference ranking implemented here:
-        #  - all docs
-        #  - up to token_budget docs from target_ind - 0
-        total_tokens = parent[self.db.n_tokens_col].sum()
-        if row[self.db.n_tokens_col] > token_budget:
-            # simple case: NOTHING will fit in the token budget!
-            return None
-        elif total_tokens <= token_budget:
-            # simple case: if all tokens in budget, no extra work
-            rows = parent
-        else:
-            target_ind_val = df.index[ind]
-            before = parent.loc[:target_ind_val]
-            # see: https://stackoverflow.com/a/37872823
-            cumulative_token_counts = before.loc[::-1, self.db.n_tokens_col].cumsum()[::-1]
-            rows = before[cumulative_token_counts <= token_budget]
-        assert len(rows) >= 1
-        new_used_inds = {df.index.get_loc(new_ind) for new_ind in rows.index}
-        assert ind in new_used_inds
-        texts = rows[self.db.embed_col]
-        n_tokens_rows = rows[self.db.n_tokens_col]
-        text = self.parent_join_string.join(texts)
-        # note this will underestimate the true number of tokens, due to whatever parent_join_string is
-        n_tokens = n_tokens_rows.sum()
-        return text, n_tokens, new_used_inds
+        k = min(self.max_texts, INITIAL_SEARCH_K)
+        while True:
+            ranked_inds, _ = self.db.search_distances(distances, k)
+            cumulative_token_counts = np.cumsum(self.db.token_counts[ranked_inds])
+            # number of leading texts whose cumulative token count is within budget
+            n_fit = np.searchsorted(cumulative_token_counts, self.max_tokens, side="right")
+            if n_fit < len(ranked_inds) or len(ranked_inds) >= self.max_texts or len(ranked_inds) < k:
+                break
+            k *= 4
+        n_selected = min(n_fit, self.max_texts)
+        return self.db.texts[ranked_inds[:n_selected]].tolist()
 
-    def get_parent_text(self, ind: int, token_budget: int):
+    def get_parent_text(self, ind: int, token_budget: int) -> tuple[str, int, set[int]]:
         """
         Intuition of "parent document" retriever is to retrieve for inclusion in a prompt the "parent" document,
         similar to including docs on either "side" as additional context.
@@ -250,49 +926,54 @@ class DbInfo:
 
         Args:
             ind (int): Most semantically relevant index to retrieve parents of.
+            token_budget (int): Maximum number of tokens to include.
+
+        Returns:
+            tuple[str, int, set[int]]: The parent text, its token count, and the indices of the included rows.
+                If the row itself doesn't fit in the token_budget, returns ("", 0, set()).
         """
-        df = self.db.df
-        row = df.iloc[ind]
-        and_cond = np.ones(len(df), dtype=bool)
-        for col in self.parent_group_cols:
-            cond = df[col] == row[col]
-            and_cond = np.logical_and(and_cond, cond)
-        parent = df[and_cond]
-        if self.parent_sort_cols is not None and len(self.parent_sort_cols) > 1:
-            parent = parent.sort_values(by=self.parent_sort_cols)
+        parent_group_index = self.db.get_parent_group_index(self.parent_group_cols, self.parent_sort_cols)
+        start, end = parent_group_index.get_group_bounds(ind)
+        token_prefix_sums = parent_group_index.token_prefix_sums
         # include a variable amount of context based on the given token_budget
         # preference ranking implemented here:
         #  - all docs
         #  - up to token_budget docs from target_ind - 0
-        total_tokens = parent[self.db.n_tokens_col].sum()
-        # new code start
-        if row[self.db.n_tokens_col] > token_budget:
-            # Return empty text and zero tokens if the row exceeds the budget
+        if self.db.token_counts[ind] > token_budget:
             return "", 0, set()
-        # new code end
-        elif total_tokens <= token_budget:
+        elif token_prefix_sums[end] - token_prefix_sums[start] <= token_budget:
             # simple case: if all tokens in budget, no extra work
-            rows = parent
+            lo, hi = start, end
         else:
-            target_ind_val = df.index[ind]
-            before = parent.loc[:target_ind_val]
-            # see: https://stackoverflow.com/a/37872823
-            cumulative_token_counts = before.loc[::-1, self.db.n_tokens_col].cumsum()[::-1]
-            rows = before[cumulative_token_counts <= token_budget]
-            # new code start
-            # Verify that the selected rows do not exceed the token budget
-            selected_tokens = rows[self.db.n_tokens_col].sum()
-            assert selected_tokens <= token_budget, f"Selected tokens {selected_tokens} exceed budget {token_budget}"
-            # new code end
-        assert len(rows) >= 1
-        new_used_inds = {df.index.get_loc(new_ind) for new_ind in rows.index}
-        assert ind in new_used_inds
-        texts = rows[self.db.embed_col]
-        n_tokens_rows = rows[self.db.n_tokens_col]
-        text = self.parent_join_string.join(texts)
+            # the longest run of group members ending at ind that fits in the token_budget
+            hi = parent_group_index.member_positions[ind] + 1
+            lo = max(start, np.searchsorted(token_prefix_sums, token_prefix_sums[hi] - token_budget, side="left"))
+        member_inds = parent_group_index.member_order[lo:hi]
+        text = self.parent_join_string.join(self.db.texts[member_inds])
         # note this will underestimate the true number of tokens, due to whatever parent_join_string is
-        n_tokens = n_tokens_rows.sum()
-        return text, n_tokens, new_used_inds
+        n_tokens = token_prefix_sums[hi] - token_prefix_sums[lo]
+        return text, n_tokens, set(member_inds.tolist())
+
+    def compute_string_distances(self, query_str: str) -> np.array:
+        """Distances from the query to the rows of the RetrievalDb, respecting this DbInfo's filters."""
+        return self.db.compute_string_distances(query_str, filters=self.filters)
+
+    async def acompute_string_distances(self, query_str: str) -> np.array:
+        """Async version of `compute_string_distances`."""
+        return await self.db.acompute_string_distances(query_str, filters=self.filters)
+
+    def compute_lexical_scores(self, query_str: str) -> np.array:
+        """BM25 scores for the rows of the RetrievalDb, respecting this DbInfo's filters."""
+        return self.db.compute_lexical_scores(query_str, filters=self.filters)
+
+    def compute_embedding_distances(self, query_embedding: np.array) -> np.array:
+        """Distances from the query embedding to the rows of the RetrievalDb, respecting this DbInfo's filters."""
+        return self.db.compute_embedding_distances(query_embedding, filters=self.filters)
+
+    def get_distances_key(self) -> tuple:
+        """DbInfos with equal keys get identical distances for the same query."""
+        filters_key = None if self.filters is None else repr(sorted(self.filters.items()))
+        return id(self.db), filters_key
 
     def get_fill_string_from_distances(self, distances: np.array) -> str:
         """Given distances to the texts within the RetrievalDb, create an appropriate fill string.
@@ -303,29 +984,61 @@ class DbInfo:
         Returns:
             str: The string to include in the prompt.
         """
-        sort_inds = get_distance_sort_indices(distances)
+        with tracing.span(
+            "get_fill_string_from_distances",
+            db_name=self.db.db_name,
+            use_parent_text=self.use_parent_text,
+        ):
+            if not self.use_parent_text:
+                texts = self.get_single_fill_texts(distances)
+                return self.prefix + self.join_string.join(texts) + self.suffix
+            texts = self.get_parent_fill_texts(distances)
+            return self.prefix + self.join_string.join(texts) + self.suffix
+
+    def get_parent_fill_texts(self, distances: np.array) -> list[str]:
+        """The parent texts of the closest rows that fit within max_tokens and max_texts, closest first.
+
+        Candidates come from `RetrievalDb.search_distances`; more (4x as many each time) are only selected
+        if the budget isn't filled by the first ones, and only from rows that weren't already considered and still fit
+        in the remaining budget. Selection stops once no row can fit in the remaining budget.
+
+        Args:
+            distances (np.array): Distances, where closer texts in the RetrievalDb are more relevant.
+
+        Returns:
+            list[str]: Selected parent texts.
+        """
         used_inds = set()
+        considered_inds = []
         texts = []
         total_tokens = 0
-        for ind in sort_inds:
-            if ind in used_inds:
-                continue
-            if self.use_parent_text:
+        candidate_distances = distances
+        k = min(self.max_texts, INITIAL_SEARCH_K)
+        while True:
+            if self.max_tokens - total_tokens < self.db.min_token_count:
+                return texts
+            ranked_inds, _ = self.db.search_distances(candidate_distances, k)
+            considered_inds.append(ranked_inds)
+            # rows too long for the remaining budget can't be selected later either, as the budget only shrinks
+            candidate_inds = ranked_inds[self.db.token_counts[ranked_inds] <= self.max_tokens - total_tokens]
+            for ind in candidate_inds.tolist():
+                if ind in used_inds:
+                    continue
                 token_budget = self.max_tokens - total_tokens
-                # new code start
                 text, n_tokens, new_used_inds = self.get_parent_text(ind, token_budget)
-                if not text.strip():  # Skip empty text
+                if not text.strip():
+                    # this row doesn't fit in the remaining budget, but a later one might
                     continue
-                # new code end
                 used_inds.update(new_used_inds)
-            else:
-                text, n_tokens = self.get_single_text(ind)
-                used_inds.add(ind)
-            if total_tokens + n_tokens > self.max_tokens:
-                break
-            total_tokens += n_tokens
-            texts.append(text)
-            if len(texts) >= self.max_texts:
-                break
-        fill_string = self.prefix + self.join_string.join(texts) + self.suffix
-        return fill_string
+                total_tokens += n_tokens
+                texts.append(text)
+                if len(texts) >= self.max_texts or self.max_tokens - total_tokens < self.db.min_token_count:
+                    return texts
+            if len(ranked_inds) < k:
+                # every scored row has been considered
+                return texts
+            # the next search only ranks rows that are new and could still be selected
+            candidate_distances = np.where(self.db.token_counts <= self.max_tokens - total_tokens, distances, np.inf)
+            candidate_distances[np.concatenate(considered_inds)] = np.inf
+            candidate_distances[list(used_inds)] = np.inf
+            k *= 4
@@ -1,19 +1,91 @@
+from __future__ import annotations
+
+import asyncio
+
+import numpy as np
+
 from brain_wave import retrieval
 
+# MappedEmbeddingRetrievalStrategy retrieval modes:
+#  - embedding: rank by embedding distance
+#  - hybrid: reciprocal-rank fusion of the embedding and BM25 rankings
+#  - lexical_first: rank by BM25 alone if its top result is confidently ahead, otherwise as in hybrid
+RETRIEVAL_MODES = ["embedding", "hybrid", "lexical_first"]
+
 
 class RetrievalStrategy:
     """General retrieval strategy interface."""
 
-    def do_retrieval(self, expected_slots: list[str], user_query: str, previous_messages: list[dict[str, str]] = []):
+    def do_retrieval(
+        self,
+        expected_slots: list[str],
+        user_query: str,
+        previous_messages: list[dict[str, str]] = [],
+        query_embedding: np.array | None = None,
+    ):
+        """Fill expected_slots for the user_query.
+
+        query_embedding, if provided, is the embedding of user_query (e.g. from a response cache lookup);
+        strategies that embed the query use it instead of embedding the query again.
+        """
         raise ValueError("Not implemented.")
 
+    def do_retrieval_batch(
+        self,
+        expected_slots: list[str],
+        user_queries: list[str],
+        previous_messages: list[dict[str, str]] = [],
+    ) -> list[dict[str, str]]:
+        """Fill expected_slots for each of the given user_queries.
+
+        Subclasses can override this to share work across queries; by default, calls `do_retrieval` for each query.
+
+        Returns:
+            list[dict[str, str]]: One slot fill dict per user query.
+        """
+        return [self.do_retrieval(expected_slots, user_query, previous_messages) for user_query in user_queries]
+
+    async def ado_retrieval(
+        self,
+        expected_slots: list[str],
+        user_query: str,
+        previous_messages: list[dict[str, str]] = [],
+        query_embedding: np.array | None = None,
+    ) -> dict[str, str]:
+        """Async version of `do_retrieval`.
+
+        Subclasses that make network calls should override this; by default, runs `do_retrieval` in a worker thread.
+        """
+        return await asyncio.to_thread(
+            self.do_retrieval,
+            expected_slots,
+            user_query,
+            previous_messages,
+            query_embedding,
+        )
+
 
 class NoRetrievalStrategy(RetrievalStrategy):
     """Fill all expected_slots with the empty string."""
 
-    def do_retrieval(self, expected_slots: list[str], user_query: str, previous_messages: list[dict[str, str]] = []):
+    def do_retrieval(
+        self,
+        expected_slots: list[str],
+        user_query: str,
+        previous_messages: list[dict[str, str]] = [],
+        query_embedding: np.array | None = None,
+    ):
         return {expected_slot: "" for expected_slot in expected_slots}
 
+    async def ado_retrieval(
+        self,
+        expected_slots: list[str],
+        user_query: str,
+        previous_messages: list[dict[str, str]] = [],
+        query_embedding: np.array | None = None,
+    ):
+        return self.do_retrieval(expected_slots, user_query, previous_messages)
+
 
 class StaticRetrievalStrategy(RetrievalStrategy):
     """Fill all expected_slots with a static string."""
@@ -22,9 +94,24 @@ class StaticRetrievalStrategy(RetrievalStrategy):
         super().__init__()
         self.fill_string = fill_string
 
-    def do_retrieval(self, expected_slots: list[str], user_query: str, previous_messages: list[dict[str, str]] = []):
+    def do_retrieval(
+        self,
+        expected_slots: list[str],
+        user_query: str,
+        previous_messages: list[dict[str, str]] = [],
+        query_embedding: np.array | None = None,
+    ):
         return {expected_slot: self.fill_string for expected_slot in expected_slots}
 
+    async def ado_retrieval(
+        self,
+        expected_slots: list[str],
+        user_query: str,
+        previous_messages: list[dict[str, str]] = [],
+        query_embedding: np.array | None = None,
+    ):
+        return self.do_retrieval(expected_slots, user_query, previous_messages)
+
 
 class EmbeddingRetrievalStrategy(RetrievalStrategy):
     """Fill all expected_slots with up to max_token texts from the retrieval_db.
@@ -35,19 +122,35 @@ class EmbeddingRetrievalStrategy(RetrievalStrategy):
         self.db: retrieval.RetrievalDb = db
         self.max_tokens: int = max_tokens
 
-    def do_retrieval(self, expected_slots: list[str], user_query: str, previous_messages: list[dict[str, str]] = []):
-        distances = self.db.compute_string_distances(user_query)
-        sort_inds = retrieval.get_distance_sort_indices(distances)
-        texts = []
-        total_tokens = 0
-        for ind in sort_inds:
-            row = self.db.df.iloc[ind]
-            n_tokens = row[self.db.n_tokens_col]
-            if total_tokens + n_tokens > self.max_tokens:
-                break
-            total_tokens += n_tokens
-            text = row[self.db.embed_col]
-            texts.append(text)
+    def do_retrieval(
+        self,
+        expected_slots: list[str],
+        user_query: str,
+        previous_messages: list[dict[str, str]] = [],
+        query_embedding: np.array | None = None,
+    ):
+        if query_embedding is None:
+            distances = self.db.compute_string_distances(user_query)
+        else:
+            distances = self.db.compute_embedding_distances(query_embedding)
+        return self.get_fill_string_map(expected_slots, distances)
+
+    async def ado_retrieval(
+        self,
+        expected_slots: list[str],
+        user_query: str,
+        previous_messages: list[dict[str, str]] = [],
+        query_embedding: np.array | None = None,
+    ):
+        if query_embedding is None:
+            distances = await self.db.acompute_string_distances(user_query)
+        else:
+            distances = await asyncio.to_thread(self.db.compute_embedding_distances, query_embedding)
+        return self.get_fill_string_map(expected_slots, distances)
+
+    def get_fill_string_map(self, expected_slots: list[str], distances: np.array) -> dict[str, str]:
+        db_info = retrieval.DbInfo(self.db, max_tokens=self.max_tokens, max_texts=len(self.db.texts))
+        texts = db_info.get_single_fill_texts(distances)
         fill_string = "\n".join(texts)
         return {expected_slot: fill_string for expected_slot in expected_slots}
 
@@ -55,12 +158,25 @@ class EmbeddingRetrievalStrategy(RetrievalStrategy):
 class MappedEmbeddingRetrievalStrategy(RetrievalStrategy):
     """Fill all expected_slots based on the entries in slot_map.
     If asked to fill a slot not in slot_map, will use nonmatching_fill instead.
-    slot_map can have either static strings or `retrieval.DbInfo`."""
+    slot_map can have either static strings or `retrieval.DbInfo`.
+    See RETRIEVAL_MODES for the supported retrieval_mode values.
+    In lexical_first mode, the BM25 ranking is used alone (skipping the embedding API call) when
+    (top score - second score) / top score >= lexical_confidence_margin."""
 
-    def __init__(self, slot_map: dict[str, str | retrieval.DbInfo], nonmatching_fill: str = "") -> None:
+    def __init__(
+        self,
+        slot_map: dict[str, str | retrieval.DbInfo],
+        nonmatching_fill: str = "",
+        retrieval_mode: str = "embedding",
+        lexical_confidence_margin: float = 0.3,
+    ) -> None:
         super().__init__()
         self.slot_map = slot_map
         self.nonmatching_fill = nonmatching_fill
+        if retrieval_mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode {retrieval_mode}; expected one of {RETRIEVAL_MODES}.")
+        self.retrieval_mode = retrieval_mode
+        self.lexical_confidence_margin = lexical_confidence_margin
         self._validate_slot_map()
 
     def _validate_slot_map(self):
@@ -77,7 +193,93 @@ class MappedEmbeddingRetrievalStrategy(RetrievalStrategy):
         self.slot_map.update(slot_updates)
         self._validate_slot_map()
 
-    def do_retrieval(self, expected_slots: list[str], user_query: str, previous_messages: list[dict[str, str]] = []):
+    def is_lexical_confident(self, lexical_scores: np.array) -> bool:
+        if len(lexical_scores) < 2:
+            return len(lexical_scores) == 1 and lexical_scores[0] > 0
+        top_score, second_score = lexical_scores[retrieval.get_top_k_indices(-lexical_scores, 2)]
+        return top_score > 0 and (top_score - second_score) / top_score >= self.lexical_confidence_margin
+
+    def do_retrieval(
+        self,
+        expected_slots: list[str],
+        user_query: str,
+        previous_messages: list[dict[str, str]] = [],
+        query_embedding: np.array | None = None,
+    ):
+        """Fill expected_slots for the user_query.
+
+        The query is embedded at most once (not at all if query_embedding is given), and all dbs needing embedding
+        distances are scored in parallel; see `retrieval.compute_federated_distances`.
+        """
+        db_infos = self.get_db_infos(expected_slots)
+        lexical_scores_by_key = self.compute_lexical_scores_by_key(db_infos, user_query)
+        embedding_db_infos = self.get_embedding_db_infos(db_infos, lexical_scores_by_key)
+        embedding_distances_list = []
+        if len(embedding_db_infos) > 0:
+            if query_embedding is None:
+                query_embedding = retrieval.embed_query(user_query)
+            embedding_distances_list = retrieval.compute_federated_distances(query_embedding, embedding_db_infos)
+        embedding_distances_by_key = {
+            db_info.get_distances_key(): distances
+            for db_info, distances in zip(embedding_db_infos, embedding_distances_list)
+        }
+        return self.get_fill_string_map(expected_slots, lexical_scores_by_key, embedding_distances_by_key)
+
+    async def ado_retrieval(
+        self,
+        expected_slots: list[str],
+        user_query: str,
+        previous_messages: list[dict[str, str]] = [],
+        query_embedding: np.array | None = None,
+    ) -> dict[str, str]:
+        """Async version of `do_retrieval`; dbs are scored concurrently in worker threads."""
+        db_infos = self.get_db_infos(expected_slots)
+        lexical_scores_by_key = self.compute_lexical_scores_by_key(db_infos, user_query)
+        embedding_db_infos = self.get_embedding_db_infos(db_infos, lexical_scores_by_key)
+        embedding_distances_list = []
+        if len(embedding_db_infos) > 0:
+            if query_embedding is None:
+                query_embedding = await retrieval.aembed_query(user_query)
+            embedding_distances_list = await retrieval.acompute_federated_distances(query_embedding, embedding_db_infos)
+        embedding_distances_by_key = {
+            db_info.get_distances_key(): distances
+            for db_info, distances in zip(embedding_db_infos, embedding_distances_list)
+        }
+        return self.get_fill_string_map(expected_slots, lexical_scores_by_key, embedding_distances_by_key)
+
+    def get_db_infos(self, expected_slots: list[str]) -> list[retrieval.DbInfo]:
+        return [
+            self.slot_map[expected_slot]
+            for expected_slot in expected_slots
+            if expected_slot in self.slot_map and type(self.slot_map[expected_slot]) is not str
+        ]
+
+    def compute_lexical_scores_by_key(self, db_infos: list[retrieval.DbInfo], user_query: str) -> dict[tuple, np.array]:
+        if self.retrieval_mode == "embedding":
+            return {}
+        unique_db_infos = {db_info.get_distances_key(): db_info for db_info in db_infos}
+        return {key: db_info.compute_lexical_scores(user_query) for key, db_info in unique_db_infos.items()}
+
+    def get_embedding_db_infos(
+        self,
+        db_infos: list[retrieval.DbInfo],
+        lexical_scores_by_key: dict[tuple, np.array],
+    ) -> list[retrieval.DbInfo]:
+        """The db_infos that need embedding distances; in lexical_first mode, those without a confident BM25 ranking."""
+        if self.retrieval_mode != "lexical_first":
+            return db_infos
+        return [
+            db_info
+            for db_info in db_infos
+            if not self.is_lexical_confident(lexical_scores_by_key[db_info.get_distances_key()])
+        ]
+
+    def get_fill_string_map(
+        self,
+        expected_slots: list[str],
+        lexical_scores_by_key: dict[tuple, np.array],
+        embedding_distances_by_key: dict[tuple, np.array],
+    ) -> dict[str, str]:
         fill_string_map = {}
         for expected_slot in expected_slots:
             if expected_slot in self.slot_map:
@@ -85,9 +287,73 @@ class MappedEmbeddingRetrievalStrategy(RetrievalStrategy):
                 if type(db_info) is str:
                     fill_string = db_info
                 else:
-                    distances = db_info.db.compute_string_distances(user_query)
+                    key = db_info.get_distances_key()
+                    distances = combine_distances(lexical_scores_by_key.get(key), embedding_distances_by_key.get(key))
                     fill_string = db_info.get_fill_string_from_distances(distances)
             else:
                 fill_string = self.nonmatching_fill
             fill_string_map[expected_slot] = fill_string
         return fill_string_map
+
+    def do_retrieval_batch(
+        self,
+        expected_slots: list[str],
+        user_queries: list[str],
+        previous_messages: list[dict[str, str]] = [],
+        batch_size: int = 256,
+    ) -> list[dict[str, str]]:
+        """Fill expected_slots for each of the given user_queries.
+
+        Queries are embedded together, and each db is scored against a batch of queries with one matrix product.
+
+        Args:
+            batch_size (int, optional): Queries scored per matrix product, bounding memory use. Defaults to 256.
+
+        Returns:
+            list[dict[str, str]]: One slot fill dict per user query.
+        """
+        if self.retrieval_mode != "embedding":
+            # lexical ranking decisions are per query
+            return super().do_retrieval_batch(expected_slots, user_queries, previous_messages)
+        db_info_slots = [
+            expected_slot
+            for expected_slot in expected_slots
+            if expected_slot in self.slot_map and type(self.slot_map[expected_slot]) is not str
+        ]
+        query_embedding_mat = retrieval.embed_queries(user_queries) if len(db_info_slots) > 0 else None
+        fill_string_maps = []
+        for start in range(0, len(user_queries), batch_size):
+            # several slots may share a db, so compute distances once per db and filters
+            distances_by_db = {}
+            for expected_slot in db_info_slots:
+                db_info = self.slot_map[expected_slot]
+                key = db_info.get_distances_key()
+                if key not in distances_by_db:
+                    distances_by_db[key] = db_info.db.compute_embedding_distances_batch(
+                        query_embedding_mat[start : start + batch_size],
+                        filters=db_info.filters,
+                    )
+            for i in range(min(batch_size, len(user_queries) - start)):
+                fill_string_map = {}
+                for expected_slot in expected_slots:
+                    if expected_slot in db_info_slots:
+                        db_info = self.slot_map[expected_slot]
+                        distances = distances_by_db[db_info.get_distances_key()][i]
+                        fill_string = db_info.get_fill_string_from_distances(distances)
+                    elif expected_slot in self.slot_map:
+                        fill_string = self.slot_map[expected_slot]
+                    else:
+                        fill_string = self.nonmatching_fill
+                    fill_string_map[expected_slot] = fill_string
+                fill_string_maps.append(fill_string_map)
+        return fill_string_maps
+
+
+def combine_distances(lexical_scores: np.array | None, embedding_distances: np.array | None) -> np.array:
+    """Distances from whichever of the BM25 and embedding rankings were computed, fused if both were."""
+    if lexical_scores is None:
+        return embedding_distances
+    lexical_distances = retrieval.convert_scores_to_distances(lexical_scores)
+    if embedding_distances is None:
+        return lexical_distances
+    return retrieval.fuse_distances([embedding_distances, lexical_distances])
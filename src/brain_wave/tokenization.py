@@ -0,0 +1,96 @@
+# Shared tiktoken tokenizers and memoized token counting
+# docs: https://github.com/openai/tiktoken
+from __future__ import annotations
+
+import collections
+import functools
+import hashlib
+import threading
+
+import tiktoken
+
+DEFAULT_MODEL = "gpt-3.5-turbo"
+TOKEN_COUNT_CACHE_SIZE = 65536
+# below this many uncached texts, encoding one at a time beats the thread pool overhead of encode_batch
+MIN_BATCH_ENCODE_TEXTS = 64
+ENCODE_NUM_THREADS = 8
+
+
+@functools.cache
+def get_tokenizer(model_name: str = DEFAULT_MODEL) -> tiktoken.Encoding:
+    """Get the tokenizer for the given model. Cached, so each encoding is loaded once per process.
+
+    Args:
+        model_name (str, optional): The model tokenizer to load. Defaults to DEFAULT_MODEL.
+
+    Returns:
+        tiktoken.Encoding: The tiktoken/OpenAI tokenizer.
+    """
+    return tiktoken.encoding_for_model(model_name)
+
+
+class TokenCounter:
+    """Thread-safe token counting for one encoding, memoized per text hash in a bounded LRU."""
+
+    def __init__(self, tokenizer: tiktoken.Encoding, cache_size: int = TOKEN_COUNT_CACHE_SIZE):
+        self.tokenizer = tokenizer
+        self.cache_size = cache_size
+        self.cache: collections.OrderedDict[bytes, int] = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def count_tokens(self, texts: list[str], use_cache: bool = True) -> list[int]:
+        """Token counts for the given texts.
+
+        Args:
+            texts (list[str]): Texts to tokenize.
+            use_cache (bool, optional): If False, neither read nor fill the LRU; use for one-off bulk work
+                that would otherwise evict frequently counted texts. Defaults to True.
+
+        Returns:
+            list[int]: Token counts corresponding to texts.
+        """
+        texts = list(texts)
+        if not use_cache:
+            return self.encode_counts(texts)
+        keys = [get_text_key(text) for text in texts]
+        counts = [None] * len(texts)
+        with self.lock:
+            for i, key in enumerate(keys):
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    counts[i] = self.cache[key]
+        missing = {keys[i]: texts[i] for i, count in enumerate(counts) if count is None}
+        if len(missing) > 0:
+            missing_counts = dict(zip(missing.keys(), self.encode_counts(list(missing.values()))))
+            with self.lock:
+                for key, count in missing_counts.items():
+                    self.cache[key] = count
+                    self.cache.move_to_end(key)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            counts = [missing_counts[key] if count is None else count for key, count in zip(keys, counts)]
+        return counts
+
+    def encode_counts(self, texts: list[str]) -> list[int]:
+        if len(texts) >= MIN_BATCH_ENCODE_TEXTS:
+            return [len(tokens) for tokens in self.tokenizer.encode_batch(texts, num_threads=ENCODE_NUM_THREADS)]
+        return [len(self.tokenizer.encode(text)) for text in texts]
+
+
+def get_token_counter(model_name: str = DEFAULT_MODEL) -> TokenCounter:
+    """The shared TokenCounter for the given model; models with the same encoding share one counter."""
+    return _get_encoding_token_counter(get_tokenizer(model_name).name)
+
+
+@functools.cache
+def _get_encoding_token_counter(encoding_name: str) -> TokenCounter:
+    return TokenCounter(tiktoken.get_encoding(encoding_name))
+
+
+def get_token_counts(texts: list[str], model_name: str = DEFAULT_MODEL, use_cache: bool = True) -> list[int]:
+    """Token counts for the given texts, using the model's tokenizer. See `TokenCounter.count_tokens`."""
+    return get_token_counter(model_name).count_tokens(texts, use_cache=use_cache)
+
+
+def get_text_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
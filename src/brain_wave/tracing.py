@@ -0,0 +1,194 @@
+# Lightweight tracing of per-stage latencies in the retrieval and prompt pipeline
+# Spans nest within a thread or async task (via contextvars); each finished root span is passed to the trace sink.
+# With no sink set (the default), `span()` returns a shared no-op context manager, so disabled tracing costs ~nothing.
+# docs: https://docs.python.org/3/library/contextvars.html
+from __future__ import annotations
+
+import collections
+import contextlib
+import contextvars
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# None disables tracing; see set_trace_sink()
+_trace_sink: TraceSink | None = None
+_current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar("current_span", default=None)
+_null_span_context = contextlib.nullcontext()
+
+
+class Span:
+    """A timed stage of a request, with any nested stages as children.
+
+    Times are from `time.perf_counter`; duration_s is None until the span is finished.
+    """
+
+    def __init__(self, name: str, attributes: dict[str, object], parent: Span | None = None):
+        self.name = name
+        self.attributes = attributes
+        self.parent = parent
+        self.children: list[Span] = []
+        self.start_time = time.perf_counter()
+        self.duration_s: float | None = None
+
+    def set_attribute(self, key: str, value: object):
+        self.attributes[key] = value
+
+    def finish(self, end_time: float | None = None):
+        if end_time is None:
+            end_time = time.perf_counter()
+        self.duration_s = end_time - self.start_time
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "duration_ms": None if self.duration_s is None else self.duration_s * 1000,
+            "attributes": self.attributes,
+            "children": [child.to_dict() for child in self.children],
+        }
+
+    def get_breakdown(self) -> list[dict]:
+        """This span and its descendants in depth-first order, as rows with a depth and duration in milliseconds."""
+        rows = []
+        stack = [(self, 0)]
+        while len(stack) > 0:
+            span, depth = stack.pop()
+            rows.append(
+                {
+                    "name": span.name,
+                    "depth": depth,
+                    "duration_ms": None if span.duration_s is None else span.duration_s * 1000,
+                    "attributes": span.attributes,
+                },
+            )
+            stack.extend((child, depth + 1) for child in span.children[::-1])
+        return rows
+
+    def format_breakdown(self) -> str:
+        """Indented, one line per span, e.g. for logging or display in the app."""
+        lines = []
+        for row in self.get_breakdown():
+            duration_str = "running" if row["duration_ms"] is None else f"{row['duration_ms']:.1f} ms"
+            attribute_str = " ".join(f"{key}={value}" for key, value in row["attributes"].items())
+            lines.append(f"{'  ' * row['depth']}{row['name']}: {duration_str} {attribute_str}".rstrip())
+        return "\n".join(lines)
+
+
+class TraceSink:
+    """Receives each finished root span; subclass and override `export`, e.g. to send spans to a tracing backend."""
+
+    def export(self, span: Span):
+        raise ValueError("Not implemented.")
+
+
+class LoggingTraceSink(TraceSink):
+    def __init__(self, level: int = logging.INFO):
+        self.level = level
+
+    def export(self, span: Span):
+        logger.log(self.level, "Trace:\n" + span.format_breakdown())
+
+
+class InMemoryTraceSink(TraceSink):
+    """Keeps the most recent max_spans root spans."""
+
+    def __init__(self, max_spans: int = 100):
+        self.spans: collections.deque[Span] = collections.deque(maxlen=max_spans)
+        self.lock = threading.Lock()
+
+    def export(self, span: Span):
+        with self.lock:
+            self.spans.append(span)
+
+    def get_spans(self) -> list[Span]:
+        with self.lock:
+            return list(self.spans)
+
+
+class SpanContext:
+    """Context manager that times a Span as the current span; created by `span()`."""
+
+    __slots__ = ["name", "attributes", "span", "token"]
+
+    def __init__(self, name: str, attributes: dict[str, object]):
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self) -> Span:
+        parent = _current_span.get()
+        self.span = Span(self.name, self.attributes, parent)
+        if parent is not None:
+            parent.children.append(self.span)
+        self.token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.span.finish()
+        if exc_type is not None:
+            self.span.set_attribute("error", exc_type.__name__)
+        _current_span.reset(self.token)
+        if self.span.parent is None:
+            export_span(self.span)
+        return False
+
+
+def span(name: str, **attributes) -> SpanContext | contextlib.nullcontext:
+    """Time the enclosed block as a span, nested in the current span if there is one.
+
+    `with tracing.span("name") as s:` gives the Span if tracing is enabled, otherwise None.
+
+    Args:
+        name (str): Name of the stage.
+        attributes: Recorded with the span, e.g. the db name; more can be added with `Span.set_attribute`.
+    """
+    if _trace_sink is None:
+        return _null_span_context
+    return SpanContext(name, attributes)
+
+
+def record_span(name: str, start_time: float, **attributes):
+    """Record a span that started at start_time (from `time.perf_counter`) and finishes now.
+
+    For stages that can't be wrapped in a `with` block, such as a streamed response consumed by the caller.
+    """
+    if _trace_sink is None:
+        return
+    parent = _current_span.get()
+    finished_span = Span(name, attributes, parent)
+    finished_span.start_time = start_time
+    finished_span.finish()
+    if parent is not None:
+        parent.children.append(finished_span)
+    else:
+        export_span(finished_span)
+
+
+def get_current_span() -> Span | None:
+    return _current_span.get()
+
+
+def export_span(root_span: Span):
+    trace_sink = _trace_sink
+    if trace_sink is None:
+        return
+    try:
+        trace_sink.export(root_span)
+    except Exception as ex:
+        # tracing should never fail a request
+        logger.warning(f"Failed to export span {root_span.name}: {ex}")
+
+
+def is_enabled() -> bool:
+    return _trace_sink is not None
+
+
+def get_trace_sink() -> TraceSink | None:
+    return _trace_sink
+
+
+def set_trace_sink(trace_sink: TraceSink | None):
+    """Set the sink for finished root spans, enabling tracing; None disables tracing."""
+    global _trace_sink
+    _trace_sink = trace_sink
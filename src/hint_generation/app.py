@@ -1,7 +1,7 @@
 import openai
 import streamlit as st
 
-from brain_wave import prompt_utils, retrieval_strategies
+from brain_wave import completion_utils, prompt_utils, retrieval_strategies
 from brain_wave.prompts import hints as hint_prompts
 from streamlit_app import auth_utils, chat_utils, data_utils
 
@@ -59,17 +59,13 @@ def process_hint_query(messages: list[dict]):
             st.markdown(prompt)
     with st.chat_message("assistant", avatar=chat_utils.get_avatar("assistant")):
         message_placeholder = st.empty()
-        with st.spinner(""):
-            completion = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo-0613",
-                messages=messages,
-            )
-            assistant_message = completion["choices"][0]["message"]
-            assert "role" in assistant_message and "content" in assistant_message
-            st.session_state.hint_prompt_manager.add_stored_message(assistant_message)
-        response = assistant_message["content"]
-        for displayed_message in chat_utils.stream_text_response(response):
-            message_placeholder.markdown(displayed_message)
+        response_stream = completion_utils.create_chat_completion_stream(
+            model="gpt-3.5-turbo-0613",
+            messages=messages,
+        )
+        response = chat_utils.render_text_stream(response_stream, message_placeholder)
+        assistant_message = {"role": "assistant", "content": response}
+        st.session_state.hint_prompt_manager.add_stored_message(assistant_message)
 
         st.session_state.hint_chat_messages.append(assistant_message)
 
@@ -109,15 +105,12 @@ def process_followup_query(user_query: str):
 
         with st.spinner(""):
             messages = st.session_state.hint_prompt_manager.build_query(user_query)
-            completion = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo-0613",
-                messages=messages,
-            )
-            assistant_message = completion["choices"][0]["message"]
-            assert "role" in assistant_message and "content" in assistant_message
-        response = assistant_message["content"]
-        for displayed_message in chat_utils.stream_text_response(response):
-            message_placeholder.markdown(displayed_message)
+        response_stream = completion_utils.create_chat_completion_stream(
+            model="gpt-3.5-turbo-0613",
+            messages=messages,
+        )
+        response = chat_utils.render_text_stream(response_stream, message_placeholder)
+        assistant_message = {"role": "assistant", "content": response}
 
         st.session_state.hint_chat_messages.append(assistant_message)
         st.session_state.hint_prompt_manager.add_stored_message(assistant_message)
@@ -0,0 +1,197 @@
+# Load generator: simulated concurrent tutoring sessions through prompt building, retrieval and chat completion
+# Run with: python -m load_testing.load_generator --help
+# By default, requests go to a stand-in API started in-process; see stub_openai_server.
+from __future__ import annotations
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import random
+import time
+from pathlib import Path
+
+import numpy as np
+import openai
+import pandas as pd
+
+from brain_wave import cache_utils, completion_utils, embedding_utils, prompt_utils, retrieval, retrieval_strategies
+from brain_wave.prompts import mathqa
+from load_testing import stub_openai_server
+
+CHAT_MODEL = "gpt-3.5-turbo-0613"
+SAMPLE_QUERIES = [
+    "How do I find the greatest common factor of 12 and 18?",
+    "What is the slope of the line through (1, 2) and (3, 8)?",
+    "How do I solve 3x + 5 = 20?",
+    "What is the area of a circle with radius 4?",
+    "How do you add fractions with different denominators?",
+    "What does it mean for two lines to be parallel?",
+    "How do I convert 0.375 to a fraction?",
+    "Why is a negative times a negative positive?",
+]
+# timed stages of each conversation turn
+STAGES = ["build_query", "time_to_first_token", "completion", "turn"]
+
+logger = logging.getLogger(__name__)
+
+
+def create_retrieval_strategy(data_dir: Path | None, db_names: list[str]) -> retrieval_strategies.RetrievalStrategy:
+    """Like the Math QA retrieval options, splitting 2000 tokens between the given dbs.
+    No retrieval if data_dir is None."""
+    if data_dir is None or len(db_names) == 0:
+        return retrieval_strategies.NoRetrievalStrategy()
+    slot_map = {}
+    for db_name in db_names:
+        db = retrieval.RetrievalDb(data_dir, db_name, "db_string", mmap=True)
+        slot_map[f"{db_name}_texts"] = retrieval.DbInfo(
+            db,
+            max_tokens=2000 // len(db_names),
+            prefix="Here is some content that might be relevant:\n",
+        )
+    return retrieval_strategies.MappedEmbeddingRetrievalStrategy(slot_map, nonmatching_fill="")
+
+
+def run_session(
+    session_id: int,
+    queries: list[str],
+    n_turns: int,
+    retrieval_strategy: retrieval_strategies.RetrievalStrategy,
+    intro_messages: list[dict[str, str]],
+) -> list[dict[str, float]]:
+    """Run one simulated conversation, returning the timings of each turn (in seconds) and any error."""
+    rng = random.Random(session_id)
+    prompt_manager = prompt_utils.PromptManager()
+    prompt_manager.set_intro_messages(intro_messages).set_retrieval_strategy(retrieval_strategy)
+    turn_results = []
+    for _ in range(n_turns):
+        result = {"session_id": session_id, "error": None}
+        turn_start = time.perf_counter()
+        try:
+            messages = prompt_manager.build_query(rng.choice(queries))
+            result["build_query"] = time.perf_counter() - turn_start
+            completion_start = time.perf_counter()
+            response_pieces = []
+            for piece in completion_utils.create_chat_completion_stream(CHAT_MODEL, messages, request_timeout=60):
+                if len(response_pieces) == 0:
+                    result["time_to_first_token"] = time.perf_counter() - completion_start
+                response_pieces.append(piece)
+            result["completion"] = time.perf_counter() - completion_start
+            prompt_manager.add_stored_message({"role": "assistant", "content": "".join(response_pieces)})
+        except Exception as ex:
+            result["error"] = f"{type(ex).__name__}: {ex}"
+        result["turn"] = time.perf_counter() - turn_start
+        turn_results.append(result)
+    return turn_results
+
+
+def run_load_test(
+    n_sessions: int,
+    n_turns: int,
+    queries: list[str],
+    retrieval_strategy: retrieval_strategies.RetrievalStrategy,
+    intro_messages: list[dict[str, str]],
+) -> dict:
+    """Run n_sessions concurrent conversations of n_turns each, in threads as the Streamlit server does.
+
+    Returns:
+        dict: Throughput, error counts, and latency percentiles (in milliseconds) per stage.
+    """
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_sessions) as executor:
+        futures = [
+            executor.submit(run_session, session_id, queries, n_turns, retrieval_strategy, intro_messages)
+            for session_id in range(n_sessions)
+        ]
+        turn_results = [result for future in futures for result in future.result()]
+    elapsed_s = time.perf_counter() - start
+    n_errors = sum(result["error"] is not None for result in turn_results)
+    report = {
+        "n_sessions": n_sessions,
+        "n_turns": len(turn_results),
+        "n_errors": n_errors,
+        "elapsed_s": elapsed_s,
+        "turns_per_second": (len(turn_results) - n_errors) / elapsed_s,
+        "latency_ms": {},
+        "errors": sorted({result["error"] for result in turn_results if result["error"] is not None})[:10],
+    }
+    for stage in STAGES:
+        stage_times = np.array(
+            [result[stage] for result in turn_results if result["error"] is None and stage in result]
+        )
+        if len(stage_times) == 0:
+            continue
+        p50, p95, p99 = np.percentile(stage_times * 1000, [50, 95, 99])
+        report["latency_ms"][stage] = {
+            "mean": float(stage_times.mean() * 1000),
+            "p50": float(p50),
+            "p95": float(p95),
+            "p99": float(p99),
+        }
+    return report
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        f"{report['n_sessions']} sessions, {report['n_turns']} turns in {report['elapsed_s']:.2f}s: "
+        f"{report['turns_per_second']:.2f} turns/s, {report['n_errors']} errors",
+        f"{'stage':<22}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}  (ms)",
+    ]
+    for stage, stats in report["latency_ms"].items():
+        lines.append(f"{stage:<22}" + "".join(f"{stats[key]:>10.1f}" for key in ["mean", "p50", "p95", "p99"]))
+    for error in report["errors"]:
+        lines.append(f"error: {error}")
+    return "\n".join(lines)
+
+
+def load_queries(queries_csv: Path | None) -> list[str]:
+    if queries_csv is None:
+        return SAMPLE_QUERIES
+    query_df = pd.read_csv(queries_csv)
+    return [post_content.strip() for post_content in query_df.post_content.dropna()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate concurrent Math QA sessions and report latency percentiles.")
+    parser.add_argument("--sessions", type=int, default=8, help="Number of concurrent sessions.")
+    parser.add_argument("--turns", type=int, default=3, help="Conversation turns per session.")
+    parser.add_argument("--data-dir", type=Path, default=None, help="Retrieval db directory, e.g. data/app_data.")
+    parser.add_argument("--db-names", nargs="*", default=["rori_microlesson", "openstax_subsection"])
+    parser.add_argument("--queries-csv", type=Path, default=None, help="e.g. mn_general_student_queries.csv")
+    parser.add_argument(
+        "--api-base",
+        default=None,
+        help="Send requests to this OpenAI-compatible API instead of starting a stand-in API in-process.",
+    )
+    parser.add_argument(
+        "--use-embedding-cache",
+        action="store_true",
+        help="Keep the default embedding cache; by default, every query embedding is requested from the API.",
+    )
+    parser.add_argument("--output-json", type=Path, default=None, help="Also write the report to this file.")
+    stub_openai_server.add_config_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.api_base is None:
+        server = stub_openai_server.start_server_thread(stub_openai_server.get_config_from_args(args))
+        openai.api_base = stub_openai_server.get_api_base(server)
+        openai.api_key = openai.api_key or "sk-stub"
+        logger.info(f"Started a stand-in API at {openai.api_base}")
+    else:
+        openai.api_base = args.api_base
+    if not args.use_embedding_cache:
+        embedding_utils.set_embedding_cache(cache_utils.EmbeddingCache(None, memory_size=0))
+
+    retrieval_strategy = create_retrieval_strategy(args.data_dir, args.db_names)
+    intro_messages = prompt_utils.PromptSelector(mathqa.intro_prompts).get_default_intro_prompt()["messages"]
+    queries = load_queries(args.queries_csv)
+    report = run_load_test(args.sessions, args.turns, queries, retrieval_strategy, intro_messages)
+    print(format_report(report))
+    if args.output_json is not None:
+        with open(args.output_json, "w") as outfile:
+            json.dump(report, outfile, indent=2)
+
+
+if __name__ == "__main__":
+    main()
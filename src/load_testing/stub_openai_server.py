@@ -0,0 +1,235 @@
+# Local stand-in for the OpenAI Embedding and ChatCompletion endpoints, for load testing without API costs
+# Point the openai package at it with: openai.api_base = "http://localhost:8089/v1"
+# Run with: python -m load_testing.stub_openai_server --help
+from __future__ import annotations
+
+import argparse
+import hashlib
+import http.server
+import json
+import logging
+import random
+import threading
+import time
+
+import numpy as np
+
+EMBEDDING_DIM = 1536
+DEFAULT_PORT = 8089
+
+logger = logging.getLogger(__name__)
+
+
+class StubApiConfig:
+    """Behaviour of the stand-in API.
+
+    Latencies are log-normal: the median is given, and sigma controls the spread (0 means constant).
+    Chat completions take the sampled latency before the first token, then emit tokens at tokens_per_second.
+    """
+
+    def __init__(
+        self,
+        embedding_latency_ms: float = 200,
+        chat_latency_ms: float = 500,
+        latency_sigma: float = 0.5,
+        tokens_per_second: float = 50,
+        completion_tokens: int = 150,
+        error_rate: float = 0.0,
+        seed: int | None = None,
+    ):
+        self.embedding_latency_ms = embedding_latency_ms
+        self.chat_latency_ms = chat_latency_ms
+        self.latency_sigma = latency_sigma
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+
+    def sample_latency_s(self, median_ms: float) -> float:
+        with self.random_lock:
+            return median_ms / 1000 * self.random.lognormvariate(0, self.latency_sigma)
+
+    def sample_is_error(self) -> bool:
+        with self.random_lock:
+            return self.random.random() < self.error_rate
+
+
+def get_stub_embedding(text: str) -> list[float]:
+    """Deterministic unit-length embedding for the text; equal texts always get equal embeddings."""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    embedding = np.random.default_rng(seed).standard_normal(EMBEDDING_DIM).astype(np.float32)
+    return (embedding / np.linalg.norm(embedding)).tolist()
+
+
+def get_stub_completion_tokens(messages: list[dict], n_tokens: int) -> list[str]:
+    """Deterministic response "tokens" (words) for the messages."""
+    seed = int.from_bytes(hashlib.sha256(json.dumps(messages, sort_keys=True).encode("utf-8")).digest()[:8], "little")
+    words = ["the", "answer", "is", "to", "add", "both", "sides", "so", "x", "equals", "3", "first", "then", "we"]
+    rng = random.Random(seed)
+    return [(" " if i > 0 else "") + rng.choice(words) for i in range(n_tokens)]
+
+
+class StubApiRequestHandler(http.server.BaseHTTPRequestHandler):
+    # set on the handler subclass created by create_server
+    config: StubApiConfig = StubApiConfig()
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        # the openai package sends embedding requests to /engines/{engine}/embeddings if given an engine
+        if self.path.endswith("/embeddings"):
+            latency_s = self.config.sample_latency_s(self.config.embedding_latency_ms)
+            handler = self.handle_embeddings
+        elif self.path.endswith("/chat/completions"):
+            latency_s = self.config.sample_latency_s(self.config.chat_latency_ms)
+            handler = self.handle_chat_completions
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+            return
+        time.sleep(latency_s)
+        if self.config.sample_is_error():
+            self.send_json(429, {"error": {"message": "Simulated rate limit error.", "type": "rate_limit_error"}})
+            return
+        handler(request)
+
+    def handle_embeddings(self, request: dict):
+        texts = request["input"] if isinstance(request["input"], list) else [request["input"]]
+        n_tokens = sum(len(text.split()) for text in texts)
+        self.send_json(
+            200,
+            {
+                "object": "list",
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": get_stub_embedding(text)}
+                    for i, text in enumerate(texts)
+                ],
+                "model": request.get("model", "text-embedding-ada-002"),
+                "usage": {"prompt_tokens": n_tokens, "total_tokens": n_tokens},
+            },
+        )
+
+    def handle_chat_completions(self, request: dict):
+        n_tokens = self.config.completion_tokens
+        if request.get("max_tokens") is not None:
+            n_tokens = min(n_tokens, request["max_tokens"])
+        tokens = get_stub_completion_tokens(request["messages"], n_tokens)
+        completion_id = f"chatcmpl-stub{random.getrandbits(32):08x}"
+        created = int(time.time())
+        model = request.get("model", "gpt-3.5-turbo")
+        if request.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            deltas = [{"role": "assistant"}] + [{"content": token} for token in tokens] + [{}]
+            for i, delta in enumerate(deltas):
+                if 0 < i < len(deltas) - 1:
+                    time.sleep(1 / self.config.tokens_per_second)
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [
+                        {"index": 0, "delta": delta, "finish_reason": "stop" if i == len(deltas) - 1 else None}
+                    ],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.close_connection = True
+            return
+        time.sleep(len(tokens) / self.config.tokens_per_second)
+        prompt_tokens = sum(len(message.get("content", "").split()) for message in request["messages"])
+        self.send_json(
+            200,
+            {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [
+                    {"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": len(tokens),
+                    "total_tokens": prompt_tokens + len(tokens),
+                },
+            },
+        )
+
+    def send_json(self, status: int, body: dict):
+        body_bytes = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body_bytes)))
+        self.end_headers()
+        self.wfile.write(body_bytes)
+
+
+def create_server(config: StubApiConfig, host: str = "localhost", port: int = DEFAULT_PORT) -> http.server.HTTPServer:
+    """Create (but don't start) a threaded stand-in API server; port 0 picks a free port."""
+    handler_class = type("ConfiguredStubApiRequestHandler", (StubApiRequestHandler,), {"config": config})
+    server = http.server.ThreadingHTTPServer((host, port), handler_class)
+    server.daemon_threads = True
+    return server
+
+
+def start_server_thread(config: StubApiConfig, host: str = "localhost", port: int = 0) -> http.server.HTTPServer:
+    """Start a stand-in API server in a daemon thread; its api_base is `get_api_base(server)`."""
+    server = create_server(config, host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def get_api_base(server: http.server.HTTPServer) -> str:
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}/v1"
+
+
+def add_config_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--embedding-latency-ms", type=float, default=200, help="Median embedding request latency.")
+    parser.add_argument("--chat-latency-ms", type=float, default=500, help="Median chat time to first token.")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Log-normal latency spread; 0 is constant.")
+    parser.add_argument("--tokens-per-second", type=float, default=50, help="Chat completion generation rate.")
+    parser.add_argument("--completion-tokens", type=int, default=150, help="Tokens per chat completion.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests failing with a 429.")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the latency and error sampling.")
+
+
+def get_config_from_args(args: argparse.Namespace) -> StubApiConfig:
+    return StubApiConfig(
+        embedding_latency_ms=args.embedding_latency_ms,
+        chat_latency_ms=args.chat_latency_ms,
+        latency_sigma=args.latency_sigma,
+        tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the OpenAI Embedding and Chat APIs.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server = create_server(get_config_from_args(args), args.host, args.port)
+    logger.info(f"Serving a stand-in OpenAI API at {get_api_base(server)}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
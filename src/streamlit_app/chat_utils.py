@@ -1,4 +1,8 @@
 import time
+from collections.abc import Iterable
+
+# placeholder re-renders per second while streaming; each re-render sends the whole message so far
+STREAM_FRAME_RATE = 15
 
 
 def get_avatar(role: str) -> str | None:
@@ -9,18 +13,26 @@ def get_avatar(role: str) -> str | None:
     return None
 
 
-def stream_text_response(response: str):
-    # Clean leading/trailing whitespace for better formatting
-    response = response.strip()
+def render_text_stream(text_pieces: Iterable[str], placeholder, frame_rate: float = STREAM_FRAME_RATE) -> str:
+    """Render text in the placeholder as its pieces arrive, e.g. from `completion_utils.create_chat_completion_stream`.
+
+    Args:
+        text_pieces (Iterable[str]): Pieces of the text, in order.
+        placeholder: Streamlit element to render into, e.g. from `st.empty()`.
+        frame_rate (float, optional): Maximum re-renders per second. Defaults to STREAM_FRAME_RATE.
 
-    displayed_message = ""
-    for char in response:
-        displayed_message += char
-        if char == "\n":
-            time.sleep(0.06)  # Slightly longer pause on line breaks
-        elif char == " ":
-            time.sleep(0.03)  # Small pause for spaces
-        else:
-            time.sleep(0.004)  # Fast character output
-        yield displayed_message + "▌"  # Typing indicator
-    yield displayed_message  # Final message without cursor
+    Returns:
+        str: The full text, with leading/trailing whitespace removed.
+    """
+    placeholder.markdown("▌")  # Typing indicator until the first piece arrives
+    pieces = []
+    last_render_time = time.monotonic()
+    for piece in text_pieces:
+        pieces.append(piece)
+        now = time.monotonic()
+        if now - last_render_time >= 1 / frame_rate:
+            placeholder.markdown("".join(pieces).strip() + "▌")
+            last_render_time = now
+    text = "".join(pieces).strip()
+    placeholder.markdown(text)  # Final message without cursor
+    return text
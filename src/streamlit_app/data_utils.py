@@ -5,7 +5,7 @@ from pathlib import Path
 import pandas as pd
 import streamlit as st
 
-from brain_wave import misconceptions, retrieval, retrieval_strategies
+from brain_wave import misconceptions, response_cache, retrieval, retrieval_strategies, tracing
 
 DATA_DIR = Path("./data") / "app_data"
 RETRIEVAL_OPTIONS_LIST = [
@@ -17,7 +17,7 @@ RETRIEVAL_OPTIONS_LIST = [
 DB_NAME_LIST = ["rori_microlesson", "openstax_subsection"]
 
 
-@st.cache_data
+@st.cache_resource
 def create_retrieval_db_map(
     db_name_list: list[str] = DB_NAME_LIST,
     except_on_error: bool = False,
@@ -26,7 +26,8 @@ def create_retrieval_db_map(
     if DATA_DIR.exists():
         for db_name in db_name_list:
             try:
-                db = retrieval.RetrievalDb(DATA_DIR, db_name, "db_string")
+                # memory-mapped, so all server processes share one copy of each embedding matrix
+                db = retrieval.RetrievalDb(DATA_DIR, db_name, "db_string", mmap=True)
                 retrieval_db_map[db_name] = db
             except Exception as ex:
                 if except_on_error:
@@ -37,7 +38,20 @@ def create_retrieval_db_map(
     return retrieval_db_map
 
 
-@st.cache_data
+@st.cache_resource
+def get_response_cache() -> response_cache.SemanticResponseCache:
+    """Semantic response cache shared by all sessions in this server process."""
+    return response_cache.SemanticResponseCache()
+
+
+@st.cache_resource
+def enable_tracing() -> tracing.TraceSink:
+    """Trace requests in this server process, logging each trace at debug level, unless a trace sink is already set."""
+    if tracing.get_trace_sink() is None:
+        tracing.set_trace_sink(tracing.LoggingTraceSink(level=logging.DEBUG))
+    return tracing.get_trace_sink()
+
+
 def create_hint_default_retrieval_slot_map() -> dict[str, retrieval.DbInfo]:
     retrieval_db_map = create_retrieval_db_map()
     rori_microlesson_db_info = retrieval.DbInfo(
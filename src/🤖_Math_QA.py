@@ -1,13 +1,12 @@
 import locale
 import logging
-import time
 from datetime import datetime
 
 import openai
 import pandas as pd
 import streamlit as st
 
-from brain_wave import prompt_utils
+from brain_wave import completion_utils, prompt_utils, tracing
 from brain_wave.prompts import mathqa
 from streamlit_app import auth_utils, chat_utils, custom_textarea, data_utils
 
@@ -54,45 +53,45 @@ def process_user_query(user_query: str):
     with st.chat_message("user", avatar=chat_utils.get_avatar("user")):
         st.markdown(user_query)
 
-    with st.chat_message("assistant", avatar=chat_utils.get_avatar("assistant")):
-        message_placeholder = st.empty()
-        displayed_message = ""
-
-        with st.spinner(""):
-            messages = st.session_state.prompt_manager.build_query(user_query)
-            if st.session_state.show_expert_controls:
-                slot_fill_dict = st.session_state.prompt_manager.most_recent_slot_fill_dict
-                # currently, we only show the retrieved texts until the next page reload
-                with st.expander("Retrieved texts:"):
-                    s = ""
-                    for key, value in slot_fill_dict.items():
-                        if value == "":
-                            value = "(none)"
-                        s += "#### " + key + ":\n\n" + value.replace("\n", "\n\n") + "\n\n\n"
-                    st.markdown(s)
-            completion = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo-0613",
-                messages=messages,
-                temperature=st.session_state.temperature,
-                request_timeout=20,
-            )
-            assistant_message = completion["choices"][0]["message"]
-            assert "role" in assistant_message and "content" in assistant_message
+    # with expert controls, the time spent in each stage is shown in the Advanced expander
+    with tracing.span("math_qa_request") as request_span:
+        with st.chat_message("assistant", avatar=chat_utils.get_avatar("assistant")):
+            message_placeholder = st.empty()
+
+            with st.spinner(""):
+                update_response_cache_setting()
+                cached_message = st.session_state.prompt_manager.get_cached_response(user_query)
+                messages = st.session_state.prompt_manager.build_query(user_query)
+                if st.session_state.show_expert_controls:
+                    slot_fill_dict = st.session_state.prompt_manager.most_recent_slot_fill_dict
+                    # currently, we only show the retrieved texts until the next page reload
+                    with st.expander("Retrieved texts:"):
+                        s = ""
+                        for key, value in slot_fill_dict.items():
+                            if value == "":
+                                value = "(none)"
+                            s += "#### " + key + ":\n\n" + value.replace("\n", "\n\n") + "\n\n\n"
+                        st.markdown(s)
+            if cached_message is not None:
+                logging.info("Using a cached response.")
+                assistant_message = cached_message
+                message_placeholder.markdown(assistant_message["content"])
+            else:
+                # render the response as it is generated
+                response_stream = completion_utils.create_chat_completion_stream(
+                    model="gpt-3.5-turbo-0613",
+                    messages=messages,
+                    temperature=st.session_state.temperature,
+                    request_timeout=20,
+                )
+                response = chat_utils.render_text_stream(response_stream, message_placeholder)
+                assistant_message = {"role": "assistant", "content": response}
+                st.session_state.prompt_manager.cache_response(assistant_message)
             st.session_state.prompt_manager.add_stored_message(assistant_message)
             # TODO add timestamp to message: int(datetime.now().timestamp())
-        response = assistant_message["content"]
-        for char in response:
-            displayed_message += char
-            if char == "\n":
-                time.sleep(0.06)
-            elif char == " ":
-                time.sleep(0.03)
-            else:
-                time.sleep(0.004)
-            message_placeholder.markdown(displayed_message + "▌")
-        message_placeholder.markdown(displayed_message)
 
-        st.session_state.chat_messages.append(assistant_message)
+            st.session_state.chat_messages.append(assistant_message)
+    st.session_state.last_request_span = request_span
 
 
 def update_temperature_setting():
@@ -117,6 +116,15 @@ def update_retrieval_setting():
     st.session_state.prompt_manager.set_retrieval_strategy(st.session_state.retrieval_strategy)
 
 
+def update_response_cache_setting():
+    if st.session_state.use_response_cache:
+        # answers depend on the retrieval option and temperature, as well as the intro messages
+        cache_namespace = f"{st.session_state.retrieval_radio}|{st.session_state.temperature}"
+        st.session_state.prompt_manager.set_response_cache(data_utils.get_response_cache(), cache_namespace)
+    else:
+        st.session_state.prompt_manager.set_response_cache(None)
+
+
 def instantiate_session():
     # settings
     setting_defaults = {
@@ -126,6 +134,8 @@ def instantiate_session():
         "retrieval_radio": data_utils.RETRIEVAL_OPTIONS_LIST[0],
         "student_query_selectbox_new_value": None,
         "show_expert_controls": False,
+        "use_response_cache": False,
+        "last_request_span": None,
     }
     # initialize all values in the settings dict
     # (happens only on the first run each session)
@@ -139,6 +149,8 @@ def instantiate_session():
     if "show_expert_controls" in st.query_params:
         if st.query_params["show_expert_controls"].lower() == "true":
             st.session_state.show_expert_controls = True
+    if st.session_state.show_expert_controls:
+        data_utils.enable_tracing()
 
     if "student_queries" not in st.session_state:
         # load the student question data
@@ -285,6 +297,19 @@ After each query, the associated prompt is included in a drop-down (including an
                     key="retrieval_radio",
                     on_change=update_retrieval_setting,
                 )
+                st.checkbox(
+                    "Reuse answers to similar first questions",
+                    key="use_response_cache",
+                    help="Answer a new chat's first question from the response cache if a similar question was answered.",
+                )
+                if st.session_state.use_response_cache:
+                    response_cache_stats = data_utils.get_response_cache().get_stats()
+                    st.markdown(
+                        f"Response cache: {response_cache_stats['hits']} hits, {response_cache_stats['misses']} misses",
+                    )
+                if st.session_state.last_request_span is not None:
+                    st.markdown("Last request time breakdown:")
+                    st.code(st.session_state.last_request_span.format_breakdown(), language=None)
 
 
 st.set_page_config(page_title="ChatGPT for middle-school math education", page_icon="🤖")
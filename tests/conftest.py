@@ -0,0 +1,31 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
+
+from brain_wave import cache_utils, embedding_utils, retrieval  # noqa: E402
+
+
+@pytest.fixture
+def seed_embeddings(monkeypatch):
+    """Returns a function that caches random embeddings for texts, so embedding them needs no API calls."""
+    embedding_cache = cache_utils.EmbeddingCache(None)
+    monkeypatch.setattr(embedding_utils, "_embedding_cache", embedding_cache)
+    rng = np.random.default_rng(0)
+
+    def seed(texts: list[str]):
+        texts = [retrieval.normalize_text(text) for text in texts]
+        embeddings = list(rng.standard_normal((len(texts), embedding_utils.EMBEDDING_DIM), dtype=np.float32))
+        embedding_cache.put_many(texts, embeddings, embedding_utils.EMBEDDING_MODEL)
+
+    return seed
+
+
+@pytest.fixture
+def embedding_mat() -> np.array:
+    """Random unit-normalized float32 embeddings."""
+    embedding_mat = np.random.default_rng(0).standard_normal((2000, 64), dtype=np.float32)
+    return embedding_mat / np.linalg.norm(embedding_mat, axis=1, keepdims=True)
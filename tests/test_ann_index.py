@@ -0,0 +1,26 @@
+import numpy as np
+import pandas as pd
+
+from brain_wave import ann_index, retrieval
+
+
+def test_probing_all_lists_returns_every_row(embedding_mat):
+    index = ann_index.IvfIndex.build(embedding_mat, n_lists=16)
+    candidate_ids = index.get_candidate_ids(embedding_mat[0], n_probe=index.n_lists)
+    assert sorted(candidate_ids.tolist()) == list(range(len(embedding_mat)))
+    # each row is in exactly one list
+    assert sorted(index.list_ids.tolist()) == list(range(len(embedding_mat)))
+
+
+def test_full_probe_search_matches_exact_top_k(tmp_path, embedding_mat):
+    df = pd.DataFrame({"text": [f"text {i}" for i in range(len(embedding_mat))], "n_tokens": 2})
+    db = retrieval.RetrievalDb(tmp_path, "ivf", "text", df)
+    db.embedding_mat = embedding_mat
+    db.build_ann_index(n_lists=16, n_probe=16, min_rows=0)
+    query_embeddings = np.random.default_rng(1).standard_normal((10, embedding_mat.shape[1]), dtype=np.float32)
+    for query_embedding in query_embeddings:
+        exact_distances = db.compute_embedding_distances(query_embedding, exact=True)
+        ann_distances = db.compute_embedding_distances(query_embedding)
+        top_k_indices = retrieval.get_top_k_indices(exact_distances, 10)
+        assert retrieval.get_top_k_indices(ann_distances, 10).tolist() == top_k_indices.tolist()
+        np.testing.assert_allclose(ann_distances[top_k_indices], exact_distances[top_k_indices], rtol=1e-5)
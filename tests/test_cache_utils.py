@@ -0,0 +1,32 @@
+import numpy as np
+
+from brain_wave import cache_utils
+
+
+def test_embedding_cache_hits_return_the_same_vector(tmp_path):
+    db_filepath = tmp_path / "embeddings.sqlite"
+    texts = ["first text", "second  text\n", "third text"]
+    embeddings = list(np.random.default_rng(0).standard_normal((len(texts), 8), dtype=np.float32))
+    embedding_cache = cache_utils.EmbeddingCache(db_filepath, memory_size=2)
+    embedding_cache.put_many(texts, embeddings, "model")
+
+    # "first text" has been evicted from memory, so is read back from disk
+    cached_embeddings = embedding_cache.get_many(texts, "model")
+    assert embedding_cache.get_stats()["disk_hits"] == 1
+    for cached_embedding, embedding in zip(cached_embeddings, embeddings):
+        assert cached_embedding.dtype == np.float32
+        np.testing.assert_array_equal(cached_embedding, embedding)
+
+    disk_embeddings = cache_utils.EmbeddingCache(db_filepath).get_many(texts, "model")
+    for disk_embedding, embedding in zip(disk_embeddings, embeddings):
+        np.testing.assert_array_equal(disk_embedding, embedding)
+
+
+def test_embedding_cache_keys():
+    embedding = np.ones(8, dtype=np.float32)
+    embedding_cache = cache_utils.EmbeddingCache(None)
+    embedding_cache.put_many(["some text"], [embedding], "model")
+    # whitespace differences share an entry; different models don't
+    np.testing.assert_array_equal(embedding_cache.get_many([" some\ntext "], "model")[0], embedding)
+    assert embedding_cache.get_many(["some text"], "other model") == [None]
+    assert embedding_cache.get_many(["other text"], "model") == [None]
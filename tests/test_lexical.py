@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from brain_wave import lexical, retrieval, retrieval_strategies
+
+TEXTS = [
+    "Add the two fractions 1/2 and 1/4.",
+    "Multiply fractions by multiplying the numerators and the denominators.",
+    "A triangle has three sides.",
+    "The area of a triangle is half the base times the height.",
+    "fractions fractions fractions",
+]
+
+
+def compute_reference_bm25_scores(texts: list[str], query: str, k1: float, b: float) -> np.array:
+    docs = [lexical.tokenize(text) for text in texts]
+    avg_doc_length = np.mean([len(doc) for doc in docs])
+    scores = np.zeros(len(docs))
+    for term in set(lexical.tokenize(query)):
+        doc_freq = sum(term in doc for doc in docs)
+        idf = np.log(1 + (len(docs) - doc_freq + 0.5) / (doc_freq + 0.5))
+        for i, doc in enumerate(docs):
+            term_freq = doc.count(term)
+            scores[i] += idf * term_freq * (k1 + 1) / (term_freq + k1 * (1 - b + b * len(doc) / avg_doc_length))
+    return scores
+
+
+def test_tokenize():
+    assert lexical.tokenize("What is 3/4 of 12? Fractions!") == ["what", "is", "3", "4", "of", "12", "fractions"]
+
+
+@pytest.mark.parametrize("query", ["fractions", "area of a triangle", "Add 1/2", "unrelated words"])
+def test_bm25_scores_match_reference(tmp_path, query):
+    index = lexical.Bm25Index.build(TEXTS)
+    expected_scores = compute_reference_bm25_scores(TEXTS, query, lexical.BM25_K1, lexical.BM25_B)
+    np.testing.assert_allclose(index.compute_scores(query), expected_scores, rtol=1e-5)
+    index.save(tmp_path / "bm25.npz")
+    loaded_index = lexical.Bm25Index.load(tmp_path / "bm25.npz")
+    np.testing.assert_allclose(loaded_index.compute_scores(query), expected_scores, rtol=1e-5)
+
+
+def test_bm25_ranking():
+    scores = lexical.Bm25Index.build(TEXTS).compute_scores("triangle area")
+    assert np.argmax(scores) == 3
+    # rows sharing no terms with the query score 0
+    assert scores[[0, 1, 4]].tolist() == [0, 0, 0]
+
+
+def test_rrf_ordering():
+    # row 1 is second in both rankings, so it beats row 0 and row 2, which are each first in only one
+    embedding_distances = np.array([0.1, 0.2, 0.9, 0.5, np.inf])
+    lexical_distances = np.array([np.inf, -5, -9, np.inf, np.inf])
+    fused_distances = retrieval.fuse_distances([embedding_distances, lexical_distances], k=60, n_candidates=3)
+    assert retrieval.get_top_k_indices(fused_distances, 4).tolist() == [1, 0, 2, 3]
+    np.testing.assert_allclose(-fused_distances[1], 1 / 62 + 1 / 62, rtol=1e-6)
+    # row 4 is in neither ranking's top n_candidates
+    assert np.isinf(fused_distances[4])
+
+
+def test_lexical_scores_convert_to_distances():
+    distances = retrieval.convert_scores_to_distances(np.array([0, 2.5, 1.0], dtype=np.float32))
+    assert distances.tolist() == [np.inf, -2.5, -1.0]
+
+
+@pytest.fixture
+def lexical_db(tmp_path, seed_embeddings) -> retrieval.RetrievalDb:
+    seed_embeddings(TEXTS + ["triangle sides", "fractions triangle"])
+    db = retrieval.RetrievalDb(tmp_path, "lexical", "text", pd.DataFrame({"text": TEXTS}))
+    db.create_embeddings()
+    return db
+
+
+def test_is_lexical_confident():
+    strategy = retrieval_strategies.MappedEmbeddingRetrievalStrategy({}, lexical_confidence_margin=0.3)
+    assert strategy.is_lexical_confident(np.array([10, 6.9, 1], dtype=np.float32))
+    assert not strategy.is_lexical_confident(np.array([10, 7.1, 1], dtype=np.float32))
+    assert not strategy.is_lexical_confident(np.zeros(3, dtype=np.float32))
+
+
+def test_lexical_first_skips_embedding_when_confident(lexical_db, monkeypatch):
+    embedded_queries = []
+    embed_query = retrieval.embed_query
+
+    def spy_embed_query(query_str):
+        embedded_queries.append(query_str)
+        return embed_query(query_str)
+
+    monkeypatch.setattr(retrieval, "embed_query", spy_embed_query)
+    db_info = retrieval.DbInfo(lexical_db, max_texts=1)
+    strategy = retrieval_strategies.MappedEmbeddingRetrievalStrategy({"texts": db_info}, retrieval_mode="lexical_first")
+
+    # "sides" only occurs in one text, so BM25 is confident
+    assert strategy.do_retrieval(["texts"], "triangle sides") == {"texts": TEXTS[2]}
+    assert embedded_queries == []
+
+    # the top two texts score about the same, so the rankings are fused as in hybrid mode
+    query = "fractions triangle"
+    hybrid_strategy = retrieval_strategies.MappedEmbeddingRetrievalStrategy({"texts": db_info}, retrieval_mode="hybrid")
+    assert strategy.do_retrieval(["texts"], query) == hybrid_strategy.do_retrieval(["texts"], query)
+    assert embedded_queries == [query, query]
@@ -0,0 +1,101 @@
+import pandas as pd
+import pytest
+
+from brain_wave import embedding_utils, prompt_utils, response_cache, retrieval, retrieval_strategies
+
+SLOT_FILL_DICT = {"query": "What is 2 + 2?", "context": "Addition {is} easy.", "n": 3}
+PROMPT_STRINGS = [
+    "A prompt without slots.",
+    "{query}",
+    "Context: {context}\nQuestion: {query}\nContext again: {context}",
+    "Escaped {{braces}} around {query}, and {{{query}}}",
+    "Unicode ✓ {query} ünïcode",
+    "A non-string fill: {n}",
+    "A format spec: {n:>5}",
+    "A conversion: {query!r}",
+]
+
+
+@pytest.mark.parametrize("prompt_string", PROMPT_STRINGS)
+def test_fill_matches_str_format(prompt_string):
+    template = prompt_utils.get_prompt_template(prompt_string)
+    assert template.fill(SLOT_FILL_DICT) == prompt_string.format(**SLOT_FILL_DICT)
+
+
+def test_compiled_template_is_cached():
+    prompt_string = "Question: {query}"
+    template = prompt_utils.get_prompt_template(prompt_string)
+    assert template.literals is not None
+    assert prompt_utils.get_prompt_template(prompt_string) is template
+
+
+def test_fill_raises_on_missing_slot():
+    with pytest.raises(KeyError):
+        prompt_utils.get_prompt_template("Context: {context}\nQuestion: {query}").fill({"query": "?"})
+
+
+def test_response_cache_miss_embeds_the_query_once(tmp_path, seed_embeddings, monkeypatch):
+    df = pd.DataFrame({"text": [f"text {i}" for i in range(10)]})
+    seed_embeddings(list(df.text) + ["What is 2 + 2?"])
+    db = retrieval.RetrievalDb(tmp_path, "texts", "text", df)
+    db.create_embeddings()
+    embedded_texts = []
+    get_openai_embeddings = embedding_utils.get_openai_embeddings
+
+    def spy_get_openai_embeddings(texts, *args, **kwargs):
+        embedded_texts.extend(texts)
+        return get_openai_embeddings(texts, *args, **kwargs)
+
+    monkeypatch.setattr(embedding_utils, "get_openai_embeddings", spy_get_openai_embeddings)
+    retrieval_strategy = retrieval_strategies.MappedEmbeddingRetrievalStrategy({"texts": retrieval.DbInfo(db)})
+    prompt_manager = (
+        prompt_utils.PromptManager()
+        .set_intro_messages([{"role": "system", "content": "Use these texts:\n{texts}"}])
+        .set_retrieval_strategy(retrieval_strategy)
+        .set_response_cache(response_cache.SemanticResponseCache())
+    )
+    assert prompt_manager.get_cached_response("What is 2 + 2?") is None
+    messages = prompt_manager.build_query("What is 2 + 2?")
+    assert embedded_texts == ["What is 2 + 2?"]
+    assert "text " in messages[0]["content"]
+
+
+def test_stored_token_counts_match_full_recount():
+    def recount(prompt_manager: prompt_utils.PromptManager) -> int:
+        if len(prompt_manager.stored_messages) == 0:
+            return 0
+        message_token_counts = [
+            prompt_utils.PromptManager.count_message_tokens(message) for message in prompt_manager.stored_messages
+        ]
+        return sum(message_token_counts) + prompt_utils.TOKENS_PER_REPLY
+
+    prompt_manager = (
+        prompt_utils.PromptManager()
+        .set_intro_messages([{"role": "system", "content": "You are a math tutor. Context: {context}"}])
+        .set_retrieval_strategy(retrieval_strategies.StaticRetrievalStrategy("Fractions have a numerator."))
+    )
+    assert prompt_manager.compute_stored_token_counts() == recount(prompt_manager) == 0
+    prompt_manager.build_query("What is 1/2 + 1/4?")
+    assert prompt_manager.compute_stored_token_counts() == recount(prompt_manager)
+    prompt_manager.add_stored_message({"role": "assistant", "content": "It is 3/4.", "name": "tutor"})
+    assert prompt_manager.compute_stored_token_counts() == recount(prompt_manager)
+    prompt_manager.build_query("And 1/3 + 1/3?")
+    assert prompt_manager.compute_stored_token_counts() == recount(prompt_manager)
+    # stored_messages truncated directly, as when regenerating a response
+    prompt_manager.stored_messages.pop()
+    assert prompt_manager.compute_stored_token_counts() == recount(prompt_manager)
+
+    prompt_manager.clear_stored_messages()
+    assert prompt_manager.compute_stored_token_counts() == recount(prompt_manager) == 0
+    # the user_query fills a slot of the new intro, so its own message isn't stored
+    prompt_manager.set_intro_messages(
+        [
+            {"role": "system", "content": "You are a patient tutor."},
+            {"role": "user", "content": "Question: {user_query}\nContext: {context}"},
+        ],
+    )
+    prompt_manager.build_query("What is a triangle?")
+    assert len(prompt_manager.stored_messages) == 2
+    assert prompt_manager.compute_stored_token_counts() == recount(prompt_manager)
+    prompt_manager.add_stored_message({"role": "assistant", "content": "A shape with three sides."})
+    assert prompt_manager.compute_stored_token_counts() == recount(prompt_manager)
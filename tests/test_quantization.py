@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+
+from brain_wave import quantization, retrieval
+
+
+def test_quantized_similarities_are_close(embedding_mat):
+    quantized_embeddings = quantization.ScalarQuantizedEmbeddings.from_embedding_mat(embedding_mat)
+    query_embedding = embedding_mat[0]
+    similarities = quantized_embeddings.compute_similarities(query_embedding)
+    np.testing.assert_allclose(similarities, embedding_mat @ query_embedding, atol=0.02)
+    ids = np.array([5, 1, 3])
+    id_similarities = quantized_embeddings.compute_similarities(query_embedding, ids)
+    np.testing.assert_allclose(id_similarities, similarities[ids], rtol=1e-5)
+
+
+def test_rescored_top_k_matches_float32_top_k(tmp_path, embedding_mat):
+    df = pd.DataFrame({"text": [f"text {i}" for i in range(len(embedding_mat))], "n_tokens": 2})
+    db = retrieval.RetrievalDb(tmp_path, "quantized", "text", df, rescore_k=50)
+    db.embedding_mat = embedding_mat
+    db.quantize_embeddings()
+    query_embeddings = np.random.default_rng(1).standard_normal((10, embedding_mat.shape[1]), dtype=np.float32)
+    for query_embedding in query_embeddings:
+        exact_top_k_indices, exact_top_k_distances = db.search_distances(
+            db.compute_embedding_distances(query_embedding, exact=True),
+            k=10,
+        )
+        top_k_indices, top_k_distances = db.search(query_embedding, k=10)
+        assert top_k_indices.tolist() == exact_top_k_indices.tolist()
+        np.testing.assert_allclose(top_k_distances, exact_top_k_distances, rtol=1e-5)
+
+
+def test_rescored_rows_rank_ahead_of_approximate_rows(tmp_path, embedding_mat):
+    df = pd.DataFrame({"text": [f"text {i}" for i in range(len(embedding_mat))], "n_tokens": 2})
+    db = retrieval.RetrievalDb(tmp_path, "quantized", "text", df, rescore_k=5)
+    db.embedding_mat = embedding_mat
+    db.quantize_embeddings()
+    query_embeddings = np.random.default_rng(1).standard_normal((50, embedding_mat.shape[1]), dtype=np.float32)
+    for query_embedding in query_embeddings:
+        exact_distances = db.compute_embedding_distances(query_embedding, exact=True)
+        top_k_indices, top_k_distances = db.search(query_embedding, k=50)
+        # the rescore_k rows with exact distances come first, in exact order
+        np.testing.assert_allclose(top_k_distances[:5], exact_distances[top_k_indices[:5]], rtol=1e-5)
+        assert top_k_distances[5] > top_k_distances[4]
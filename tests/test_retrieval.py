@@ -0,0 +1,140 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from brain_wave import retrieval
+
+
+@pytest.fixture
+def db(tmp_path, embedding_mat) -> retrieval.RetrievalDb:
+    n_rows = len(embedding_mat)
+    df = pd.DataFrame(
+        {
+            "text": [f"text {i}" for i in range(n_rows)],
+            # mostly long rows, with every tenth row short
+            "n_tokens": np.where(np.arange(n_rows) % 10 == 0, 10, 50),
+            "group": np.arange(n_rows) // 4,
+            "position": np.arange(n_rows) % 4,
+        },
+    )
+    db = retrieval.RetrievalDb(tmp_path, "fill", "text", df)
+    db.embedding_mat = embedding_mat
+    return db
+
+
+def test_parent_fill_considers_a_bounded_number_of_candidates(db, monkeypatch):
+    search_ks = []
+    get_parent_text_inds = []
+    search_distances = db.search_distances
+    get_parent_text = retrieval.DbInfo.get_parent_text
+
+    def spy_search_distances(distances, k=5, max_distance=None):
+        search_ks.append(k)
+        return search_distances(distances, k, max_distance)
+
+    def spy_get_parent_text(self, ind, token_budget):
+        get_parent_text_inds.append(ind)
+        return get_parent_text(self, ind, token_budget)
+
+    monkeypatch.setattr(db, "search_distances", spy_search_distances)
+    monkeypatch.setattr(retrieval.DbInfo, "get_parent_text", spy_get_parent_text)
+    db_info = retrieval.DbInfo(
+        db,
+        max_tokens=125,
+        use_parent_text=True,
+        parent_group_cols=["group"],
+        parent_sort_cols=["position"],
+    )
+    distances = db.compute_embedding_distances(db.embedding_mat[1], exact=True)
+    texts = db_info.get_parent_fill_texts(distances)
+
+    assert len(texts) > 0
+    # once the budget is nearly full, only the short rows that still fit are ranked, not the whole corpus
+    assert max(search_ks) < len(db.df)
+    assert len(get_parent_text_inds) <= sum(search_ks) // 4
+    # every candidate passed to get_parent_text fit in the budget
+    assert len(get_parent_text_inds) == len(texts)
+    np.testing.assert_array_less(db.token_counts[get_parent_text_inds], db_info.max_tokens + 1)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_mmap_load_normalizes_like_load(tmp_path, monkeypatch, embedding_mat, dtype):
+    monkeypatch.setenv("BRAIN_WAVE_CACHE_DIR", str(tmp_path / "cache"))
+    df = pd.DataFrame({"text": [f"text {i}" for i in range(len(embedding_mat))], "n_tokens": 2})
+    df.to_parquet(tmp_path / "unnormalized_df.parquet")
+    # saved by an older version, without normalizing
+    saved_embedding_mat = (embedding_mat * np.linspace(0.5, 2, len(embedding_mat))[:, None]).astype(dtype)
+    embedding_filepath = tmp_path / "unnormalized_embed.npy"
+    np.save(embedding_filepath, saved_embedding_mat)
+
+    db = retrieval.RetrievalDb(tmp_path, "unnormalized", "text")
+    mmap_db = retrieval.RetrievalDb(tmp_path, "unnormalized", "text", mmap=True)
+    assert isinstance(mmap_db.embedding_mat, np.memmap)
+    np.testing.assert_allclose(mmap_db.embedding_mat, db.embedding_mat, atol=1e-6)
+    np.testing.assert_allclose(
+        mmap_db.compute_embedding_distances(embedding_mat[0]),
+        db.compute_embedding_distances(embedding_mat[0]),
+        atol=1e-6,
+    )
+    # the saved file is never modified
+    np.testing.assert_array_equal(np.load(embedding_filepath), saved_embedding_mat)
+
+
+@pytest.fixture
+def filter_db(tmp_path, embedding_mat) -> retrieval.RetrievalDb:
+    n_rows = len(embedding_mat)
+    rng = np.random.default_rng(2)
+    df = pd.DataFrame(
+        {
+            "text": [f"text {i}" for i in range(n_rows)],
+            "n_tokens": 2,
+            "chapter": rng.integers(0, 5, size=n_rows),
+            "grade": rng.choice(["K", "1", "2", None], size=n_rows),
+        },
+    )
+    db = retrieval.RetrievalDb(tmp_path, "filter", "text", df)
+    db.embedding_mat = embedding_mat
+    return db
+
+
+FILTERS = [
+    {},
+    {"chapter": 3},
+    {"chapter": [1, 4]},
+    {"grade": "K"},
+    {"chapter": [0, 2], "grade": ["1", "2"]},
+    {"chapter": 9},
+    {"chapter": [3, 9], "grade": "2"},
+]
+
+
+def get_filter_mask(df: pd.DataFrame, filters: dict) -> np.array:
+    mask = np.ones(len(df), dtype=bool)
+    for col, values in filters.items():
+        mask &= df[col].isin(values if isinstance(values, list) else [values]).to_numpy()
+    return mask
+
+
+@pytest.mark.parametrize("filters", FILTERS)
+def test_filter_ids_match_mask(filter_db, filters):
+    filter_ids = filter_db.get_filter_ids(filters)
+    assert filter_ids.tolist() == np.flatnonzero(get_filter_mask(filter_db.df, filters)).tolist()
+
+
+@pytest.mark.parametrize("filters", FILTERS)
+def test_filtered_search_matches_masked_search(filter_db, filters):
+    mask = get_filter_mask(filter_db.df, filters)
+    query_embedding = filter_db.embedding_mat[7]
+    ranked_inds, _ = filter_db.search(query_embedding, k=len(filter_db.df))
+    expected_inds = ranked_inds[mask[ranked_inds]][:20]
+    top_k_indices, top_k_distances = filter_db.search(query_embedding, k=20, filters=filters)
+    assert top_k_indices.tolist() == expected_inds.tolist()
+    distances = filter_db.compute_embedding_distances(query_embedding)
+    np.testing.assert_allclose(top_k_distances, distances[expected_inds], rtol=1e-6)
+    # rows not matching the filters are never scored
+    assert np.isinf(filter_db.compute_embedding_distances(query_embedding, filters=filters)[~mask]).all()
+
+
+def test_filter_on_unknown_column_raises(filter_db):
+    with pytest.raises(ValueError):
+        filter_db.get_filter_ids({"section": 1})
@@ -0,0 +1,38 @@
+import pandas as pd
+import pytest
+
+from brain_wave import retrieval, retrieval_strategies
+
+QUERIES = ["How do I add fractions?", "What is a triangle?", "area", "Multiply 3 by 4", "fractions of a triangle"]
+
+
+@pytest.fixture
+def db(tmp_path, seed_embeddings) -> retrieval.RetrievalDb:
+    df = pd.DataFrame({"text": [f"text {i} about topic {i % 3}" for i in range(30)]})
+    df["topic"] = df.index % 3
+    seed_embeddings(list(df.text) + QUERIES)
+    db = retrieval.RetrievalDb(tmp_path, "texts", "text", df)
+    db.create_embeddings()
+    return db
+
+
+@pytest.mark.parametrize("retrieval_mode", retrieval_strategies.RETRIEVAL_MODES)
+def test_batch_retrieval_matches_per_query_retrieval(db, retrieval_mode):
+    strategy = retrieval_strategies.MappedEmbeddingRetrievalStrategy(
+        {
+            "texts": retrieval.DbInfo(db, max_texts=3),
+            # shares distances with "texts"
+            "more_texts": retrieval.DbInfo(db, max_texts=5, prefix="More:\n"),
+            "topic_texts": retrieval.DbInfo(db, max_texts=2, filters={"topic": 1}),
+            "static": "A static fill.",
+        },
+        nonmatching_fill="(none)",
+        retrieval_mode=retrieval_mode,
+    )
+    expected_slots = ["texts", "more_texts", "topic_texts", "static", "unknown"]
+    # a batch_size that doesn't divide the number of queries
+    fill_string_maps = strategy.do_retrieval_batch(expected_slots, QUERIES, batch_size=2)
+    assert fill_string_maps == [strategy.do_retrieval(expected_slots, query) for query in QUERIES]
+    assert fill_string_maps[0]["static"] == "A static fill."
+    assert fill_string_maps[0]["unknown"] == "(none)"
+    assert all(text.endswith("topic 1") for text in fill_string_maps[0]["topic_texts"].split("\n"))
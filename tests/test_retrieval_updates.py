@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from brain_wave import retrieval
+
+
+def create_db(embedding_dir, db_name: str, df: pd.DataFrame) -> retrieval.RetrievalDb:
+    db = retrieval.RetrievalDb(embedding_dir, db_name, "text", df.copy())
+    db.create_embeddings()
+    db.save_df()
+    return db
+
+
+def test_upsert_delete_compact_matches_rebuilt_db(tmp_path, seed_embeddings):
+    df = pd.DataFrame({"text": [f"original text {i}" for i in range(20)]}, index=range(20))
+    rows = pd.DataFrame(
+        {"text": ["replaced text 3", "original text 7", "new text 20", "new text 21"]},
+        index=[3, 5, 20, 21],
+    )
+    deleted_ids = [0, 9, 20]
+    seed_embeddings(list(df.text) + list(rows.text))
+
+    db = create_db(tmp_path, "updated", df)
+    assert db.upsert(rows) == 3  # "original text 7" is already embedded
+    assert db.delete(deleted_ids) == 3
+    db.compact()
+    assert not db.delta_dir.exists()
+
+    expected_df = pd.concat([df[~df.index.isin(rows.index)], rows])
+    expected_df = expected_df[~expected_df.index.isin(deleted_ids)]
+    rebuilt_db = create_db(tmp_path, "rebuilt", expected_df)
+    for updated_db in [db, retrieval.RetrievalDb(tmp_path, "updated", "text")]:
+        assert updated_db.df.index.tolist() == rebuilt_db.df.index.tolist()
+        assert updated_db.df.text.tolist() == rebuilt_db.df.text.tolist()
+        assert updated_db.df.n_tokens.tolist() == rebuilt_db.df.n_tokens.tolist()
+        np.testing.assert_allclose(updated_db.embedding_mat, rebuilt_db.embedding_mat, atol=1e-6)
+        query_embedding = rebuilt_db.embedding_mat[4]
+        top_inds, _ = updated_db.search(query_embedding, k=5)
+        assert top_inds.tolist() == rebuilt_db.search(query_embedding, k=5)[0].tolist()
+
+
+def test_failed_compact_leaves_saved_db_loadable(tmp_path, seed_embeddings, monkeypatch):
+    df = pd.DataFrame({"text": [f"original text {i}" for i in range(20)]})
+    rows = pd.DataFrame({"text": ["new text 20"]}, index=[20])
+    seed_embeddings(list(df.text) + list(rows.text))
+    db = create_db(tmp_path, "updated", df)
+    db.upsert(rows)
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(retrieval.lexical.Bm25Index, "save", fail)
+    with pytest.raises(OSError):
+        db.compact()
+    monkeypatch.undo()
+    assert sorted(path.name for path in tmp_path.iterdir() if ".tmp" in path.name) == []
+    loaded_db = retrieval.RetrievalDb(tmp_path, "updated", "text")
+    assert loaded_db.df.index.tolist() == list(range(21))
+    np.testing.assert_allclose(loaded_db.embedding_mat, db.embedding_mat, atol=1e-6)
+
+
+def test_compact_keeps_ann_index_settings(tmp_path, seed_embeddings, monkeypatch):
+    df = pd.DataFrame({"text": [f"original text {i}" for i in range(40)]})
+    seed_embeddings(list(df.text))
+    db = create_db(tmp_path, "ann", df)
+    db.build_ann_index(n_lists=3, n_probe=2, min_rows=0)
+    db.delete([0])
+    # compact() rebuilds the index with the default min_rows, which is larger than this db
+    build_ann_index = retrieval.RetrievalDb.build_ann_index
+    monkeypatch.setattr(
+        retrieval.RetrievalDb,
+        "build_ann_index",
+        lambda self, **kwargs: build_ann_index(self, min_rows=0, **kwargs),
+    )
+    db.compact()
+    assert (db.ann_index.n_lists, db.ann_index.n_probe) == (3, 2)
+    loaded_db = retrieval.RetrievalDb(tmp_path, "ann", "text")
+    assert (loaded_db.ann_index.n_lists, loaded_db.ann_index.n_probe) == (3, 2)